@@ -1,300 +1,1331 @@
 import os
+import sys
+import bisect
 import csv
 import io
 import math
 import requests
+import threading
+import json
+import sqlite3
+import time
+import uuid
+import hashlib
+import hmac
+import gzip
+import zlib
+import re
+import itertools
 from datetime import datetime, timedelta
-from typing import Dict, List, Any, Tuple
-from flask import Flask, Response, jsonify, request
+from typing import Dict, List, Any, Optional, Tuple, Iterator
+from flask import Flask, Response, g, jsonify, request, stream_with_context
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, generate_latest, multiprocess
 import logging
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 from dotenv import load_dotenv
 
+import delivery_pipeline
+import label_printing
+# Client du back-office et génération des lignes (partagés avec export_labels.py)
+from delivery_pipeline import (
+    BUILD_PHASE_DURATION, CACHE_INVALIDATIONS, CSV_FIELDNAMES, ENDPOINT_TIMEOUTS, FRESHEO_CHECKPOINT_TTL,
+    FRESHEO_DATA_DIR, FRESHEO_MAX_PARALLEL_DATES, FRESHEO_SINGLE_FLIGHT_TTL, UPSTREAM_CONCURRENCY_LIMIT,
+    BuildProgress, FresheoDeliveryAPI, LabelSnapshotStore, add_active_profile, csv_part, extract_orders_for_csv,
+    get_api_client, get_csv_filename, get_delivery_planning_name, get_http_session, get_order_cache,
+    get_snapshot_store, get_target_date, get_target_dates_range, get_upstream_limiter, is_process_alive,
+    iter_order_groups_for_csv, open_sqlite, remove_active_profile, render_csv_header, render_indexed_csv_rows,
+    resolve_target_dates
+)
+
 # Charger les variables d'environnement depuis .env
 load_dotenv()
 
 app = Flask(__name__)
 logging.basicConfig(level=logging.INFO)
 
-class FresheoDeliveryAPI:
-    def __init__(self, base_url: str, token: str):
-        # S'assurer que l'URL de base contient /api/bo/v1
-        base_url = base_url.rstrip('/')
-        if not base_url.endswith('/api/bo/v1'):
-            base_url = base_url + '/api/bo/v1'
+# Processus de rendu des QR codes (get_label_pool) lancés depuis "python app.py" : multiprocessing (spawn)
+# y réexécute ce fichier sous le nom __mp_main__. L'import ne démarre rien (serveur, préparation planifiée) ;
+# les effets visibles hors du processus (métriques partagées) sont réservés au processus serveur
+SERVER_PROCESS = __name__ != '__mp_main__'
+if SERVER_PROCESS:
+    # Limite visible dans /metrics dès le démarrage, avant le premier appel au back-office
+    UPSTREAM_CONCURRENCY_LIMIT.set(get_upstream_limiter().limit)
+
+# Envoi des CSV par nginx (X-Accel-Redirect) : préfixe de la location interne nginx qui pointe sur FRESHEO_DATA_DIR
+# (vide = le CSV est envoyé par le worker). Les fichiers de /delivery.csv sont gardés FRESHEO_CSV_FILES_TTL secondes
+FRESHEO_ACCEL_REDIRECT = os.getenv('FRESHEO_ACCEL_REDIRECT', '')
+FRESHEO_CSV_FILES_TTL = float(os.getenv('FRESHEO_CSV_FILES_TTL', 3600))
+
+# Formats compacts de /delivery.csv (format=csv.gz, jsonl, jsonl.gz, parquet) : niveau de compression gzip,
+# lignes par row group Parquet
+FRESHEO_GZIP_LEVEL = min(9, max(1, int(os.getenv('FRESHEO_GZIP_LEVEL', 6))))
+FRESHEO_PARQUET_ROW_GROUP = max(1, int(os.getenv('FRESHEO_PARQUET_ROW_GROUP', 50000)))
+
+# Étiquettes prêtes à imprimer (/delivery.zpl, /delivery.pdf) : format en mm, résolution de l'imprimante ZPL
+FRESHEO_LABEL_WIDTH_MM = float(os.getenv('FRESHEO_LABEL_WIDTH_MM', 100))
+FRESHEO_LABEL_HEIGHT_MM = float(os.getenv('FRESHEO_LABEL_HEIGHT_MM', 60))
+FRESHEO_ZPL_DPI = int(os.getenv('FRESHEO_ZPL_DPI', 203))
+# Processus de rendu des QR codes du PDF par worker (0 = dans le thread de la requête), lignes par lot
+FRESHEO_LABEL_PROCESSES = max(0, int(os.getenv('FRESHEO_LABEL_PROCESSES', 2)))
+FRESHEO_LABEL_BATCH = max(1, int(os.getenv('FRESHEO_LABEL_BATCH', 100)))
+
+# Jobs de génération CSV asynchrones
+FRESHEO_JOB_WORKERS = max(1, int(os.getenv('FRESHEO_JOB_WORKERS', 2)))
+FRESHEO_JOB_TTL = float(os.getenv('FRESHEO_JOB_TTL', 86400))
+
+# Préparation planifiée des CSV (heure "HH:MM" à partir de laquelle préparer le lendemain, vide = désactivé)
+FRESHEO_PREWARM_AT = os.getenv('FRESHEO_PREWARM_AT', '').strip()
+try:
+    FRESHEO_PREWARM_TIME = datetime.strptime(FRESHEO_PREWARM_AT, '%H:%M').time() if FRESHEO_PREWARM_AT else None
+except ValueError:
+    # Heure invalide : préparation désactivée (signalé au démarrage et dans /health)
+    FRESHEO_PREWARM_TIME = None
+FRESHEO_PREWARM_INTERVAL = max(60.0, float(os.getenv('FRESHEO_PREWARM_INTERVAL', 900)))
+FRESHEO_PREWARM_MAX_AGE = float(os.getenv('FRESHEO_PREWARM_MAX_AGE', 2 * FRESHEO_PREWARM_INTERVAL))
+
+# Attente max d'une génération live (secondes) avant de servir les derniers snapshots des dates demandées,
+# la génération continuant en arrière-plan (0 = toujours attendre la génération)
+FRESHEO_STALE_AFTER = float(os.getenv('FRESHEO_STALE_AFTER', 20))
+
+# Âge max des snapshots servis à une demande filtrée (shipping_label=, shipping_group=) sans génération (secondes)
+FRESHEO_SLICE_MAX_AGE = float(os.getenv('FRESHEO_SLICE_MAX_AGE', 300))
+
+# HEAD /delivery.csv répond depuis les snapshots ; au-delà de cet âge (secondes),
+# une actualisation est lancée en arrière-plan pour que les HEAD suivants voient les changements
+FRESHEO_HEAD_MAX_AGE = float(os.getenv('FRESHEO_HEAD_MAX_AGE', 60))
+
+# Profilage à la demande de /delivery.csv et /test/* (header X-Fresheo-Profile: <token>, vide = désactivé)
+FRESHEO_PROFILE_TOKEN = os.getenv('FRESHEO_PROFILE_TOKEN', '')
+# Intervalle d'échantillonnage des piles (secondes), durée de conservation des profils (secondes)
+FRESHEO_PROFILE_INTERVAL = max(0.001, float(os.getenv('FRESHEO_PROFILE_INTERVAL', 0.01)))
+FRESHEO_PROFILE_TTL = float(os.getenv('FRESHEO_PROFILE_TTL', 7 * 86400))
+# Nombre max d'appels au back-office gardés dans la cascade d'un profil
+FRESHEO_PROFILE_MAX_CALLS = max(1, int(os.getenv('FRESHEO_PROFILE_MAX_CALLS', 100000)))
+
+# Invalidation ciblée des caches par le back-office (POST /invalidate, header Authorization: Bearer <token>,
+# vide = désactivée), nombre max de commandes + tournées + dates par appel
+FRESHEO_INVALIDATE_TOKEN = os.getenv('FRESHEO_INVALIDATE_TOKEN', '')
+FRESHEO_INVALIDATE_MAX_IDS = max(1, int(os.getenv('FRESHEO_INVALIDATE_MAX_IDS', 10000)))
+
+# Chemin des endpoints du back-office dans la cascade des profils
+UPSTREAM_URL_TEMPLATES = {
+    'rounds': '/rounds/delivery?date={date}',
+    'round_details': '/rounds/delivery/{round_id}',
+    'order_details': '/get-order/{order_id}/delivery',
+}
+
+# Fichiers dont le code est compté dans les échantillons des profils
+PROFILED_FILES = (__file__, delivery_pipeline.__file__)
+
+class RequestProfile:
+    """
+    Profil d'une requête : échantillons des piles des threads et cascade des appels au back-office
+    - toutes les FRESHEO_PROFILE_INTERVAL secondes, la pile de chaque thread qui exécute du code de app.py
+      ou de delivery_pipeline.py (requête, tournées et commandes en parallèle, génération partagée...) est comptée
+    - chaque appel passé par FresheoDeliveryAPI est noté : début relatif, durée, taille, code HTTP
+    Les appels et les piles des autres requêtes du même worker pendant le profil sont comptés aussi
+    """
+    
+    def __init__(self, method: str, path: str):
+        self.id = uuid.uuid4().hex
+        self.method = method
+        self.path = path
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.calls = []
+        self.calls_dropped = 0
+        self.stacks = {}
+        self.sample_count = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name='request-profiler', daemon=True)
+    
+    def start(self):
+        add_active_profile(self)
+        self._thread.start()
+    
+    def stop(self):
+        remove_active_profile(self)
+        self._stop.set()
+        self._thread.join()
+    
+    def record_call(self, endpoint: str, url: str, started: float, elapsed: float, response: requests.Response = None):
+        with self._lock:
+            if len(self.calls) >= FRESHEO_PROFILE_MAX_CALLS:
+                self.calls_dropped += 1
+                return
+            self.calls.append({
+                'endpoint': endpoint,
+                'url': UPSTREAM_URL_TEMPLATES.get(endpoint, endpoint),
+                'target': url.split('/api/bo/v1', 1)[-1],
+                'start': round(started - self.started, 4),
+                'duration': round(elapsed, 4),
+                'bytes': len(response.content) if response is not None else 0,
+                'status': response.status_code if response is not None else 'error',
+                'thread': threading.current_thread().name
+            })
+    
+    def _sample(self):
+        own = threading.get_ident()
+        while not self._stop.wait(FRESHEO_PROFILE_INTERVAL):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                in_app = False
+                while frame is not None:
+                    code = frame.f_code
+                    if code is RequestProfile._sample.__code__:
+                        # Échantillonneur d'un autre profil
+                        in_app = False
+                        break
+                    in_app = in_app or code.co_filename in PROFILED_FILES
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                if not in_app:
+                    # Threads inactifs (executors en attente, boucle gunicorn)
+                    continue
+                folded = ';'.join(reversed(stack))
+                with self._lock:
+                    self.stacks[folded] = self.stacks.get(folded, 0) + 1
+                    self.sample_count += 1
+    
+    def summary(self, status_code: int, top: int = 40) -> Dict[str, Any]:
+        """Profil complet : fonctions les plus présentes dans les échantillons, cascade et totaux par endpoint"""
+        with self._lock:
+            calls = sorted(self.calls, key=lambda call: call['start'])
+            stacks = dict(self.stacks)
         
-        self.base_url = base_url
-        self.headers = {
-            'Authorization': f'Bearer {token}',
-            'Content-Type': 'application/json'
+        own_samples, total_samples = {}, {}
+        for folded, count in stacks.items():
+            frames = folded.split(';')
+            own_samples[frames[-1]] = own_samples.get(frames[-1], 0) + count
+            for function in set(frames):
+                total_samples[function] = total_samples.get(function, 0) + count
+        
+        def ranking(samples: Dict[str, int]) -> List[Dict[str, Any]]:
+            ranked = sorted(samples.items(), key=lambda item: item[1], reverse=True)[:top]
+            # Temps cumulé sur tous les threads échantillonnés (peut dépasser la durée de la requête)
+            return [{'function': function, 'samples': count, 'thread_seconds': round(count * FRESHEO_PROFILE_INTERVAL, 3)}
+                    for function, count in ranked]
+        
+        endpoints = {}
+        for call in calls:
+            stats = endpoints.setdefault(call['endpoint'], {'calls': 0, 'seconds': 0.0, 'bytes': 0, 'max_seconds': 0.0, 'statuses': {}})
+            stats['calls'] += 1
+            stats['seconds'] += call['duration']
+            stats['bytes'] += call['bytes']
+            stats['max_seconds'] = max(stats['max_seconds'], call['duration'])
+            stats['statuses'][str(call['status'])] = stats['statuses'].get(str(call['status']), 0) + 1
+        for stats in endpoints.values():
+            stats['seconds'] = round(stats['seconds'], 3)
+        
+        # Temps pendant lequel au moins un appel au back-office était en cours
+        busy, busy_until = 0.0, 0.0
+        for call in calls:
+            end = call['start'] + call['duration']
+            if end > busy_until:
+                busy += end - max(call['start'], busy_until)
+                busy_until = end
+        
+        return {
+            'id': self.id,
+            'method': self.method,
+            'path': self.path,
+            'status': status_code,
+            'started_at': datetime.fromtimestamp(self.started_at).isoformat(timespec='seconds'),
+            'duration': round(time.perf_counter() - self.started, 3),
+            'sampling': {
+                'interval': FRESHEO_PROFILE_INTERVAL,
+                'samples': self.sample_count,
+                'top_own': ranking(own_samples),
+                'top_total': ranking(total_samples),
+                'stacks': stacks
+            },
+            'upstream': {
+                'calls': len(calls),
+                'calls_dropped': self.calls_dropped,
+                'busy_seconds': round(busy, 3),
+                'endpoints': endpoints,
+                'waterfall': calls
+            }
         }
 
-    def get_delivery_rounds_for_date(self, date: str) -> List[Dict[str, Any]]:
-        """Récupère toutes les tournées pour une date donnée"""
-        url = f"{self.base_url}/rounds/delivery"
-        params = {'date': date}
-        
+def get_profiles_dir() -> str:
+    return os.path.join(FRESHEO_DATA_DIR, 'profiles')
+
+def save_profile(profile: Dict[str, Any]):
+    """Écrit le profil dans data/profiles (lisible depuis n'importe quel worker) et supprime les profils expirés"""
+    directory = get_profiles_dir()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{profile['id']}.json")
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump(profile, f)
+    os.replace(f"{path}.tmp", path)
+    
+    expired_before = time.time() - FRESHEO_PROFILE_TTL
+    for entry in os.scandir(directory):
         try:
-            # Timeout long pour éviter les problèmes de performance (5+ minutes parfois)
-            response = requests.get(url, headers=self.headers, params=params, timeout=600)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            app.logger.error(f"Erreur lors de la récupération des tournées: {e}")
-            raise
+            if entry.stat().st_mtime < expired_before:
+                os.remove(entry.path)
+        except OSError:
+            pass
 
-    def get_round_details(self, round_id: int) -> Dict[str, Any]:
-        """Récupère les détails d'une tournée spécifique"""
-        url = f"{self.base_url}/rounds/delivery/{round_id}"
+class DeliveryJobStore:
+    """
+    État des jobs de génération CSV asynchrones (SQLite) et fichiers CSV produits
+    Partagé par les workers gunicorn : n'importe quel worker peut répondre sur un job
+    """
+    
+    ACTIVE_STATUSES = ('pending', 'running')
+    
+    def __init__(self, directory: str, ttl: float = FRESHEO_JOB_TTL):
+        self.path = os.path.join(directory, 'jobs.sqlite3')
+        self.results_dir = os.path.join(directory, 'jobs')
+        self.ttl = ttl
+        self._conn = None
+        self._conn_pid = None
+        self._lock = threading.Lock()
+    
+    def _connect(self) -> sqlite3.Connection:
+        """Connexion SQLite du processus (rouverte après un fork)"""
+        if self._conn is None or self._conn_pid != os.getpid():
+            conn = open_sqlite(self.path)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    target_dates TEXT NOT NULL,
+                    filename TEXT NOT NULL,
+                    pid INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL,
+                    rounds_total INTEGER NOT NULL DEFAULT 0,
+                    rounds_done INTEGER NOT NULL DEFAULT 0,
+                    rounds_failed INTEGER NOT NULL DEFAULT 0,
+                    orders_total INTEGER NOT NULL DEFAULT 0,
+                    orders_fetched INTEGER NOT NULL DEFAULT 0,
+                    orders_defaulted INTEGER NOT NULL DEFAULT 0,
+                    rows INTEGER,
+                    date_sources TEXT,
+                    error TEXT
+                )
+            """)
+            # Colonnes ajoutées depuis la création de la table
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(jobs)')}
+            for column, definition in (('rounds_failed', 'INTEGER NOT NULL DEFAULT 0'), ('date_sources', 'TEXT'),
+                                       ('orders_defaulted', 'INTEGER NOT NULL DEFAULT 0')):
+                if column not in columns:
+                    conn.execute(f'ALTER TABLE jobs ADD COLUMN {column} {definition}')
+            os.makedirs(self.results_dir, exist_ok=True)
+            self._conn = conn
+            self._conn_pid = os.getpid()
+        return self._conn
+    
+    def result_path(self, job_id: str) -> str:
+        return os.path.join(self.results_dir, f"{job_id}.csv")
+    
+    def create(self, target_dates: List[str], filename: str) -> str:
+        """Enregistre un nouveau job en attente et retourne son identifiant"""
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                'INSERT INTO jobs (id, status, target_dates, filename, pid, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+                (job_id, 'pending', json.dumps(target_dates), filename, os.getpid(), time.time())
+            )
+        return job_id
+    
+    def update(self, job_id: str, **fields: Any):
+        """Met à jour les colonnes données d'un job"""
+        columns = ', '.join(f"{name} = ?" for name in fields)
+        with self._lock:
+            self._connect().execute(f'UPDATE jobs SET {columns} WHERE id = ?', (*fields.values(), job_id))
+    
+    def get(self, job_id: str) -> Dict[str, Any]:
+        """Retourne l'état d'un job, ou None s'il est inconnu"""
+        with self._lock:
+            conn = self._connect()
+            cursor = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            job = dict(zip([column[0] for column in cursor.description], row))
         
-        try:
-            # Timeout long pour les détails de tournée qui peuvent être volumineux
-            response = requests.get(url, headers=self.headers, timeout=300)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            app.logger.warning(f"Impossible de récupérer les détails de la tournée {round_id}: {e}")
-            return {}
+        # Un job actif dont le worker a disparu (redémarrage gunicorn) ne se terminera jamais
+        if job['status'] in self.ACTIVE_STATUSES and not is_process_alive(job['pid']):
+            job.update(status='failed', error='Job interrompu (worker arrêté)', finished_at=time.time())
+            self.update(job_id, status=job['status'], error=job['error'], finished_at=job['finished_at'])
+        
+        job['target_dates'] = json.loads(job['target_dates'])
+        job['date_sources'] = json.loads(job['date_sources']) if job['date_sources'] else None
+        return job
+    
+    def purge_expired(self):
+        """Supprime les jobs terminés depuis plus de ttl secondes et leurs fichiers"""
+        limit = time.time() - self.ttl
+        with self._lock:
+            conn = self._connect()
+            # Date de fin (un job long reste disponible ttl secondes après sa fin), de création à défaut
+            expired = [row[0] for row in conn.execute(
+                'SELECT id FROM jobs WHERE COALESCE(finished_at, created_at) < ? AND status NOT IN (?, ?)',
+                (limit, *self.ACTIVE_STATUSES)
+            )]
+            for job_id in expired:
+                conn.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+                for path in (self.result_path(job_id), f"{self.result_path(job_id)}.gz"):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+
+_job_store = None
+_job_executor = None
+_job_executor_pid = None
+_jobs_lock = threading.Lock()
+
+def get_job_store() -> DeliveryJobStore:
+    """Retourne le stockage des jobs partagé du processus"""
+    global _job_store
+    
+    with _jobs_lock:
+        if _job_store is None:
+            _job_store = DeliveryJobStore(FRESHEO_DATA_DIR)
+        return _job_store
 
-    def get_order_details(self, order_id: int) -> Dict[str, Any]:
-        """Récupère les détails complets d'une commande"""
-        url = f"{self.base_url}/get-order/{order_id}/delivery"
+def get_job_executor() -> ThreadPoolExecutor:
+    """Executor des jobs en arrière-plan (propre à chaque worker gunicorn)"""
+    global _job_executor, _job_executor_pid
+    
+    with _jobs_lock:
+        if _job_executor is None or _job_executor_pid != os.getpid():
+            _job_executor = ThreadPoolExecutor(max_workers=FRESHEO_JOB_WORKERS, thread_name_prefix='delivery-job')
+            _job_executor_pid = os.getpid()
+        return _job_executor
+
+class SingleFlight:
+    """
+    Regroupe les générations identiques simultanées : tant qu'une génération est en cours
+    pour une clé, les demandes suivantes (dans ce worker ou dans un autre worker gunicorn)
+    attendent son résultat au lieu de relancer les mêmes appels au back-office
+    """
+    
+    def __init__(self, store: LabelSnapshotStore, ttl: float = FRESHEO_SINGLE_FLIGHT_TTL, poll_interval: float = 0.5):
+        self.store = store
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self._inflight = {}
+        self._lock = threading.Lock()
+    
+    def do(self, key: str, build):
+        """Retourne build() pour cette clé, ou le résultat de la génération identique déjà en cours"""
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._inflight[key] = future
+        
+        # Même worker : attendre la génération en cours
+        if not leader:
+            app.logger.info(f"🔗 Génération déjà en cours dans ce worker pour {key}, attente du résultat")
+            return future.result()
         
         try:
-            # Timeout augmenté pour les détails de commande
-            response = requests.get(url, headers=self.headers, timeout=120)
-            response.raise_for_status()
-            data = response.json()
+            result = self._run_across_workers(key, build)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+    
+    def _run_across_workers(self, key: str, build):
+        lease = f"build:{key}"
+        waiting_since = time.time()
+        waited = False
+        
+        while True:
+            # Un autre worker a terminé la génération pendant l'attente
+            if waited:
+                result = self.store.load_flight_result(key, since=waiting_since)
+                if result is not None:
+                    return result
             
-            # L'API peut retourner un array ou un objet
-            if isinstance(data, list):
-                if len(data) > 0:
-                    return data[0]  # Retourner le premier élément
-                else:
-                    app.logger.warning(f"API a retourné une liste vide pour la commande {order_id}")
-                    return {}  # Retourner un dict vide si liste vide
+            if self.store.try_acquire_lease(lease, self.ttl):
+                try:
+                    started_at = time.time()
+                    result = build()
+                    self.store.save_flight_result(key, result, started_at=started_at)
+                    return result
+                finally:
+                    self.store.release_lease(lease)
+            
+            if not waited:
+                app.logger.info(f"🔗 Génération déjà en cours dans un autre worker pour {key}, attente du résultat")
+                waited = True
+            time.sleep(self.poll_interval)
+_single_flight = None
+_single_flight_lock = threading.Lock()
+
+def get_single_flight() -> SingleFlight:
+    """Retourne le regroupement des générations partagé du processus"""
+    global _single_flight
+    
+    store = get_snapshot_store()
+    with _single_flight_lock:
+        if _single_flight is None:
+            _single_flight = SingleFlight(store)
+        return _single_flight
+
+# Types des colonnes dans les formats typés (JSON Lines, Parquet), texte sinon
+CSV_FIELD_TYPES = {
+    'order_id': int, 'shipping_group': int, 'shipping_order': int,
+    'total_meals': int, 'max_meals': int, 'labels_quantity': int,
+    'delivery_status': lambda value: value == 'True'
+}
+
+# Formats de sortie de /delivery.csv : (type MIME, extension du fichier)
+OUTPUT_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'csv.gz': ('application/gzip', 'csv.gz'),
+    'jsonl': ('application/x-ndjson', 'jsonl'),
+    'jsonl.gz': ('application/gzip', 'jsonl.gz'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+
+def get_bool_arg(args, name: str) -> bool:
+    """Lit un paramètre de requête booléen (1, true, yes)"""
+    return args.get(name, '').lower() in ['1', 'true', 'yes']
+
+def build_delivery_dates(target_dates: List[str], api: FresheoDeliveryAPI, progress: BuildProgress = None,
+                         incremental: bool = False, row_filter: Dict[str, set] = None) -> Dict[str, Dict[str, Any]]:
+    """
+    Récupère les commandes de chaque date cible
+    Les dates sont traitées en parallèle, leurs appels partagent le budget global du back-office
+    En mode incremental, les tournées inchangées depuis la dernière génération sont réutilisées
+    Retourne {date: partie de CSV (voir csv_part, csv None si la date a échoué) + 'complete': bool}
+    Les lignes de chaque date sont rendues une seule fois ; une date complète
+    (aucune tournée en erreur) remplace le snapshot de la date avec ce rendu
+    Avec un filtre shipping_label / shipping_group, seules les tournées retenues sont récupérées
+    et les snapshots ne sont pas mis à jour
+    """
+    store = get_snapshot_store()
+    results = {}
+    
+    def extract_date(date: str) -> Dict[str, Any]:
+        app.logger.info(f"Traitement de la date: {date}")
+        started = time.time()
+        date_progress = BuildProgress(parent=progress)
+        rows = extract_orders_for_csv(date, api, progress=date_progress, round_store=store, incremental=incremental,
+                                      round_filter=get_round_filter(row_filter or {}, date))
+        csv_text, row_index = render_indexed_csv_rows(rows)
+        part = csv_part(csv_text, len(rows), started, row_index=row_index)
+        part['complete'] = date_progress.complete
+        if not part['complete']:
+            app.logger.warning(
+                f"Date {date} incomplète ({date_progress.rounds_failed} tournée(s) en erreur, "
+                f"{date_progress.orders_defaulted} commande(s) avec total_meals par défaut), snapshot non mis à jour"
+            )
+        elif not is_sliced(row_filter or {}):
+            store.save(date, rows, built_at=started, csv_text=csv_text, row_index=row_index)
+        return part
+    
+    with ThreadPoolExecutor(max_workers=min(len(target_dates), FRESHEO_MAX_PARALLEL_DATES) or 1) as executor:
+        date_futures = [(date, executor.submit(extract_date, date)) for date in target_dates]
+        
+        for date, date_future in date_futures:
+            try:
+                results[date] = date_future.result()
+            except Exception as e:
+                app.logger.warning(f"Erreur pour la date {date}: {e}")
+                results[date] = {'csv': None, 'digest': None, 'row_count': 0, 'built_at': None, 'complete': False}
+    
+    return results
+
+def build_delivery_dates_coalesced(target_dates: List[str], api: FresheoDeliveryAPI, progress: BuildProgress = None,
+                                   incremental: bool = False, row_filter: Dict[str, set] = None) -> Dict[str, Dict[str, Any]]:
+    """
+    build_delivery_dates regroupé par dates cibles, mode et filtre : une demande identique
+    à une génération en cours (même worker ou autre worker) attend et partage son résultat
+    """
+    key = f"{','.join(target_dates)}|{'incremental' if incremental else 'full'}{get_row_filter_key(row_filter or {})}"
+    return get_single_flight().do(
+        key, lambda: build_delivery_dates(target_dates, api, progress=progress, incremental=incremental, row_filter=row_filter)
+    )
+
+def get_row_filter_key(row_filter: Dict[str, set]) -> str:
+    """Représentation stable des filtres shipping_label / shipping_group (vide sans filtre)"""
+    if not is_sliced(row_filter):
+        return ''
+    filters = []
+    if 'shipping_label' in row_filter:
+        filters.append(f"shipping_label={','.join(sorted(row_filter['shipping_label']))}")
+    if 'shipping_group' in row_filter:
+        filters.append(f"shipping_group={','.join(f'{first}-{last}' for first, last in row_filter['shipping_group'])}")
+    return '|' + ';'.join(filters)
+
+def assemble_delivery_parts(target_dates: List[str], results: Dict[str, Dict[str, Any]] = None,
+                            row_filter: Dict[str, set] = None) -> Tuple[List[Dict[str, Any]], Dict[str, str], float]:
+    """
+    Assemble les parties de CSV des dates cibles, dans l'ordre des dates
+    - date complète : lignes live
+    - date en erreur ou incomplète : dernier snapshot de la date s'il existe (stale),
+      sinon lignes live partielles (partial, aucune ligne si la date a échoué)
+    Sans results (génération trop lente), toutes les dates viennent de leur snapshot
+    Les snapshots sont réduits aux groupes retenus par row_filter (results l'est déjà)
+    Retourne (parties, source de chaque date, built_at de la donnée la plus ancienne)
+    """
+    store = get_snapshot_store()
+    parts = []
+    sources = {}
+    
+    for date in target_dates:
+        result = (results or {}).get(date)
+        if result and result['complete']:
+            part, sources[date] = result, 'live'
+        else:
+            part = store.load_part(date)
+            if part is not None:
+                part = filter_csv_part(part, row_filter or {})
+                sources[date] = 'snapshot'
+            elif result:
+                part = result if result['csv'] is not None else csv_part('', 0, time.time())
+                sources[date] = 'partial'
             else:
-                return data  # Si c'est déjà un dict, retourner tel quel
-        except requests.exceptions.RequestException as e:
-            app.logger.warning(f"Impossible de récupérer les détails de la commande {order_id}: {e}")
-            return {}
+                raise ValueError(f"Aucun snapshot pour la date {date}")
+        parts.append(part)
+    
+    return parts, sources, min((part['built_at'] for part in parts), default=time.time())
+
+def get_data_headers(sources: Dict[str, str], built_at: float) -> Dict[str, str]:
+    """Headers décrivant l'origine des données : dates live, dates servies depuis un snapshot, dates incomplètes"""
+    distinct_sources = set(sources.values())
+    headers = {
+        'X-Data-Source': distinct_sources.pop() if len(distinct_sources) == 1 else 'mixed',
+        'X-Data-Built-At': datetime.fromtimestamp(built_at).isoformat(timespec='seconds'),
+        'X-Data-Age': str(int(time.time() - built_at)),
+        'X-Stale': 'true' if 'snapshot' in sources.values() else 'false',
+        'X-Live-Dates': ','.join(date for date, source in sources.items() if source in ('live', 'partial')),
+        'X-Cached-Dates': ','.join(date for date, source in sources.items() if source in ('snapshot', 'prepared', 'cached'))
+    }
+    incomplete_dates = [date for date, source in sources.items() if source == 'partial']
+    if incomplete_dates:
+        headers['X-Incomplete-Dates'] = ','.join(incomplete_dates)
+    return headers
 
-def get_target_date(simulated_today: datetime = None) -> str:
+_label_pool = None
+_label_pool_pid = None
+_label_pool_lock = threading.Lock()
+
+def get_label_pool() -> Optional[ProcessPoolExecutor]:
     """
-    Reproduit la logique SQL de filtrage par date selon le jour de la semaine
-    Note: Retourne la première date de la plage pour la nouvelle API
+    Processus de rendu des QR codes, propres à chaque worker gunicorn (None si FRESHEO_LABEL_PROCESSES=0)
+    Démarrés en "spawn" : pas de copie des threads du serveur. Sous gunicorn ils n'importent que label_printing ;
+    avec "python app.py", multiprocessing y réexécute aussi app.py (voir SERVER_PROCESS), sans démarrer le serveur
+    Un pool cassé (processus de rendu tué par l'OOM killer...) est remplacé à la demande suivante
     """
-    today = simulated_today if simulated_today else datetime.now()
-    day_of_week = today.weekday()  # 0=Lundi, 4=Vendredi, 5=Samedi, 6=Dimanche
+    global _label_pool, _label_pool_pid
     
-    if day_of_week == 4:  # Vendredi → Samedi
-        return (today + timedelta(days=1)).strftime("%Y-%m-%d")
-    elif day_of_week == 5:  # Samedi → Dimanche (première date de la plage dim-mar)
-        return (today + timedelta(days=1)).strftime("%Y-%m-%d")
-    else:  # Autres jours → Aujourd'hui
-        return today.strftime("%Y-%m-%d")
+    if not FRESHEO_LABEL_PROCESSES:
+        return None
+    with _label_pool_lock:
+        if _label_pool is not None and _label_pool_pid == os.getpid() and _label_pool._broken:
+            app.logger.warning(f"⚠️ Pool de rendu des étiquettes cassé ({_label_pool._broken}), recréé")
+            _label_pool.shutdown(wait=False)
+            _label_pool = None
+        if _label_pool is None or _label_pool_pid != os.getpid():
+            _label_pool = ProcessPoolExecutor(
+                max_workers=FRESHEO_LABEL_PROCESSES,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+            _label_pool_pid = os.getpid()
+        return _label_pool
+
+_refresh_executor = None
+_refresh_executor_pid = None
+_refresh_executor_lock = threading.Lock()
+_refresh_futures = {}
 
-def get_target_dates_range(simulated_today: datetime = None) -> List[str]:
+def get_refresh_executor() -> ThreadPoolExecutor:
     """
-    Retourne toutes les dates cibles selon la logique SQL EXACTE
-    SQL: WHEN 6 THEN shipping_date BETWEEN CURRENT_DATE + INTERVAL '1 day' AND CURRENT_DATE + INTERVAL '3 days'
+    Executor des générations live lancées par /delivery.csv (propre à chaque worker gunicorn)
+    Une génération trop lente continue en arrière-plan et met à jour les snapshots
     """
-    today = simulated_today if simulated_today else datetime.now()
-    day_of_week = today.weekday()  # 0=Lundi, 4=Vendredi, 5=Samedi, 6=Dimanche
+    global _refresh_executor, _refresh_executor_pid
     
-    if day_of_week == 4:  # Vendredi → Samedi (CURRENT_DATE + 1 day)
-        target_date = (today + timedelta(days=1)).strftime("%Y-%m-%d")
-        return [target_date]
-    elif day_of_week == 5:  # Samedi → Dimanche à Mardi (BETWEEN +1 day AND +3 days)
-        dates = []
-        dates.append((today + timedelta(days=1)).strftime("%Y-%m-%d"))  # Dimanche (+1)
-        dates.append((today + timedelta(days=2)).strftime("%Y-%m-%d"))  # Lundi (+2)
-        dates.append((today + timedelta(days=3)).strftime("%Y-%m-%d"))  # Mardi (+3)
-        return dates
-    else:  # Autres jours → Aujourd'hui (CURRENT_DATE)
-        return [today.strftime("%Y-%m-%d")]
+    with _refresh_executor_lock:
+        if _refresh_executor is None or _refresh_executor_pid != os.getpid():
+            _refresh_executor = ThreadPoolExecutor(max_workers=FRESHEO_MAX_PARALLEL_DATES, thread_name_prefix='delivery-refresh')
+            _refresh_executor_pid = os.getpid()
+            _refresh_futures.clear()
+        return _refresh_executor
 
-def get_day_name_french(date_str: str) -> str:
-    """Convertit une date en nom de jour en français"""
-    date_obj = datetime.strptime(date_str, "%Y-%m-%d")
-    days = ['lundi', 'mardi', 'mercredi', 'jeudi', 'vendredi', 'samedi', 'dimanche']
-    return days[date_obj.weekday()]
+def start_background_refresh(target_dates: List[str], api: FresheoDeliveryAPI, incremental: bool = False,
+                             row_filter: Dict[str, set] = None) -> Future:
+    """Lance la génération des dates en arrière-plan, ou retourne celle déjà en cours dans ce worker pour les mêmes dates, mode et filtre"""
+    executor = get_refresh_executor()
+    key = (tuple(target_dates), incremental, get_row_filter_key(row_filter or {}))
+    with _refresh_executor_lock:
+        future = _refresh_futures.get(key)
+        if future is None:
+            future = executor.submit(build_delivery_dates_coalesced, target_dates, api, incremental=incremental, row_filter=row_filter)
+            _refresh_futures[key] = future
+            future.add_done_callback(lambda done: _refresh_futures.pop(key, None))
+    return future
 
-def get_delivery_planning_name(date_str: str, time_slot: str) -> str:
+def get_delivery_parts(target_dates: List[str], api: FresheoDeliveryAPI, incremental: bool = False,
+                       row_filter: Dict[str, set] = None) -> Tuple[List[Dict[str, Any]], Dict[str, str], float]:
     """
-    Génère le delivery_planning_name au format "lundi matin" ou "mardi soir"
+    Génération live avec repli sur les derniers snapshots (stale-while-revalidate)
+    - date en erreur ou incomplète : son dernier snapshot est servi (voir assemble_delivery_parts)
+    - génération plus longue que FRESHEO_STALE_AFTER alors que toutes les dates ont un snapshot :
+      les snapshots sont servis tout de suite, la génération continue en arrière-plan et les remplacera
+    Avec un filtre shipping_label / shipping_group, voir get_sliced_parts
+    Retourne (parties de CSV, source de chaque date, built_at de la donnée la plus ancienne)
     """
-    day_name = get_day_name_french(date_str)
+    row_filter = row_filter or {}
+    if is_sliced(row_filter):
+        sliced = get_sliced_parts(target_dates, api, row_filter, incremental=incremental)
+        if sliced is not None:
+            return sliced
+    
+    store = get_snapshot_store()
+    if FRESHEO_STALE_AFTER <= 0 or len(store.built_at(target_dates)) < len(target_dates):
+        return assemble_delivery_parts(
+            target_dates, build_delivery_dates_coalesced(target_dates, api, incremental=incremental, row_filter=row_filter), row_filter
+        )
     
-    # Extraire l'heure du time_slot (format "09:00" ou "13:00")
+    future = start_background_refresh(target_dates, api, incremental=incremental, row_filter=row_filter)
     try:
-        hour = int(time_slot.split(':')[0])
-        period = "matin" if hour < 12 else "soir"
-        return f"{day_name} {period}"
-    except (ValueError, IndexError):
-        return f"{day_name} journée"
+        results = future.result(timeout=FRESHEO_STALE_AFTER)
+    except FuturesTimeoutError:
+        app.logger.warning(f"⏳ Back-office lent : derniers snapshots servis pour {', '.join(target_dates)}, actualisation en arrière-plan")
+        results = None
+    return assemble_delivery_parts(target_dates, results, row_filter)
+
+def get_sliced_parts(target_dates: List[str], api: FresheoDeliveryAPI, row_filter: Dict[str, set],
+                     incremental: bool = False) -> Tuple[List[Dict[str, Any]], Dict[str, str], float]:
+    """
+    Demande filtrée (shipping_label / shipping_group) servie depuis l'index des snapshots,
+    si toutes les dates ont un snapshot de moins de FRESHEO_SLICE_MAX_AGE secondes : aucune génération
+    Au-delà de FRESHEO_HEAD_MAX_AGE, une génération complète est lancée en arrière-plan pour les demandes suivantes
+    Retourne None si une date n'a pas de snapshot assez récent (seules les tournées retenues sont alors générées)
+    """
+    store = get_snapshot_store()
+    parts = [store.load_part(date) for date in target_dates]
+    if any(part is None or time.time() - part['built_at'] > FRESHEO_SLICE_MAX_AGE for part in parts):
+        return None
+    
+    built_at = min((part['built_at'] for part in parts), default=time.time())
+    if time.time() - built_at > FRESHEO_HEAD_MAX_AGE:
+        start_background_refresh(target_dates, api, incremental=incremental)
+    return [filter_csv_part(part, row_filter) for part in parts], {date: 'cached' for date in target_dates}, built_at
+
+def parse_row_filter(args) -> Dict[str, set]:
+    """
+    Filtres de /delivery.csv sur les colonnes du CSV, valeurs séparées par des virgules ou répétées :
+    shipping_date=2025-08-02, shipping_label=samedi matin, shipping_group=1-5,8
+    Retourne {colonne: valeurs acceptées} pour les filtres présents (vide sans filtre),
+    shipping_group sous forme de plages [(début, fin)] triées et fusionnées (jamais développées)
+    Lève ValueError avec le message d'erreur destiné au client
+    """
+    def values(name: str) -> List[str]:
+        return [value.strip() for raw in args.getlist(name) for value in raw.split(',') if value.strip()]
+    
+    row_filter = {}
+    if values('shipping_date'):
+        for date in values('shipping_date'):
+            try:
+                datetime.strptime(date, '%Y-%m-%d')
+            except ValueError:
+                raise ValueError('Format de date invalide pour shipping_date. Utiliser yyyy-mm-dd')
+        row_filter['shipping_date'] = set(values('shipping_date'))
+    if values('shipping_label'):
+        row_filter['shipping_label'] = {label.lower() for label in values('shipping_label')}
+    if values('shipping_group'):
+        ranges = []
+        for value in values('shipping_group'):
+            first, _, last = value.partition('-')
+            if not first.isdigit() or (last and not last.isdigit()):
+                raise ValueError('shipping_group attend des numéros de tournée ou des plages (ex: 1-5,8)')
+            first, last = int(first), int(last or first)
+            if first > last:
+                raise ValueError(f'Plage shipping_group inversée: {value} (utiliser {last}-{first})')
+            ranges.append((first, last))
+        row_filter['shipping_group'] = merge_group_ranges(ranges)
+    return row_filter
+
+def merge_group_ranges(ranges: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """Plages de tournées triées, celles qui se chevauchent ou se suivent fusionnées (ex: 1-5,3-8,9 → 1-9)"""
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+def in_group_ranges(ranges: List[Tuple[int, int]], group: int) -> bool:
+    """La tournée group est dans une des plages (triées, disjointes)"""
+    index = bisect.bisect_right(ranges, (group, math.inf)) - 1
+    return index >= 0 and ranges[index][0] <= group <= ranges[index][1]
 
-def format_customer_name(first_name: str, last_name: str) -> str:
-    """Formate le nom client en Title Case comme dans SQL INITCAP"""
-    return f"{first_name.title()} {last_name.title()}"
+def is_sliced(row_filter: Dict[str, set]) -> bool:
+    """Le filtre retient une partie des groupes d'une date (shipping_label ou shipping_group)"""
+    return 'shipping_label' in row_filter or 'shipping_group' in row_filter
 
-def calculate_labels_quantity(total_meals: int) -> int:
-    """Calcule le nombre d'étiquettes nécessaires (ceil(total_meals / 7))"""
-    return math.ceil(total_meals / 7)
+def matches_group(row_filter: Dict[str, set], label: str, group: int) -> bool:
+    """Le groupe (shipping_label, shipping_group) est retenu par le filtre"""
+    return (('shipping_label' not in row_filter or label.lower() in row_filter['shipping_label'])
+            and ('shipping_group' not in row_filter or in_group_ranges(row_filter['shipping_group'], group)))
 
-def generate_color_code(delivery_tour_index: int) -> str:
-    """Génère le code couleur basé sur l'index de tournée"""
-    return f"color_{((delivery_tour_index % 10) + 1)}"
+def get_round_filter(row_filter: Dict[str, set], date: str):
+    """Filtre sur la liste des tournées d'une date (seules les tournées retenues sont redemandées), ou None"""
+    if not is_sliced(row_filter):
+        return None
+    return lambda round_data: matches_group(row_filter, get_delivery_planning_name(date, round_data['timeOfDay']), round_data['round'])
 
-def extract_orders_for_csv(date: str, api: FresheoDeliveryAPI) -> List[Dict[str, Any]]:
+def filter_csv_part(part: Dict[str, Any], row_filter: Dict[str, set]) -> Dict[str, Any]:
+    """Partie réduite aux groupes retenus, découpée dans le CSV déjà rendu grâce à l'index (sans resérialisation)"""
+    if not is_sliced(row_filter):
+        return part
+    chunks = []
+    row_index = []
+    position = 0
+    for label, group, start, end, count in part['index']:
+        if matches_group(row_filter, label, group):
+            chunks.append(part['csv'][start:end])
+            row_index.append([label, group, position, position + end - start, count])
+            position += end - start
+    return csv_part(''.join(chunks), sum(entry[4] for entry in row_index), part['built_at'], row_index=row_index)
+
+def iter_part_rows(parts: List[Dict[str, Any]]) -> Iterator[Dict[str, str]]:
+    """Lignes des parties de CSV, dans l'ordre du CSV (valeurs texte)"""
+    for part in parts:
+        yield from csv.DictReader(io.StringIO(part['csv']), fieldnames=CSV_FIELDNAMES)
+
+def get_output_format(args, accept_mimetypes) -> str:
+    """
+    Format demandé : paramètre format=, sinon header Accept (CSV par défaut, y compris pour */*)
+    Lève ValueError si le format est inconnu
+    """
+    output_format = args.get('format')
+    if output_format:
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Format inconnu: {output_format} (attendu: {', '.join(OUTPUT_FORMATS)})")
+        return output_format
+    best = accept_mimetypes.best_match(['text/csv', 'application/x-ndjson', 'application/vnd.apache.parquet'])
+    return {'application/x-ndjson': 'jsonl', 'application/vnd.apache.parquet': 'parquet'}.get(best, 'csv')
+
+def get_output_filename(filename: str, output_format: str) -> str:
+    return f"{filename.rsplit('.', 1)[0]}.{OUTPUT_FORMATS[output_format][1]}"
+
+def get_output_digests(digests: List[str], output_format: str) -> List[str]:
+    """Empreintes de l'ETag : celles du CSV, plus le format s'il est différent (un ETag par représentation)"""
+    return digests if output_format == 'csv' else digests + [output_format]
+
+def iter_typed_rows(csv_chunks: Iterator[str]) -> Iterator[Dict[str, Any]]:
+    """Lignes typées (entiers, booléens) lues au fil des morceaux de CSV sans header"""
+    for chunk in csv_chunks:
+        for row in csv.DictReader(io.StringIO(chunk), fieldnames=CSV_FIELDNAMES):
+            for field, convert in CSV_FIELD_TYPES.items():
+                row[field] = convert(row[field])
+            yield row
+
+def iter_jsonl(csv_chunks: Iterator[str]) -> Iterator[str]:
+    """JSON Lines : un objet par ligne, un morceau envoyé par morceau de CSV"""
+    for chunk in csv_chunks:
+        yield ''.join(json.dumps(row, ensure_ascii=False) + '\n' for row in iter_typed_rows([chunk]))
+
+class _ParquetSink(io.RawIOBase):
+    """Destination du writer Parquet : les octets écrits sont récupérés au fur et à mesure (take)"""
+    
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._position = 0
+    
+    def writable(self) -> bool:
+        return True
+    
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+    
+    def tell(self) -> int:
+        return self._position
+    
+    def take(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def iter_parquet(csv_chunks: Iterator[str]) -> Iterator[bytes]:
     """
-    Extrait et formate toutes les commandes pour le CSV en utilisant la nouvelle API
+    Parquet à colonnes typées (shipping_date en date), écrit row group par row group
+    (FRESHEO_PARQUET_ROW_GROUP lignes) : chaque row group est envoyé dès qu'il est écrit
     """
-    orders_for_csv = []
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    
+    types = {field: pa.int64() for field, convert in CSV_FIELD_TYPES.items() if convert is int}
+    types.update({'delivery_status': pa.bool_(), 'shipping_date': pa.date32()})
+    schema = pa.schema([(field, types.get(field, pa.string())) for field in CSV_FIELDNAMES])
+    
+    sink = _ParquetSink()
+    writer = pq.ParquetWriter(sink, schema, compression='zstd')
     
-    # 1. Récupérer toutes les tournées du jour
-    rounds = api.get_delivery_rounds_for_date(date)
+    def write(rows: List[Dict[str, Any]]) -> bytes:
+        for row in rows:
+            row['shipping_date'] = datetime.strptime(row['shipping_date'], '%Y-%m-%d').date()
+        writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+        return sink.take()
     
-    # 2. Pour chaque tournée, récupérer les détails
-    for round_data in rounds:
-        round_details = api.get_round_details(round_data['id'])
+    rows = []
+    for row in iter_typed_rows(csv_chunks):
+        rows.append(row)
+        if len(rows) >= FRESHEO_PARQUET_ROW_GROUP:
+            yield write(rows)
+            rows = []
+    if rows:
+        yield write(rows)
+    writer.close()
+    yield sink.take()
+
+def iter_gzip(chunks: Iterator[str]) -> Iterator[bytes]:
+    """Compression gzip au fil de l'eau (un seul membre gzip)"""
+    compressor = zlib.compressobj(FRESHEO_GZIP_LEVEL, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+def iter_output(output_format: str, csv_chunks: Iterator[str]) -> Iterator:
+    """Corps de la réponse dans le format demandé, à partir des morceaux de CSV sans header"""
+    if output_format == 'parquet':
+        return iter_parquet(csv_chunks)
+    if output_format.startswith('jsonl'):
+        body = iter_jsonl(csv_chunks)
+    else:
+        body = itertools.chain([render_csv_header()], csv_chunks)
+    return iter_gzip(body) if output_format.endswith('.gz') else body
+
+def join_csv_parts(parts: List[Dict[str, Any]]) -> str:
+    """CSV complet (header + lignes de chaque date, dans l'ordre)"""
+    return render_csv_header() + ''.join(part['csv'] for part in parts)
+
+def get_csv_etag(digests: List[str]) -> str:
+    """ETag fort du CSV, dérivé des empreintes des dates qui le composent (dans l'ordre)"""
+    return hashlib.sha1('|'.join(digests).encode('ascii')).hexdigest()
+
+def write_csv_file(path: str, content: str):
+    """
+    Écrit un CSV et sa variante compressée (path.gz, servie par nginx gzip_static) de façon atomique :
+    fichier temporaire propre au thread puis renommage, jamais de fichier à moitié écrit
+    """
+    data = content.encode('utf-8')
+    # Variante gzip d'abord : quand le CSV existe, sa variante aussi
+    for target, payload in ((f"{path}.gz", gzip.compress(data, mtime=0)), (path, data)):
+        temporary = f"{target}.{os.getpid()}-{threading.get_ident()}.tmp"
+        with open(temporary, 'wb') as f:
+            f.write(payload)
+        os.replace(temporary, target)
+
+_csv_files_purged_at = 0.0
+
+def get_csv_file(etag: str, parts: List[Dict[str, Any]]) -> str:
+    """
+    Fichier du CSV d'ETag donné dans FRESHEO_DATA_DIR/csv, écrit une seule fois (le nom dépend du contenu)
+    Retourne le chemin relatif à FRESHEO_DATA_DIR
+    """
+    relative_path = f"csv/{etag}.csv"
+    path = os.path.join(FRESHEO_DATA_DIR, relative_path)
+    try:
+        # Fichier déjà écrit : le garder FRESHEO_CSV_FILES_TTL secondes de plus
+        os.utime(path)
+        os.utime(f"{path}.gz")
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_csv_file(path, join_csv_parts(parts))
+        purge_csv_files()
+    return relative_path
+
+def purge_csv_files():
+    """Supprime les fichiers CSV non demandés depuis FRESHEO_CSV_FILES_TTL secondes (au plus toutes les 5 minutes)"""
+    global _csv_files_purged_at
+    
+    if time.time() - _csv_files_purged_at < 300:
+        return
+    _csv_files_purged_at = time.time()
+    directory = os.path.join(FRESHEO_DATA_DIR, 'csv')
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            if time.time() - os.path.getmtime(path) > FRESHEO_CSV_FILES_TTL:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def accel_redirect_response(relative_path: str, headers: Dict[str, str], mimetype: str = 'text/csv') -> Response:
+    """
+    Réponse vide dont nginx envoie le contenu depuis le fichier (sendfile, variante .gz si acceptée) :
+    le worker est libéré sans attendre la fin du téléchargement
+    """
+    return Response(
+        mimetype=mimetype,
+        headers={**headers, 'X-Accel-Redirect': f"{FRESHEO_ACCEL_REDIRECT.rstrip('/')}/{relative_path}"}
+    )
+
+class IncompleteDateError(Exception):
+    """Date dont une partie des lignes manque ou a des valeurs par défaut (génération en streaming)"""
+
+def iter_delivery_csv(target_dates: List[str], api: FresheoDeliveryAPI, incremental: bool = False,
+                      row_filter: Dict[str, set] = None) -> Iterator[str]:
+    """
+    Génère le CSV morceau par morceau : le header immédiatement, puis les lignes
+    de chaque groupe (shipping_date, shipping_label, shipping_group) dès qu'il est complet
+    Avec row_filter, seules les tournées retenues sont récupérées
+    Une date en erreur ou incomplète (tournée en erreur, total_meals par défaut) avant son premier groupe
+    est remplacée par son snapshot ; sinon la réponse est interrompue (transfert incomplet côté client) :
+    jamais de CSV plus court qui aurait l'air complet
+    """
+    row_filter = row_filter or {}
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=CSV_FIELDNAMES)
+    
+    def flush() -> str:
+        chunk = output.getvalue()
+        output.seek(0)
+        output.truncate()
+        return chunk
+    
+    writer.writeheader()
+    yield flush()
+    
+    def fetch_rounds(date: str) -> List[Dict[str, Any]]:
+        # Génération interrompue à reprendre : la liste des tournées vient du point de reprise
+        if FRESHEO_CHECKPOINT_TTL > 0 and get_snapshot_store().load_checkpoint(date, 'incremental' if incremental else 'full'):
+            return None
+        with BUILD_PHASE_DURATION.labels('list').time():
+            return api.get_delivery_rounds_for_date(date)
+    
+    rows_count = 0
+    serialize_duration = 0.0
+    executor = ThreadPoolExecutor(max_workers=min(len(target_dates), FRESHEO_MAX_PARALLEL_DATES) or 1)
+    try:
+        # Les listes de tournées (appel le plus lent) de toutes les dates sont demandées en parallèle
+        rounds_futures = [executor.submit(fetch_rounds, date) for date in target_dates]
         
-        # 3. Extraire les commandes de cette tournée
-        for order in round_details.get('orders', []):
-            # Récupérer les détails complets de la commande pour total_meals
-            order_details = api.get_order_details(order['id'])
-            total_meals = order_details.get('total_meals', 4)  # Valeur par défaut si non trouvé
-            
-            # Construire l'enregistrement CSV
-            csv_record = {
-                'order_id': order['id'],
-                'shipping_group': round_data['round'],  # Numéro de tournée
-                'shipping_order': order['index'],  # Position dans la tournée
-                'qrcode_data': f"BE_{order['id']}",
-                'total_meals': total_meals,
-                'max_meals': total_meals,  # Égal à total_meals comme suggéré
-                'labels_quantity': calculate_labels_quantity(total_meals),
-                'shipping_date': date,
-                'color': generate_color_code(round_data['round']),
-                'user_lang': 'FR',  # Fixe comme suggéré
-                'cust_name': order['customerName'],  # Disponible directement
-                'shipping_label': get_delivery_planning_name(date, round_data['timeOfDay']),
-                'delivery_status': order['deliveryStatus'] == 'replacement' if order['deliveryStatus'] else False
-            }
-            
-            orders_for_csv.append(csv_record)
+        for date, rounds_future in zip(target_dates, rounds_futures):
+            date_sent = False
+            date_progress = BuildProgress()
+            groups = None
+            try:
+                app.logger.info(f"Traitement de la date (streaming): {date}")
+                groups = iter_order_groups_for_csv(date, api, rounds=rounds_future.result(), progress=date_progress,
+                                                   round_store=get_snapshot_store(), incremental=incremental,
+                                                   round_filter=get_round_filter(row_filter, date))
+                for group_rows in groups:
+                    # Les erreurs d'un groupe sont comptées avant qu'il soit produit
+                    if not date_progress.complete:
+                        raise IncompleteDateError(
+                            f"{date_progress.rounds_failed} tournée(s) en erreur, "
+                            f"{date_progress.orders_defaulted} commande(s) avec total_meals par défaut"
+                        )
+                    serialize_started = time.perf_counter()
+                    writer.writerows(group_rows)
+                    serialize_duration += time.perf_counter() - serialize_started
+                    rows_count += len(group_rows)
+                    date_sent = date_sent or bool(group_rows)
+                    yield flush()
+            except Exception as e:
+                app.logger.warning(f"Erreur pour la date {date}: {e}")
+                # Rien envoyé pour cette date : servir son dernier snapshot s'il existe
+                snapshot = None if date_sent else get_snapshot_store().load_part(date)
+                if snapshot is None:
+                    # Headers déjà envoyés : seule une réponse interrompue signale les lignes manquantes
+                    app.logger.error(f"❌ Streaming interrompu: date {date} incomplète et sans snapshot utilisable")
+                    raise
+                snapshot = filter_csv_part(snapshot, row_filter)
+                app.logger.warning(f"Snapshot du {datetime.fromtimestamp(snapshot['built_at']).isoformat(timespec='seconds')} servi pour la date {date}")
+                rows_count += snapshot['row_count']
+                yield snapshot['csv']
+            finally:
+                if groups is not None:
+                    groups.close()
+    finally:
+        # Client déconnecté : le thread de la requête n'attend pas les listes de tournées encore en cours
+        executor.shutdown(wait=False, cancel_futures=True)
+    
+    BUILD_PHASE_DURATION.labels('serialize').observe(serialize_duration)
+    app.logger.info(f"CSV envoyé en streaming pour {rows_count} commandes")
+
+def get_conditional_headers(digests: List[str]) -> Dict[str, str]:
+    """ETag du CSV ; les postes d'impression revalident à chaque fois (If-None-Match)"""
+    return {
+        'ETag': f'"{get_csv_etag(digests)}"',
+        'Cache-Control': 'no-cache'
+    }
+
+def head_delivery_csv(target_dates: List[str], api: FresheoDeliveryAPI, filename: str,
+                      incremental: bool = False, row_filter: Dict[str, set] = None,
+                      output_format: str = 'csv') -> Optional[Response]:
+    """
+    HEAD /delivery.csv depuis les empreintes des snapshots : ni appel au back-office ni lecture du CSV
+    - 304 si If-None-Match correspond à l'ETag courant, 200 avec le nouvel ETag sinon
+    - snapshots plus vieux que FRESHEO_HEAD_MAX_AGE : actualisation lancée en arrière-plan,
+      un HEAD suivant verra les changements
+    Avec un filtre shipping_label / shipping_group, l'ETag est celui des groupes retenus (découpés via l'index)
+    Retourne None si une date n'a pas de snapshot (la requête est alors traitée comme un GET)
+    """
+    store = get_snapshot_store()
+    if is_sliced(row_filter or {}):
+        parts = [store.load_part(date) for date in target_dates]
+        if any(part is None for part in parts):
+            return None
+        snapshots = {date: (filter_csv_part(part, row_filter)['digest'], part['built_at']) for date, part in zip(target_dates, parts)}
+    else:
+        snapshots = store.digests(target_dates)
+        if len(snapshots) < len(target_dates):
+            return None
     
-    # Trier comme dans la requête SQL
-    orders_for_csv.sort(key=lambda x: (
-        x['shipping_date'],
-        x['shipping_label'],
-        x['shipping_group'],
-        x['shipping_order']
-    ))
+    built_at = min(snapshot_built_at for _, snapshot_built_at in snapshots.values())
+    if time.time() - built_at > FRESHEO_HEAD_MAX_AGE:
+        start_background_refresh(target_dates, api, incremental=incremental)
     
-    return orders_for_csv
+    digests = get_output_digests([snapshots[date][0] for date in target_dates], output_format)
+    headers = {
+        'Content-Disposition': f'attachment; filename={filename}',
+        **get_conditional_headers(digests),
+        **get_data_headers({date: 'snapshot' for date in target_dates}, built_at)
+    }
+    status = 304 if request.if_none_match.contains_weak(get_csv_etag(digests)) else 200
+    return Response(status=status, mimetype=OUTPUT_FORMATS[output_format][0], headers=headers)
+
+def resolve_delivery_request(args) -> Tuple[List[str], str, Dict[str, set], str]:
+    """
+    Paramètres d'une demande /delivery.* : (dates cibles, mode, filtre de lignes, nom du fichier CSV)
+    Filtre sur les dates : seules les dates cibles retenues par shipping_date sont générées
+    Lève ValueError si un paramètre est invalide ou si aucune date ne reste
+    """
+    target_dates, mode_suffix = resolve_target_dates(args)
+    row_filter = parse_row_filter(args)
+    filename = get_csv_filename(target_dates, mode_suffix)
+    
+    if 'shipping_date' in row_filter:
+        target_dates = [date for date in target_dates if date in row_filter['shipping_date']]
+        if not target_dates:
+            raise ValueError('Aucune date cible ne correspond à shipping_date')
+    return target_dates, mode_suffix, row_filter, filename
+
+def load_prepared_parts(target_dates: List[str], max_age: float = FRESHEO_PREWARM_MAX_AGE) -> Tuple[List[Dict[str, Any]], float]:
+    """
+    Parties de CSV préparées à l'avance pour toutes les dates cibles
+    Retourne (parties, built_at du snapshot le plus ancien), ou None si une date manque ou est trop ancienne
+    """
+    store = get_snapshot_store()
+    parts = []
+    
+    for date in target_dates:
+        part = store.load_part(date)
+        if part is None or time.time() - part['built_at'] > max_age:
+            return None
+        parts.append(part)
+    
+    return parts, min((part['built_at'] for part in parts), default=time.time())
+
+def get_prewarm_dates(now: datetime = None) -> List[str]:
+    """
+    Dates à garder préparées : celles demandées aujourd'hui, plus celles du lendemain
+    une fois passée l'heure FRESHEO_PREWARM_AT
+    """
+    now = now or datetime.now()
+    dates = get_target_dates_range(now)
+    
+    if now.time() >= FRESHEO_PREWARM_TIME:
+        for date in get_target_dates_range(now + timedelta(days=1)):
+            if date not in dates:
+                dates.append(date)
+    
+    return dates
+
+def run_prewarm_cycle(api: FresheoDeliveryAPI, now: datetime = None) -> List[str]:
+    """Reconstruit les dates à préparer dont le snapshot manque ou a plus de FRESHEO_PREWARM_INTERVAL secondes"""
+    store = get_snapshot_store()
+    dates = get_prewarm_dates(now)
+    built_at = store.built_at(dates)
+    rebuilt = []
+    
+    for date in dates:
+        if time.time() - built_at.get(date, 0) < FRESHEO_PREWARM_INTERVAL:
+            continue
+        try:
+            started = time.time()
+            progress = BuildProgress()
+            # Seules les tournées nouvelles ou modifiées depuis la préparation précédente sont redemandées
+            rows = extract_orders_for_csv(date, api, progress=progress, round_store=store, incremental=True)
+            if not progress.complete:
+                # Le snapshot précédent reste disponible
+                app.logger.warning(f"Préparation {date} incomplète, snapshot non mis à jour")
+                continue
+            store.save(date, rows, built_at=started)
+            rebuilt.append(date)
+            app.logger.info(f"🔥 Préparation {date}: {len(rows)} commandes en {time.time() - started:.1f}s")
+        except Exception as e:
+            # Le snapshot précédent reste disponible
+            app.logger.warning(f"Erreur de préparation pour la date {date}: {e}")
+    
+    return rebuilt
+
+def _prewarm_loop():
+    """Boucle du planificateur : vérifie chaque minute les dates à préparer"""
+    while True:
+        store = get_snapshot_store()
+        try:
+            api = get_api_client()
+            # Un seul worker gunicorn prépare à la fois
+            if api is not None and store.try_acquire_lease('prewarm', max(FRESHEO_PREWARM_INTERVAL, 600)):
+                try:
+                    run_prewarm_cycle(api)
+                finally:
+                    store.release_lease('prewarm')
+        except Exception as e:
+            app.logger.error(f"Erreur du planificateur de préparation: {e}")
+        time.sleep(60)
+
+_prewarm_thread = None
+
+def start_prewarm_scheduler():
+    """
+    Démarre le planificateur de préparation dans ce processus (une seule fois), si FRESHEO_PREWARM_AT est défini
+    Appelé par le point d'entrée du serveur (gunicorn.conf.py, python app.py), jamais à l'import du module
+    """
+    global _prewarm_thread
+    
+    if FRESHEO_PREWARM_TIME is None:
+        if FRESHEO_PREWARM_AT:
+            app.logger.error(f"❌ FRESHEO_PREWARM_AT invalide: {FRESHEO_PREWARM_AT!r} (attendu HH:MM), préparation planifiée désactivée")
+        return
+    
+    if _prewarm_thread is None or not _prewarm_thread.is_alive():
+        _prewarm_thread = threading.Thread(target=_prewarm_loop, name='prewarm-scheduler', daemon=True)
+        _prewarm_thread.start()
+        app.logger.info(f"🔥 Préparation planifiée activée (lendemain dès {FRESHEO_PREWARM_AT}, rafraîchissement toutes les {FRESHEO_PREWARM_INTERVAL:.0f}s)")
 
 @app.route('/delivery.csv')
 def delivery_csv():
     """
     Endpoint principal qui retourne le CSV des livraisons
     Paramètre optionnel: ?date=yyyy-mm-dd pour spécifier une date de test
+    Paramètres optionnels: ?from=yyyy-mm-dd&to=yyyy-mm-dd pour une plage de dates
+    Paramètre optionnel: ?stream=1 pour recevoir les lignes au fur et à mesure de la génération
+    Paramètre optionnel: ?incremental=1 pour ne redemander que les tournées nouvelles ou modifiées
+    Paramètres optionnels: ?shipping_date=, ?shipping_label=, ?shipping_group= pour ne recevoir qu'une partie
+    des lignes (valeurs séparées par des virgules, plages de tournées 1-5)
+    Paramètre optionnel: ?format=csv.gz|jsonl|jsonl.gz|parquet (ou header Accept) pour un format compact
+    
+    ETag fort dérivé du contenu de chaque date : If-None-Match → 304 sans renvoyer le CSV,
+    HEAD répond depuis les snapshots sans génération (voir head_delivery_csv)
     """
     try:
-        # Configuration API depuis le fichier .env
-        base_url_raw = os.getenv('FRESHEO_BASE_URL', 'https://api.fresheo.be')
-        token = os.getenv('FRESHEO_API_TOKEN', 'your_default_token_here')
+        # Client API partagé (configuration depuis le fichier .env)
+        api = get_api_client()
         
-        # S'assurer que l'URL de base contient /api/bo/v1
-        base_url = base_url_raw.rstrip('/')
-        if not base_url.endswith('/api/bo/v1'):
-            base_url = base_url + '/api/bo/v1'
-        
-        if not token or token == 'your_default_token_here':
+        if api is None:
             return jsonify({'error': 'Token API manquant. Configurer FRESHEO_API_TOKEN dans .env'}), 500
         
-        # Initialiser l'API
-        api = FresheoDeliveryAPI(base_url, token)
-        
         # Vérifier les paramètres de test
-        test_date = request.args.get('date')      # Force une date de livraison spécifique
-        simulate_today = request.args.get('today') # Simule "quel jour on est"
+        try:
+            target_dates, mode_suffix, row_filter, filename = resolve_delivery_request(request.args)
+            output_format = get_output_format(request.args, request.accept_mimetypes)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        if test_date and simulate_today:
-            return jsonify({'error': 'Utiliser soit date= soit today=, pas les deux'}), 400
+        filename = get_output_filename(filename, output_format)
+        mimetype = OUTPUT_FORMATS[output_format][0]
         
-        if test_date:
-            # Mode 1: Date de livraison forcée
-            try:
-                datetime.strptime(test_date, '%Y-%m-%d')
-                target_dates = [test_date]
-                app.logger.info(f"🎯 Mode date forcée: livraisons pour {test_date}")
-            except ValueError:
-                return jsonify({'error': 'Format de date invalide. Utiliser yyyy-mm-dd'}), 400
-                
-        elif simulate_today:
-            # Mode 2: Simulation du jour actuel + logique SQL
-            try:
-                simulated_today_dt = datetime.strptime(simulate_today, '%Y-%m-%d')
-                target_dates = get_target_dates_range(simulated_today_dt)
-                day_names = ['lundi', 'mardi', 'mercredi', 'jeudi', 'vendredi', 'samedi', 'dimanche']
-                day_name = day_names[simulated_today_dt.weekday()]
-                app.logger.info(f"🧪 Mode simulation: comme si on était {day_name} {simulate_today}")
-                app.logger.info(f"📅 → Livraisons pour: {target_dates}")
-            except ValueError:
-                return jsonify({'error': 'Format de date invalide pour today. Utiliser yyyy-mm-dd'}), 400
-                
+        # Mode incrémental : seules les tournées nouvelles ou modifiées sont redemandées au back-office
+        incremental = get_bool_arg(request.args, 'incremental')
+        
+        # HEAD : dire si quelque chose a changé sans générer le CSV
+        if request.method == 'HEAD' and not get_bool_arg(request.args, 'stream'):
+            response = head_delivery_csv(target_dates, api, filename, incremental=incremental, row_filter=row_filter,
+                                         output_format=output_format)
+            if response is not None:
+                return response
+        
+        # En mode automatique, utiliser les données préparées par le planificateur si elles sont récentes
+        prepared = load_prepared_parts(target_dates) if FRESHEO_PREWARM_TIME and mode_suffix == "_auto" else None
+        
+        if prepared:
+            parts, built_at = prepared
+            parts = [filter_csv_part(part, row_filter) for part in parts]
+            sources = {date: 'prepared' for date in target_dates}
+        elif get_bool_arg(request.args, 'stream'):
+            # Mode streaming : rien n'est gardé en mémoire au-delà du groupe en cours
+            body = iter_delivery_csv(target_dates, api, incremental=incremental, row_filter=row_filter)
+            if output_format != 'csv':
+                body = iter_output(output_format, itertools.islice(body, 1, None))
+            return Response(
+                stream_with_context(body),
+                mimetype=mimetype,
+                headers={
+                    'Content-Disposition': f'attachment; filename={filename}',
+                    'X-Data-Source': 'live',
+                    'X-Accel-Buffering': 'no'
+                }
+            )
         else:
-            # Mode 3: Logique SQL normale (vraie date actuelle)
-            target_dates = get_target_dates_range()
-            real_today = datetime.now().strftime('%Y-%m-%d')
-            day_names = ['lundi', 'mardi', 'mercredi', 'jeudi', 'vendredi', 'samedi', 'dimanche']
-            day_name = day_names[datetime.now().weekday()]
-            app.logger.info(f"📅 Mode automatique: vraiment {day_name} {real_today}")
-            app.logger.info(f"📅 → Livraisons pour: {target_dates}")
-        
-        all_orders_for_csv = []
-        
-        # Pour chaque date cible, récupérer les commandes
-        for date in target_dates:
-            try:
-                app.logger.info(f"Traitement de la date: {date}")
-                orders_for_date = extract_orders_for_csv(date, api)
-                all_orders_for_csv.extend(orders_for_date)
-            except Exception as e:
-                app.logger.warning(f"Erreur pour la date {date}: {e}")
-                continue
+            # Génération live, ou derniers snapshots si le back-office est lent ou en erreur
+            # Avec un filtre : index des snapshots récents, sinon seules les tournées retenues sont générées
+            parts, sources, built_at = get_delivery_parts(target_dates, api, incremental=incremental, row_filter=row_filter)
         
-        app.logger.info(f"Génération du CSV pour {len(all_orders_for_csv)} commandes")
+        digests = get_output_digests([part['digest'] for part in parts], output_format)
+        headers = {
+            'Content-Disposition': f'attachment; filename={filename}',
+            **get_conditional_headers(digests),
+            **get_data_headers(sources, built_at)
+        }
+        if 'format' not in request.args:
+            # Format choisi selon le header Accept
+            headers['Vary'] = 'Accept'
         
-        # Générer le CSV
-        output = io.StringIO()
-        fieldnames = [
-            'order_id', 'shipping_group', 'shipping_order', 'qrcode_data',
-            'total_meals', 'max_meals', 'labels_quantity', 'shipping_date',
-            'color', 'user_lang', 'cust_name', 'shipping_label', 'delivery_status'
-        ]
+        # Contenu identique à celui du client : ni assemblage ni envoi du CSV
+        if request.if_none_match.contains_weak(get_csv_etag(digests)):
+            app.logger.info(f"CSV inchangé ({headers['X-Data-Source']}), 304")
+            return Response(status=304, headers=headers)
         
-        writer = csv.DictWriter(output, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(all_orders_for_csv)
+        app.logger.info(f"Génération du CSV pour {sum(part['row_count'] for part in parts)} commandes "
+                        f"({headers['X-Data-Source']}, {output_format})")
         
-        # Retourner la réponse CSV
-        filename_dates = "_".join(target_dates)
+        # Derrière nginx : le fichier (écrit une fois par contenu, avec sa variante .gz) est envoyé par nginx
+        if FRESHEO_ACCEL_REDIRECT and output_format in ('csv', 'csv.gz'):
+            relative_path = get_csv_file(get_csv_etag([part['digest'] for part in parts]), parts)
+            if output_format == 'csv.gz':
+                relative_path += '.gz'
+            return accel_redirect_response(relative_path, headers, mimetype)
         
-        # Suffix selon le mode utilisé
-        if test_date:
-            mode_suffix = "_date_forced"
-        elif simulate_today:
-            mode_suffix = f"_simulated_{simulate_today}"
-        else:
-            mode_suffix = "_auto"
-            
+        if output_format != 'csv':
+            # Formats compacts : écrits au fil des dates, sans assembler le CSV complet
+            return Response(
+                stream_with_context(iter_output(output_format, (part['csv'] for part in parts))),
+                mimetype=mimetype,
+                headers=headers
+            )
+        
+        # Retourner la réponse CSV
         response = Response(
-            output.getvalue(),
+            join_csv_parts(parts),
             mimetype='text/csv',
-            headers={
-                'Content-Disposition': f'attachment; filename=delivery_labels_{filename_dates}{mode_suffix}.csv'
-            }
+            headers=headers
         )
         
         return response
@@ -303,6 +1334,321 @@ def delivery_csv():
         app.logger.error(f"Erreur lors de la génération du CSV: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/delivery.<any(zpl, pdf):label_format>')
+def delivery_labels(label_format):
+    """
+    Étiquettes prêtes à imprimer, générées à partir des mêmes lignes que /delivery.csv
+    (mêmes paramètres : date, today, from/to, incremental, filtres) : labels_quantity étiquettes par commande
+    - /delivery.zpl : imprimantes thermiques Zebra (QR code dessiné par l'imprimante)
+    - /delivery.pdf : une page par étiquette, QR codes calculés par le pool de processus (get_label_pool)
+    Envoyées lot par lot dès que les lignes sont prêtes
+    """
+    try:
+        api = get_api_client()
+        
+        if api is None:
+            return jsonify({'error': 'Token API manquant. Configurer FRESHEO_API_TOKEN dans .env'}), 500
+        
+        try:
+            target_dates, mode_suffix, row_filter, filename = resolve_delivery_request(request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        prepared = load_prepared_parts(target_dates) if FRESHEO_PREWARM_TIME and mode_suffix == "_auto" else None
+        if prepared:
+            parts, built_at = prepared
+            parts = [filter_csv_part(part, row_filter) for part in parts]
+            sources = {date: 'prepared' for date in target_dates}
+        else:
+            parts, sources, built_at = get_delivery_parts(
+                target_dates, api, incremental=get_bool_arg(request.args, 'incremental'), row_filter=row_filter
+            )
+        
+        # ETag : contenu des lignes et format des étiquettes
+        if label_format == 'zpl':
+            label_key = f"zpl:{FRESHEO_LABEL_WIDTH_MM}x{FRESHEO_LABEL_HEIGHT_MM}@{FRESHEO_ZPL_DPI}"
+        else:
+            label_key = f"pdf:{FRESHEO_LABEL_WIDTH_MM}x{FRESHEO_LABEL_HEIGHT_MM}"
+        digests = [part['digest'] for part in parts] + [label_key]
+        headers = {
+            'Content-Disposition': f"attachment; filename={filename.rsplit('.', 1)[0]}.{label_format}",
+            **get_conditional_headers(digests),
+            **get_data_headers(sources, built_at),
+            'X-Accel-Buffering': 'no'
+        }
+        
+        if request.if_none_match.contains_weak(get_csv_etag(digests)):
+            return Response(status=304, headers=headers)
+        
+        app.logger.info(f"🖨️ Étiquettes {label_format.upper()} pour {sum(part['row_count'] for part in parts)} commandes ({headers['X-Data-Source']})")
+        
+        rows = iter_part_rows(parts)
+        if label_format == 'zpl':
+            body = label_printing.iter_zpl(rows, FRESHEO_LABEL_WIDTH_MM, FRESHEO_LABEL_HEIGHT_MM, FRESHEO_ZPL_DPI,
+                                           batch_size=FRESHEO_LABEL_BATCH)
+            mimetype = 'application/zpl'
+        else:
+            body = label_printing.iter_pdf(rows, FRESHEO_LABEL_WIDTH_MM, FRESHEO_LABEL_HEIGHT_MM,
+                                           executor=get_label_pool(), batch_size=FRESHEO_LABEL_BATCH,
+                                           prefetch=2 * max(1, FRESHEO_LABEL_PROCESSES))
+            mimetype = 'application/pdf'
+        
+        return Response(stream_with_context(body), mimetype=mimetype, headers=headers)
+        
+    except Exception as e:
+        app.logger.error(f"Erreur lors de la génération des étiquettes {label_format}: {e}")
+        return jsonify({'error': str(e)}), 500
+
+def run_delivery_job(job_id: str, target_dates: List[str], api: FresheoDeliveryAPI, incremental: bool = False):
+    """Génère le CSV d'un job en arrière-plan et publie l'avancement dans le stockage des jobs"""
+    store = get_job_store()
+    store.update(job_id, status='running', started_at=time.time())
+    
+    # Publier l'avancement au plus une fois par seconde
+    last_update = [0.0]
+    
+    def publish_progress(progress: BuildProgress):
+        now = time.time()
+        if now - last_update[0] >= 1:
+            last_update[0] = now
+            store.update(job_id, **progress.as_dict())
+    
+    progress = BuildProgress(on_change=publish_progress)
+    
+    try:
+        parts, sources, _ = assemble_delivery_parts(
+            target_dates, build_delivery_dates_coalesced(target_dates, api, progress=progress, incremental=incremental)
+        )
+        rows = sum(part['row_count'] for part in parts)
+        
+        # Écriture atomique du résultat (et de sa variante gzip)
+        write_csv_file(store.result_path(job_id), join_csv_parts(parts))
+        
+        store.update(job_id, status='done', finished_at=time.time(), rows=rows,
+                     date_sources=json.dumps(sources), **progress.as_dict())
+        app.logger.info(f"Job {job_id} terminé: {rows} commandes")
+    except Exception as e:
+        app.logger.error(f"Erreur du job {job_id}: {e}")
+        store.update(job_id, status='failed', finished_at=time.time(), error=str(e), **progress.as_dict())
+
+def format_job(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Représentation JSON de l'état d'un job"""
+    def iso(timestamp):
+        return datetime.fromtimestamp(timestamp).isoformat() if timestamp else None
+    
+    return {
+        'job_id': job['id'],
+        'status': job['status'],
+        'target_dates': job['target_dates'],
+        'progress': {
+            'rounds_done': job['rounds_done'],
+            'rounds_total': job['rounds_total'],
+            'rounds_failed': job['rounds_failed'],
+            'orders_fetched': job['orders_fetched'],
+            'orders_total': job['orders_total'],
+            'orders_defaulted': job['orders_defaulted']
+        },
+        'rows': job['rows'],
+        'date_sources': job['date_sources'],
+        'error': job['error'],
+        'created_at': iso(job['created_at']),
+        'started_at': iso(job['started_at']),
+        'finished_at': iso(job['finished_at']),
+        'status_url': f"/jobs/{job['id']}",
+        'result_url': f"/jobs/{job['id']}/result"
+    }
+
+@app.route('/jobs/delivery', methods=['POST'])
+def create_delivery_job():
+    """
+    Lance la génération du CSV en arrière-plan et retourne immédiatement 202 + l'id du job
+    Mêmes paramètres que /delivery.csv (date=, today=, from=/to=, incremental=)
+    """
+    try:
+        api = get_api_client()
+        
+        if api is None:
+            return jsonify({'error': 'Token API manquant. Configurer FRESHEO_API_TOKEN dans .env'}), 500
+        
+        try:
+            target_dates, mode_suffix = resolve_target_dates(request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        store = get_job_store()
+        store.purge_expired()
+        job_id = store.create(target_dates, get_csv_filename(target_dates, mode_suffix))
+        get_job_executor().submit(run_delivery_job, job_id, target_dates, api, get_bool_arg(request.args, 'incremental'))
+        
+        app.logger.info(f"Job {job_id} créé pour {target_dates}")
+        
+        return jsonify(format_job(store.get(job_id))), 202, {'Location': f"/jobs/{job_id}"}
+        
+    except Exception as e:
+        app.logger.error(f"Erreur lors de la création du job: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/jobs/<job_id>')
+def get_delivery_job(job_id):
+    """Avancement d'un job : tournées traitées et commandes récupérées sur le total"""
+    job = get_job_store().get(job_id)
+    
+    if job is None:
+        return jsonify({'error': f'Job {job_id} inconnu ou expiré'}), 404
+    
+    return jsonify(format_job(job))
+
+@app.route('/jobs/<job_id>/result')
+def get_delivery_job_result(job_id):
+    """CSV produit par un job terminé (202 tant qu'il est en cours)"""
+    store = get_job_store()
+    job = store.get(job_id)
+    
+    if job is None:
+        return jsonify({'error': f'Job {job_id} inconnu ou expiré'}), 404
+    
+    if job['status'] in DeliveryJobStore.ACTIVE_STATUSES:
+        return jsonify(format_job(job)), 202, {'Retry-After': '5'}
+    
+    if job['status'] == 'failed':
+        return jsonify(format_job(job)), 500
+    
+    result_path = store.result_path(job_id)
+    gone = jsonify({'error': f'Résultat du job {job_id} supprimé, relancer la génération'}), 410
+    
+    # Derrière nginx : le fichier est envoyé par nginx
+    if FRESHEO_ACCEL_REDIRECT:
+        if not os.path.exists(result_path):
+            return gone
+        return accel_redirect_response(
+            os.path.relpath(result_path, FRESHEO_DATA_DIR),
+            {'Content-Disposition': f"attachment; filename={job['filename']}"}
+        )
+    
+    try:
+        with open(result_path, 'rb') as f:
+            content = f.read()
+    except FileNotFoundError:
+        app.logger.warning(f"Job {job_id}: fichier résultat introuvable ({result_path})")
+        return gone
+    
+    return Response(
+        content,
+        mimetype='text/csv',
+        headers={
+            'Content-Disposition': f"attachment; filename={job['filename']}"
+        }
+    )
+
+def get_prewarm_status() -> Dict[str, Any]:
+    """État de la préparation planifiée : dates préparées et âge de leurs données"""
+    if FRESHEO_PREWARM_TIME is None:
+        if FRESHEO_PREWARM_AT:
+            return {'enabled': False, 'error': f"FRESHEO_PREWARM_AT invalide: {FRESHEO_PREWARM_AT!r} (attendu HH:MM)"}
+        return {'enabled': False}
+    
+    dates = get_prewarm_dates()
+    built_at = get_snapshot_store().built_at(dates)
+    return {
+        'enabled': True,
+        'prewarm_at': FRESHEO_PREWARM_AT,
+        'interval_seconds': FRESHEO_PREWARM_INTERVAL,
+        'dates': {
+            date: {
+                'built_at': datetime.fromtimestamp(built_at[date]).isoformat(timespec='seconds'),
+                'age_seconds': int(time.time() - built_at[date])
+            } if date in built_at else None
+            for date in dates
+        }
+    }
+
+def parse_invalidation(data: Any) -> Tuple[List[int], List[int], List[str], bool]:
+    """Valide le corps de POST /invalidate, retourne (order_ids, round_ids, dates, rebuild) ou lève ValueError"""
+    if not isinstance(data, dict):
+        raise ValueError('Corps JSON attendu: {"order_ids": [...], "round_ids": [...], "dates": ["yyyy-mm-dd"]}')
+    
+    def parse_ids(name: str) -> List[int]:
+        values = data.get(name) or []
+        if not isinstance(values, list):
+            raise ValueError(f"{name} doit être une liste")
+        ids = []
+        for value in values:
+            # Identifiants entiers, ou chaînes de chiffres
+            if isinstance(value, bool) or not (isinstance(value, int) or (isinstance(value, str) and value.isdigit())):
+                raise ValueError(f"Identifiant invalide dans {name}: {value!r}")
+            ids.append(int(value))
+        return list(dict.fromkeys(ids))
+    
+    order_ids, round_ids = parse_ids('order_ids'), parse_ids('round_ids')
+    dates = data.get('dates') or []
+    if not isinstance(dates, list):
+        raise ValueError("dates doit être une liste")
+    for date in dates:
+        try:
+            datetime.strptime(date, '%Y-%m-%d')
+        except (TypeError, ValueError):
+            raise ValueError(f"Format de date invalide: {date!r} (attendu yyyy-mm-dd)")
+    dates = list(dict.fromkeys(dates))
+    
+    total = len(order_ids) + len(round_ids) + len(dates)
+    if total == 0:
+        raise ValueError("Rien à invalider : order_ids, round_ids et dates sont vides")
+    if total > FRESHEO_INVALIDATE_MAX_IDS:
+        raise ValueError(f"Trop d'identifiants ({total}, max {FRESHEO_INVALIDATE_MAX_IDS}) : découper en plusieurs appels")
+    return order_ids, round_ids, dates, bool(data.get('rebuild', False))
+
+@app.route('/invalidate', methods=['POST'])
+def invalidate_caches():
+    """
+    Notification de modification par le back-office : {"order_ids": [...], "round_ids": [...], "dates": [...], "rebuild": true}
+    Évince exactement les détails de commandes, les lignes de tournées et les snapshots concernés
+    (les autres tournées restent réutilisables par une génération incremental)
+    Avec rebuild, seules les dates concernées sont régénérées en arrière-plan (incremental)
+    """
+    if not FRESHEO_INVALIDATE_TOKEN:
+        return jsonify({'error': 'Invalidation désactivée. Configurer FRESHEO_INVALIDATE_TOKEN dans .env'}), 404
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme != 'Bearer' or not hmac.compare_digest(token.encode(), FRESHEO_INVALIDATE_TOKEN.encode()):
+        return jsonify({'error': 'Token invalide'}), 401, {'WWW-Authenticate': 'Bearer'}
+    
+    try:
+        order_ids, round_ids, dates, rebuild = parse_invalidation(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    try:
+        evicted_orders = get_order_cache().invalidate(order_ids)
+        evicted = get_snapshot_store().invalidate(order_ids, round_ids, dates)
+    except sqlite3.Error as e:
+        app.logger.error(f"Erreur lors de l'invalidation: {e}")
+        return jsonify({'error': str(e)}), 500
+    
+    CACHE_INVALIDATIONS.labels(kind='orders').inc(evicted_orders)
+    CACHE_INVALIDATIONS.labels(kind='rounds').inc(len(evicted['rounds']))
+    CACHE_INVALIDATIONS.labels(kind='snapshots').inc(len(evicted['snapshots']))
+    
+    rebuild_dates = evicted['dates'] if rebuild else []
+    if rebuild_dates:
+        api = get_api_client()
+        if api is None:
+            return jsonify({'error': 'Token API manquant. Configurer FRESHEO_API_TOKEN dans .env'}), 500
+        # Pas de regroupement avec une génération en cours : elle a commencé avant l'invalidation
+        get_refresh_executor().submit(build_delivery_dates, rebuild_dates, api, incremental=True)
+    
+    app.logger.info(
+        f"🧹 Invalidation: {evicted_orders} commande(s), {len(evicted['rounds'])} tournée(s), "
+        f"snapshots {evicted['snapshots'] or 'aucun'}" + (f", régénération de {rebuild_dates}" if rebuild_dates else '')
+    )
+    
+    return jsonify({
+        'orders_evicted': evicted_orders,
+        'rounds_evicted': evicted['rounds'],
+        'unknown_rounds': evicted['unknown_rounds'],
+        'dates': evicted['dates'],
+        'snapshots_evicted': evicted['snapshots'],
+        'rebuild_dates': rebuild_dates
+    })
+
 @app.route('/health')
 def health_check():
     """Endpoint de vérification de santé"""
@@ -316,39 +1662,126 @@ def health_check():
             'friday': get_target_dates_range(datetime(2025, 8, 1)),   # vendredi → samedi
             'saturday': get_target_dates_range(datetime(2025, 8, 2)), # samedi → dim+lun+mar 
             'monday': get_target_dates_range(datetime(2025, 8, 4))    # lundi → lundi
-        }
+        },
+        'order_cache': get_order_cache().stats(),
+        'upstream_limiter': get_upstream_limiter().stats(),
+        'prewarm': get_prewarm_status()
     })
 
+@app.route('/metrics')
+def metrics():
+    """Métriques Prometheus (latences back-office, phases de génération, lignes, valeurs par défaut)"""
+    registry = REGISTRY
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        # Plusieurs workers gunicorn : agréger les fichiers de métriques de chaque process
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+def is_profile_token(token: str) -> bool:
+    return bool(FRESHEO_PROFILE_TOKEN) and token is not None and hmac.compare_digest(
+        token.encode(), FRESHEO_PROFILE_TOKEN.encode()
+    )
+
+@app.before_request
+def start_request_profile():
+    """Profilage de /delivery.csv, /delivery.zpl, /delivery.pdf et /test/* quand le header X-Fresheo-Profile porte le token"""
+    token = request.headers.get('X-Fresheo-Profile')
+    if token is None or not (request.path in ('/delivery.csv', '/delivery.zpl', '/delivery.pdf') or request.path.startswith('/test/')):
+        return
+    if not is_profile_token(token):
+        app.logger.warning(f"⚠️ Profilage refusé pour {request.path} (token invalide ou FRESHEO_PROFILE_TOKEN non configuré)")
+        return
+    g.profile = RequestProfile(request.method, request.full_path.rstrip('?'))
+    g.profile.start()
+
+@app.after_request
+def finish_request_profile(response):
+    """Le profil se termine à la fermeture de la réponse (CSV en streaming compris)"""
+    profile = g.pop('profile', None)
+    if profile is None:
+        return response
+    
+    status_code = response.status_code
+    
+    def finish():
+        profile.stop()
+        try:
+            summary = profile.summary(status_code)
+            save_profile(summary)
+            app.logger.info(f"🔬 Profil {profile.id}: {profile.path} en {summary['duration']}s, "
+                            f"{summary['upstream']['calls']} appels au back-office")
+        except OSError as e:
+            app.logger.error(f"Impossible d'enregistrer le profil {profile.id}: {e}")
+    
+    response.call_on_close(finish)
+    response.headers['X-Profile-Id'] = profile.id
+    return response
+
+@app.route('/debug/profiles')
+def list_profiles():
+    """Profils enregistrés, du plus récent au plus ancien"""
+    if not is_profile_token(request.headers.get('X-Fresheo-Profile')):
+        return jsonify({'error': 'Header X-Fresheo-Profile manquant ou invalide'}), 403
+    
+    profiles = []
+    directory = get_profiles_dir()
+    for name in (os.listdir(directory) if os.path.isdir(directory) else []):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                profile = json.load(f)
+        except (OSError, ValueError):
+            continue
+        profiles.append({key: profile[key] for key in ('id', 'method', 'path', 'status', 'started_at', 'duration')})
+    
+    profiles.sort(key=lambda profile: profile['started_at'], reverse=True)
+    return jsonify({'profiles': profiles})
+
+@app.route('/debug/profiles/<profile_id>')
+def get_profile(profile_id):
+    """
+    Profil d'une requête (id du header X-Profile-Id)
+    format=folded : piles échantillonnées au format "pile repliée" (flamegraph.pl, speedscope)
+    """
+    if not is_profile_token(request.headers.get('X-Fresheo-Profile')):
+        return jsonify({'error': 'Header X-Fresheo-Profile manquant ou invalide'}), 403
+    
+    path = os.path.join(get_profiles_dir(), f"{profile_id}.json")
+    if not re.fullmatch(r'[0-9a-f]{32}', profile_id) or not os.path.exists(path):
+        return jsonify({'error': f'Profil {profile_id} inconnu ou expiré'}), 404
+    
+    with open(path) as f:
+        content = f.read()
+    
+    if request.args.get('format') == 'folded':
+        stacks = json.loads(content)['sampling']['stacks']
+        return Response(''.join(f"{stack} {count}\n" for stack, count in stacks.items()), mimetype='text/plain')
+    
+    return Response(content, mimetype='application/json')
+
 @app.route('/test/order/<int:order_id>')
 def test_order(order_id):
     """Endpoint de test pour récupérer une commande spécifique"""
     try:
-        # Configuration API depuis le fichier .env
-        base_url_raw = os.getenv('FRESHEO_BASE_URL', 'https://api.fresheo.be')
-        token = os.getenv('FRESHEO_API_TOKEN', 'your_default_token_here')
-        
-        # S'assurer que l'URL de base contient /api/bo/v1
-        base_url = base_url_raw.rstrip('/')
-        if not base_url.endswith('/api/bo/v1'):
-            base_url = base_url + '/api/bo/v1'
+        # Client API partagé (configuration depuis le fichier .env)
+        api = get_api_client()
         
-        if not token or token == 'your_default_token_here':
+        if api is None:
             return jsonify({'error': 'Token API manquant. Configurer FRESHEO_API_TOKEN dans .env'}), 500
         
-        # Initialiser l'API
-        api = FresheoDeliveryAPI(base_url, token)
-        
         app.logger.info(f"Test récupération commande {order_id}")
         
-        # Récupérer les détails de la commande
-        order_details = api.get_order_details(order_id)
+        # Récupérer les détails de la commande (toujours depuis l'API, sans cache)
+        order_details = api.get_order_details(order_id, use_cache=False, fields=None)
         
         if not order_details:
             return jsonify({'error': f'Commande {order_id} non trouvée ou inaccessible'}), 404
         
         return jsonify({
             'order_id': order_id,
-            'url_called': f"{base_url}/get-order/{order_id}/delivery",
+            'url_called': f"{api.base_url}/get-order/{order_id}/delivery",
             'data': order_details,
             'timestamp': datetime.now().isoformat()
         })
@@ -388,7 +1821,7 @@ def test_rounds():
         
         try:
             # Timeout long pour les tests - peut prendre plusieurs minutes
-            response = requests.get(url, headers=headers, params=params, timeout=600)
+            response = get_http_session().get(url, headers=headers, params=params, timeout=ENDPOINT_TIMEOUTS['rounds'])
             app.logger.info(f"Response status: {response.status_code}")
             app.logger.info(f"Response headers: {dict(response.headers)}")
             
@@ -435,21 +1868,12 @@ def test_rounds():
 def test_round_details(round_id):
     """Endpoint de test pour récupérer les détails d'une tournée spécifique"""
     try:
-        # Configuration API depuis le fichier .env
-        base_url_raw = os.getenv('FRESHEO_BASE_URL', 'https://api.fresheo.be')
-        token = os.getenv('FRESHEO_API_TOKEN', 'your_default_token_here')
+        # Client API partagé (configuration depuis le fichier .env)
+        api = get_api_client()
         
-        # S'assurer que l'URL de base contient /api/bo/v1
-        base_url = base_url_raw.rstrip('/')
-        if not base_url.endswith('/api/bo/v1'):
-            base_url = base_url + '/api/bo/v1'
-        
-        if not token or token == 'your_default_token_here':
+        if api is None:
             return jsonify({'error': 'Token API manquant. Configurer FRESHEO_API_TOKEN dans .env'}), 500
         
-        # Initialiser l'API
-        api = FresheoDeliveryAPI(base_url, token)
-        
         app.logger.info(f"Test récupération détails tournée {round_id}")
         
         # Récupérer les détails de la tournée
@@ -460,7 +1884,7 @@ def test_round_details(round_id):
         
         return jsonify({
             'round_id': round_id,
-            'url_called': f"{base_url}/rounds/delivery/{round_id}",
+            'url_called': f"{api.base_url}/rounds/delivery/{round_id}",
             'orders_count': len(round_details.get('orders', [])),
             'data': round_details,
             'timestamp': datetime.now().isoformat()
@@ -478,7 +1902,11 @@ def index():
     <h2>✨ Endpoints principaux :</h2>
     <ul>
         <li><a href="/delivery.csv"><strong>/delivery.csv</strong></a> - 📅 <strong>CSV automatique</strong> (logique SQL réelle)</li>
+        <li><a href="/delivery.zpl">/delivery.zpl</a> / <a href="/delivery.pdf">/delivery.pdf</a> - 🖨️ Étiquettes prêtes à imprimer (mêmes paramètres que le CSV)</li>
         <li><a href="/health">/health</a> - ❤️ Vérification de santé</li>
+        <li><a href="/metrics">/metrics</a> - 📊 Métriques Prometheus</li>
+        <li><code>POST /jobs/delivery</code> - ⏳ Génération du CSV en arrière-plan, suivi via <code>/jobs/[ID]</code> et <code>/jobs/[ID]/result</code></li>
+        <li><code>POST /invalidate</code> - 🧹 Invalidation ciblée des caches par le back-office (commandes, tournées, dates)</li>
     </ul>
     
     <h2>🧪 Modes de test :</h2>
@@ -498,6 +1926,12 @@ def index():
         <li><a href="/delivery.csv?date=2025-08-10"><code>/delivery.csv?date=2025-08-10</code></a> - Étiquettes du 10 août uniquement</li>
     </ul>
     
+    <h3>🎯 Mode 3: Plage de dates</h3>
+    <p><strong>Paramètres:</strong> <code>from=yyyy-mm-dd&amp;to=yyyy-mm-dd</code> - Étiquettes de toutes les dates de la plage (réimpressions)</p>
+    <ul>
+        <li><a href="/delivery.csv?from=2025-08-04&to=2025-08-10"><code>/delivery.csv?from=2025-08-04&amp;to=2025-08-10</code></a> - Étiquettes de la semaine du 4 août</li>
+    </ul>
+    
     <h2>🔬 Logique SQL :</h2>
     <div style="background: #f5f5f5; padding: 10px; border-left: 4px solid #007acc;">
     <strong>Vendredi</strong> → Étiquettes du samedi<br/>
@@ -533,4 +1967,8 @@ if __name__ == '__main__':
     port = int(os.getenv('PORT', 5001))
     debug = os.getenv('DEBUG', 'False').lower() in ['true', '1', 'yes']
     
+    # Préparation planifiée : pas dans le processus de surveillance du reloader (mode debug)
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_prewarm_scheduler()
+    
     app.run(host='0.0.0.0', port=port, debug=debug) 
\ No newline at end of file
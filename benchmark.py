@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Mesures de performance de la génération du CSV, contre le faux back-office local
+
+Lance fake_backoffice.py dans le même processus, puis mesure pour chaque scénario :
+- le temps total (min / médiane / max sur --repeat exécutions)
+- le nombre d'appels au back-office par endpoint (et par code HTTP)
+- le pic mémoire Python (tracemalloc, mesuré sur une exécution supplémentaire)
+
+Scénarios :
+- extract : extract_orders_for_csv() date par date (pipeline de récupération seul)
+- http    : GET /delivery.csv (génération complète, dates en parallèle, rendu CSV)
+- stream  : GET /delivery.csv?stream=1
+
+Usage :
+    python benchmark.py --rounds 40 --orders 25 --latency order_details=lognormal:0.05:0.5 --repeat 3
+    python benchmark.py --scenario http --dates 2025-08-03,2025-08-05 --json resultats.json
+"""
+
+import argparse
+import gc
+import json
+import logging
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Any, Callable, Dict, List
+
+from fake_backoffice import add_backoffice_arguments, backoffice_from_arguments, start_fake_backoffice
+
+SCENARIOS = ('extract', 'http', 'stream')
+
+def delivery_csv_query(dates: List[str], stream: bool) -> str:
+    """Paramètres de /delivery.csv pour les dates demandées"""
+    query = f"date={dates[0]}" if len(dates) == 1 else f"from={dates[0]}&to={dates[-1]}"
+    return query + ('&stream=1' if stream else '')
+
+def make_scenario(name: str, app_module, base_url: str, dates: List[str], max_workers: int) -> Callable[[], int]:
+    """Retourne une fonction qui exécute le scénario et renvoie le nombre de lignes produites"""
+    if name == 'extract':
+        api = app_module.FresheoDeliveryAPI(base_url, 'benchmark', cache=app_module.get_order_cache())
+
+        def run() -> int:
+            return sum(len(app_module.extract_orders_for_csv(date, api, max_workers=max_workers)) for date in dates)
+        return run
+
+    client = app_module.app.test_client()
+    url = f"/delivery.csv?{delivery_csv_query(dates, stream=(name == 'stream'))}"
+
+    def run() -> int:
+        response = client.get(url)
+        if response.status_code != 200:
+            raise RuntimeError(f"{url} → {response.status_code}: {response.get_data(as_text=True)[:200]}")
+        # Lignes hors header
+        return response.get_data().count(b'\n') - 1
+    return run
+
+def measure(run: Callable[[], int], backoffice, app_module, repeat: int, warm_cache: bool) -> Dict[str, Any]:
+    """Exécute un scénario repeat fois et agrège les mesures"""
+    durations = []
+    rows = None
+    upstream_calls = None
+
+    def prepare():
+        if not warm_cache:
+            app_module.get_order_cache().clear()
+        backoffice.reset_counts()
+        gc.collect()
+
+    for _ in range(repeat):
+        prepare()
+        started = time.perf_counter()
+        rows = run()
+        durations.append(time.perf_counter() - started)
+        upstream_calls = backoffice.counts()
+
+    # Pic mémoire sur une exécution à part (tracemalloc ralentit l'exécution)
+    prepare()
+    tracemalloc.start()
+    try:
+        run()
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'rows': rows,
+        'wall_time': {
+            'min': min(durations),
+            'median': statistics.median(durations),
+            'max': max(durations),
+            'runs': durations
+        },
+        'upstream_calls': upstream_calls,
+        'upstream_calls_total': sum(sum(by_status.values()) for by_status in upstream_calls.values()),
+        'peak_memory_bytes': peak_memory
+    }
+
+def print_result(name: str, result: Dict[str, Any]):
+    wall_time = result['wall_time']
+    print(f"▶️  {name}")
+    print(f"   ⏱️  Temps: min {wall_time['min']:.3f}s | médiane {wall_time['median']:.3f}s | max {wall_time['max']:.3f}s")
+    print(f"   📊 Lignes: {result['rows']}")
+    calls = ', '.join(
+        f"{endpoint} {'/'.join(f'{status}:{count}' for status, count in sorted(by_status.items()))}"
+        for endpoint, by_status in sorted(result['upstream_calls'].items())
+    )
+    print(f"   🌐 Appels back-office: {result['upstream_calls_total']} ({calls})")
+    print(f"   🧠 Pic mémoire Python: {result['peak_memory_bytes'] / 1024 / 1024:.1f} Mo")
+
+def main():
+    """Point d'entrée principal"""
+    parser = argparse.ArgumentParser(description="Mesures de performance de la génération du CSV d'étiquettes")
+    add_backoffice_arguments(parser)
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help="Scénario à mesurer (répétable, défaut: tous)")
+    parser.add_argument('--dates', default='2025-08-05',
+                        help="Dates de livraison, séparées par des virgules et consécutives pour http/stream (défaut: 2025-08-05)")
+    parser.add_argument('--repeat', type=int, default=3, help="Exécutions par scénario (défaut: 3)")
+    parser.add_argument('--max-workers', type=int, default=None, help="max_workers du scénario extract (défaut: FRESHEO_MAX_WORKERS)")
+    parser.add_argument('--warm-cache', action='store_true', help="Garder le cache des commandes entre les exécutions")
+    parser.add_argument('--json', metavar='FICHIER', help="Écrire les résultats en JSON (comparaison entre versions)")
+    args = parser.parse_args()
+
+    dates = [date.strip() for date in args.dates.split(',') if date.strip()]
+    scenarios = args.scenario or list(SCENARIOS)
+    backoffice = backoffice_from_arguments(args)
+    server = start_fake_backoffice(backoffice)
+
+    # Le serveur lit sa configuration à l'import : la préparer avant d'importer app
+    data_dir = tempfile.mkdtemp(prefix='fresheo-benchmark-')
+    os.environ.update({
+        'FRESHEO_BASE_URL': server.url,
+        'FRESHEO_API_TOKEN': 'benchmark',
+        'FRESHEO_DATA_DIR': data_dir
+    })
+    import app as app_module
+    app_module.app.logger.setLevel('WARNING')
+    logging.getLogger('delivery_pipeline').setLevel('WARNING')
+
+    print(f"🚀 Benchmark Fresheo Labels ({args.rounds} tournées x {args.orders} commandes par date, dates: {', '.join(dates)})")
+    print(f"📍 Faux back-office: {server.url}")
+    print(f"⏳ Latences: {', '.join(f'{endpoint}={model.spec}' for endpoint, model in backoffice.latencies.items())}")
+    print("=" * 60)
+
+    results = {}
+    try:
+        for name in scenarios:
+            run = make_scenario(name, app_module, server.url, dates, args.max_workers)
+            results[name] = measure(run, backoffice, app_module, args.repeat, args.warm_cache)
+            print_result(name, results[name])
+    finally:
+        server.shutdown()
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    print("=" * 60)
+
+    if args.json:
+        report = {
+            'timestamp': datetime.now().isoformat(),
+            'config': {
+                'rounds': args.rounds,
+                'orders': args.orders,
+                'latencies': {endpoint: model.spec for endpoint, model in backoffice.latencies.items()},
+                'error_rates': backoffice.error_rates,
+                'payload_kb': args.payload_kb,
+                'seed': args.seed,
+                'capacity': args.capacity,
+                'dates': dates,
+                'repeat': args.repeat,
+                'warm_cache': args.warm_cache,
+                'max_concurrency': app_module.FRESHEO_MAX_CONCURRENCY,
+                'min_concurrency': app_module.FRESHEO_MIN_CONCURRENCY,
+                'max_workers': args.max_workers or app_module.FRESHEO_MAX_WORKERS
+            },
+            'results': results
+        }
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"💾 Résultats écrits dans {args.json}")
+
+if __name__ == "__main__":
+    sys.exit(main())
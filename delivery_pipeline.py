@@ -0,0 +1,1717 @@
+"""
+Génération des lignes du CSV de livraison à partir du back-office Fresheo, sans serveur web
+
+- client du back-office (session partagée, retries, limite adaptative, hedging, cache des commandes)
+- dates cibles selon la logique SQL, lignes par date et par groupe, rendu CSV
+- stockage local des snapshots, des lignes par tournée et des points de reprise (SQLite)
+Importé par app.py (serveur Flask) et par export_labels.py (export en ligne de commande) :
+ce module n'importe pas Flask.
+"""
+
+import os
+import atexit
+import csv
+import hashlib
+import io
+import itertools
+import json
+import logging
+import math
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import requests
+from dotenv import load_dotenv
+from prometheus_client import Counter, Gauge, Histogram
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ReadTimeoutError
+from urllib3.util.retry import Retry
+
+# Charger les variables d'environnement depuis .env
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Nombre maximum d'appels simultanés au back-office pendant la génération d'un CSV
+FRESHEO_MAX_WORKERS = max(1, int(os.getenv('FRESHEO_MAX_WORKERS', 8)))
+# Budget global d'appels simultanés au back-office par processus (toutes dates et générations confondues)
+# Limite adaptative (AIMD) entre FRESHEO_MIN_CONCURRENCY et FRESHEO_MAX_CONCURRENCY :
+# elle augmente tant que le back-office répond vite et baisse fortement sur 5xx / timeouts
+FRESHEO_MAX_CONCURRENCY = max(1, int(os.getenv('FRESHEO_MAX_CONCURRENCY', 16)))
+FRESHEO_MIN_CONCURRENCY = min(FRESHEO_MAX_CONCURRENCY, max(1, int(os.getenv('FRESHEO_MIN_CONCURRENCY', 2))))
+FRESHEO_INITIAL_CONCURRENCY = min(FRESHEO_MAX_CONCURRENCY, max(
+    FRESHEO_MIN_CONCURRENCY, int(os.getenv('FRESHEO_INITIAL_CONCURRENCY', FRESHEO_MAX_CONCURRENCY // 2))
+))
+# Facteur de réduction de la limite sur surcharge
+FRESHEO_LIMITER_BACKOFF = min(0.95, max(0.1, float(os.getenv('FRESHEO_LIMITER_BACKOFF', 0.5))))
+# Une réponse plus lente que ce facteur x la latence médiane récente n'augmente pas la limite
+FRESHEO_LIMITER_SLOW_FACTOR = float(os.getenv('FRESHEO_LIMITER_SLOW_FACTOR', 3.0))
+# Nombre de dates traitées en parallèle et taille max d'une plage from=/to=
+FRESHEO_MAX_PARALLEL_DATES = max(1, int(os.getenv('FRESHEO_MAX_PARALLEL_DATES', 4)))
+FRESHEO_MAX_RANGE_DAYS = max(1, int(os.getenv('FRESHEO_MAX_RANGE_DAYS', 31)))
+
+# Session HTTP partagée vers le back-office (pool de connexions keep-alive + retries)
+FRESHEO_POOL_SIZE = max(1, int(os.getenv('FRESHEO_POOL_SIZE', 16)))
+FRESHEO_MAX_RETRIES = max(0, int(os.getenv('FRESHEO_MAX_RETRIES', 3)))
+FRESHEO_BACKOFF_FACTOR = float(os.getenv('FRESHEO_BACKOFF_FACTOR', 0.5))
+FRESHEO_BACKOFF_JITTER = float(os.getenv('FRESHEO_BACKOFF_JITTER', 0.5))
+FRESHEO_CONNECT_TIMEOUT = float(os.getenv('FRESHEO_CONNECT_TIMEOUT', 10))
+
+# Timeouts (connexion, lecture) par endpoint du back-office
+ENDPOINT_TIMEOUTS = {
+    # Liste des tournées : peut prendre 5+ minutes côté back-office
+    'rounds': (FRESHEO_CONNECT_TIMEOUT, float(os.getenv('FRESHEO_ROUNDS_READ_TIMEOUT', 600))),
+    # Détails de tournée : réponses parfois volumineuses
+    'round_details': (FRESHEO_CONNECT_TIMEOUT, float(os.getenv('FRESHEO_ROUND_READ_TIMEOUT', 300))),
+    'order_details': (FRESHEO_CONNECT_TIMEOUT, float(os.getenv('FRESHEO_ORDER_READ_TIMEOUT', 120))),
+}
+
+# Stockage local persistant (cache des commandes), partagé par tous les workers
+FRESHEO_DATA_DIR = os.getenv('FRESHEO_DATA_DIR', 'data')
+FRESHEO_CACHE_OPEN_TTL = float(os.getenv('FRESHEO_CACHE_OPEN_TTL', 300))
+FRESHEO_CACHE_MAX_ENTRIES = max(1, int(os.getenv('FRESHEO_CACHE_MAX_ENTRIES', 20000)))
+# Les lectures du cache (dates d'accès, hits/misses) sont écrites par lots, au plus toutes les N secondes
+FRESHEO_CACHE_FLUSH_INTERVAL = float(os.getenv('FRESHEO_CACHE_FLUSH_INTERVAL', 5))
+
+# Regroupement des générations identiques simultanées : attente max d'une génération d'un autre worker
+FRESHEO_SINGLE_FLIGHT_TTL = float(os.getenv('FRESHEO_SINGLE_FLIGHT_TTL', 900))
+
+# Validité d'un point de reprise (secondes) : une génération interrompue relancée dans ce délai
+# repart de la liste des tournées et des tournées déjà terminées (0 = désactivé)
+FRESHEO_CHECKPOINT_TTL = float(os.getenv('FRESHEO_CHECKPOINT_TTL', 900))
+# Une génération en cours signale son activité à chaque groupe produit : son point de reprise n'est repris
+# par une autre génération que si son worker est arrêté, si elle s'est interrompue, ou après ce silence (secondes)
+FRESHEO_CHECKPOINT_LEASE = float(os.getenv('FRESHEO_CHECKPOINT_LEASE', 600))
+
+# Durée de conservation des lignes par tournée utilisées par la reconstruction incrémentale (jours)
+FRESHEO_ROUND_ROWS_TTL_DAYS = float(os.getenv('FRESHEO_ROUND_ROWS_TTL_DAYS', 14))
+
+# Requêtes de secours (hedging) : si un appel dépasse le p95 récent de son endpoint,
+# un second appel identique est lancé et la première réponse est gardée (désactivé par défaut)
+FRESHEO_HEDGE_ENABLED = os.getenv('FRESHEO_HEDGE_ENABLED', '').lower() in ['1', 'true', 'yes']
+FRESHEO_HEDGE_ENDPOINTS = [
+    endpoint.strip() for endpoint in os.getenv('FRESHEO_HEDGE_ENDPOINTS', 'round_details,order_details').split(',')
+    if endpoint.strip()
+]
+FRESHEO_HEDGE_PERCENTILE = float(os.getenv('FRESHEO_HEDGE_PERCENTILE', 0.95))
+FRESHEO_HEDGE_MIN_DELAY = float(os.getenv('FRESHEO_HEDGE_MIN_DELAY', 0.5))
+FRESHEO_HEDGE_MIN_SAMPLES = max(1, int(os.getenv('FRESHEO_HEDGE_MIN_SAMPLES', 20)))
+FRESHEO_HEDGE_WINDOW = max(FRESHEO_HEDGE_MIN_SAMPLES, int(os.getenv('FRESHEO_HEDGE_WINDOW', 200)))
+# Nombre max de requêtes de secours en cours par processus (ne pas surcharger un back-office déjà lent)
+FRESHEO_HEDGE_MAX_INFLIGHT = max(1, int(os.getenv('FRESHEO_HEDGE_MAX_INFLIGHT', 4)))
+
+# Métriques Prometheus (agrégées entre workers gunicorn si PROMETHEUS_MULTIPROC_DIR est défini)
+UPSTREAM_LATENCY = Histogram(
+    'fresheo_upstream_request_duration_seconds',
+    "Durée des appels au back-office (retries compris) par endpoint",
+    ['endpoint'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+)
+UPSTREAM_RESPONSES = Counter(
+    'fresheo_upstream_responses_total',
+    "Réponses du back-office par endpoint et code HTTP (error = pas de réponse)",
+    ['endpoint', 'status']
+)
+BUILD_PHASE_DURATION = Histogram(
+    'fresheo_csv_build_phase_duration_seconds',
+    "Durée des phases de génération du CSV (list, details, orders, sort, serialize)",
+    ['phase'],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600)
+)
+CSV_ROWS = Counter('fresheo_csv_rows_total', "Lignes CSV produites")
+ORDER_DETAILS_FALLBACKS = Counter(
+    'fresheo_order_details_fallback_total',
+    "Commandes pour lesquelles total_meals a pris la valeur par défaut (4)",
+    ['reason']
+)
+CACHE_INVALIDATIONS = Counter(
+    'fresheo_cache_invalidations_total',
+    "Entrées évincées par POST /invalidate (orders = détails de commandes, rounds = lignes de tournées, snapshots = dates)",
+    ['kind']
+)
+UPSTREAM_HEDGES = Counter(
+    'fresheo_upstream_hedges_total',
+    "Requêtes de secours par endpoint (sent = lancée, won = plus rapide que l'appel initial, capped = plafond atteint)",
+    ['endpoint', 'outcome']
+)
+
+UPSTREAM_CONCURRENCY_LIMIT = Gauge(
+    'fresheo_upstream_concurrency_limit',
+    "Limite adaptative d'appels simultanés au back-office (somme des workers)",
+    multiprocess_mode='livesum'
+)
+UPSTREAM_IN_FLIGHT = Gauge(
+    'fresheo_upstream_in_flight',
+    "Appels au back-office en cours (somme des workers)",
+    multiprocess_mode='livesum'
+)
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Limite adaptative (AIMD) des appels simultanés au back-office, partagée par tout le processus
+    - réponse rapide alors que la limite est utilisée : +1 environ toutes les "limit" réponses
+    - réponse lente (> FRESHEO_LIMITER_SLOW_FACTOR x médiane) : limite inchangée
+    - 5xx, 429, timeout ou connexion coupée (y compris rejoués par la session) : limite x backoff
+    Seuls les appels lancés après la dernière réduction peuvent la réduire à nouveau :
+    une rafale d'erreurs due à la même surcharge ne fait pas tomber la limite au minimum
+    """
+    
+    def __init__(self, min_limit: int = FRESHEO_MIN_CONCURRENCY, max_limit: int = FRESHEO_MAX_CONCURRENCY,
+                 initial_limit: int = FRESHEO_INITIAL_CONCURRENCY, backoff: float = FRESHEO_LIMITER_BACKOFF):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self._limit = float(initial_limit)
+        self._in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+    
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+    
+    def acquire(self) -> float:
+        """Attend une place sous la limite courante, retourne l'instant d'obtention (à passer à release)"""
+        with self._condition:
+            while self._in_flight >= int(self._limit):
+                self._condition.wait()
+            self._in_flight += 1
+        UPSTREAM_IN_FLIGHT.inc()
+        return time.monotonic()
+    
+    def release(self, acquired_at: float, outcome: str):
+        """Libère la place et ajuste la limite selon le résultat de l'appel (fast, overload, sinon inchangée)"""
+        with self._condition:
+            saturated = self._in_flight >= int(self._limit)
+            self._in_flight -= 1
+            if outcome == 'overload':
+                if acquired_at >= self._last_decrease:
+                    self._limit = max(float(self.min_limit), self._limit * self.backoff)
+                    self._last_decrease = time.monotonic()
+            elif outcome == 'fast' and saturated:
+                self._limit = min(float(self.max_limit), self._limit + 1 / self._limit)
+            limit = int(self._limit)
+            self._condition.notify_all()
+        UPSTREAM_IN_FLIGHT.dec()
+        UPSTREAM_CONCURRENCY_LIMIT.set(limit)
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._condition:
+            return {
+                'limit': int(self._limit),
+                'in_flight': self._in_flight,
+                'min_limit': self.min_limit,
+                'max_limit': self.max_limit
+            }
+
+# Budget global d'appels au back-office
+_upstream_limiter = AdaptiveConcurrencyLimiter()
+def get_upstream_limiter() -> AdaptiveConcurrencyLimiter:
+    """Retourne le budget d'appels au back-office du processus"""
+    return _upstream_limiter
+
+# Places disponibles pour les requêtes de secours
+_hedge_slots = threading.BoundedSemaphore(FRESHEO_HEDGE_MAX_INFLIGHT)
+_hedge_executor = None
+_hedge_executor_pid = None
+_hedge_executor_lock = threading.Lock()
+
+class LatencyTracker:
+    """Latences récentes des appels réussis par endpoint (fenêtre glissante), pour le seuil de hedging"""
+    
+    def __init__(self, window: int = FRESHEO_HEDGE_WINDOW, min_samples: int = FRESHEO_HEDGE_MIN_SAMPLES):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples = {}
+        self._lock = threading.Lock()
+    
+    def observe(self, endpoint: str, seconds: float):
+        with self._lock:
+            if endpoint not in self._samples:
+                self._samples[endpoint] = deque(maxlen=self.window)
+            self._samples[endpoint].append(seconds)
+    
+    def percentile(self, endpoint: str, q: float) -> Optional[float]:
+        """Percentile q (0-1) des latences récentes, None tant qu'il n'y a pas assez de mesures"""
+        with self._lock:
+            samples = sorted(self._samples.get(endpoint, ()))
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+_latency_tracker = LatencyTracker()
+
+def get_hedge_executor() -> ThreadPoolExecutor:
+    """Executor des appels hedgés (appel initial + secours), propre à chaque worker gunicorn"""
+    global _hedge_executor, _hedge_executor_pid
+    
+    with _hedge_executor_lock:
+        if _hedge_executor is None or _hedge_executor_pid != os.getpid():
+            # Chaque appel prend une place du budget global : au-delà, les threads attendent leur tour
+            _hedge_executor = ThreadPoolExecutor(
+                max_workers=FRESHEO_MAX_CONCURRENCY + FRESHEO_HEDGE_MAX_INFLIGHT,
+                thread_name_prefix='upstream-hedge'
+            )
+            _hedge_executor_pid = os.getpid()
+        return _hedge_executor
+
+class UpstreamRetry(Retry):
+    """Retry urllib3 qui ne relance pas une requête arrivée au bout de son timeout de lecture"""
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        # Un back-office qui ne répond pas ne répondra pas mieux au 2e essai : chaque relance
+        # rajouterait un timeout complet et bloquerait le thread d'autant
+        if isinstance(error, ReadTimeoutError):
+            raise error.with_traceback(_stacktrace)
+        return super().increment(method, url, response=response, error=error, _pool=_pool, _stacktrace=_stacktrace)
+
+_http_session = None
+_http_session_pid = None
+_http_session_lock = threading.Lock()
+
+def get_http_session() -> requests.Session:
+    """
+    Retourne la session HTTP partagée par tout le processus
+    Recréée après un fork (workers gunicorn) pour ne pas partager les sockets
+    """
+    global _http_session, _http_session_pid
+    
+    with _http_session_lock:
+        if _http_session is None or _http_session_pid != os.getpid():
+            # Retries bornés avec backoff exponentiel + jitter sur les 5xx et les connexions coupées
+            # (pas sur les timeouts de lecture, voir UpstreamRetry)
+            retry = UpstreamRetry(
+                total=FRESHEO_MAX_RETRIES,
+                connect=FRESHEO_MAX_RETRIES,
+                read=FRESHEO_MAX_RETRIES,
+                status=FRESHEO_MAX_RETRIES,
+                backoff_factor=FRESHEO_BACKOFF_FACTOR,
+                backoff_jitter=FRESHEO_BACKOFF_JITTER,
+                status_forcelist=(500, 502, 503, 504),
+                allowed_methods=frozenset(['GET']),
+                raise_on_status=False
+            )
+            adapter = HTTPAdapter(
+                pool_connections=FRESHEO_POOL_SIZE,
+                pool_maxsize=FRESHEO_POOL_SIZE,
+                max_retries=retry
+            )
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _http_session = session
+            _http_session_pid = os.getpid()
+        return _http_session
+
+# Profils en cours dans le processus (les appels au back-office sont notés dans chacun)
+_active_profiles = []
+_active_profiles_lock = threading.Lock()
+
+def add_active_profile(profile):
+    """Note dans profile (méthode record_call) chaque appel au back-office jusqu'à remove_active_profile"""
+    with _active_profiles_lock:
+        _active_profiles.append(profile)
+
+def remove_active_profile(profile):
+    with _active_profiles_lock:
+        if profile in _active_profiles:
+            _active_profiles.remove(profile)
+
+def record_upstream_call(endpoint: str, url: str, started: float, elapsed: float, response: requests.Response = None):
+    with _active_profiles_lock:
+        profiles = list(_active_profiles)
+    for profile in profiles:
+        profile.record_call(endpoint, url, started, elapsed, response)
+
+def open_sqlite(path: str) -> sqlite3.Connection:
+    """
+    Ouvre une base SQLite locale partagée entre workers gunicorn
+    (mode WAL, autocommit, utilisable depuis plusieurs threads sous verrou)
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+class OrderDetailsCache:
+    """
+    Cache SQLite des détails de commandes, indexé par order_id
+    - Commandes clôturées (is_closed) : n'expirent jamais
+    - Commandes ouvertes : expirent après open_ttl secondes
+    - Éviction des entrées les moins récemment lues au-delà de max_entries
+    Le fichier est partagé par les workers gunicorn (mode WAL)
+    Une lecture n'écrit rien : dates d'accès et compteurs sont gardés en mémoire
+    et écrits en une transaction toutes les flush_interval secondes
+    """
+    
+    def __init__(self, path: str, open_ttl: float = FRESHEO_CACHE_OPEN_TTL, max_entries: int = FRESHEO_CACHE_MAX_ENTRIES,
+                 flush_interval: float = FRESHEO_CACHE_FLUSH_INTERVAL):
+        self.path = path
+        self.open_ttl = open_ttl
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self._conn = None
+        self._conn_pid = None
+        self._lock = threading.Lock()
+        self._writes = 0
+        # Lectures pas encore écrites : {order_id: accessed_at} et {compteur: valeur}
+        self._pending_access = {}
+        self._pending_counts = {}
+        self._flushed_at = time.time()
+        # Vérifier la taille du cache régulièrement (au plus toutes les 100 écritures)
+        self._eviction_interval = max(1, min(100, max_entries // 10))
+    
+    def _connect(self) -> sqlite3.Connection:
+        """Connexion SQLite du processus (rouverte après un fork)"""
+        if self._conn is None or self._conn_pid != os.getpid():
+            # Après un fork, les lectures en attente appartiennent au processus parent
+            self._pending_access, self._pending_counts = {}, {}
+            conn = open_sqlite(self.path)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS order_details (
+                    order_id INTEGER PRIMARY KEY,
+                    data TEXT NOT NULL,
+                    is_closed INTEGER NOT NULL,
+                    fetched_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            """)
+            conn.execute('CREATE INDEX IF NOT EXISTS order_details_accessed_at ON order_details (accessed_at)')
+            conn.execute('CREATE TABLE IF NOT EXISTS cache_stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+            # Commandes invalidées : une réponse demandée avant l'invalidation n'est pas remise en cache
+            conn.execute('CREATE TABLE IF NOT EXISTS invalidated_orders (order_id INTEGER PRIMARY KEY, invalidated_at REAL NOT NULL)')
+            self._conn = conn
+            self._conn_pid = os.getpid()
+        return self._conn
+    
+    def _increment(self, conn: sqlite3.Connection, name: str, value: int = 1):
+        conn.execute(
+            'INSERT INTO cache_stats (name, value) VALUES (?, ?) '
+            'ON CONFLICT(name) DO UPDATE SET value = value + excluded.value',
+            (name, value)
+        )
+    
+    def get(self, order_id: int, fresh_since: float = None) -> Dict[str, Any]:
+        """
+        Retourne les détails en cache, ou None si absents ou expirés
+        Une commande ouverte récupérée depuis fresh_since est acceptée même au-delà de open_ttl
+        """
+        now = time.time()
+        try:
+            with self._lock:
+                conn = self._connect()
+                row = conn.execute(
+                    'SELECT data, is_closed, fetched_at FROM order_details WHERE order_id = ?', (order_id,)
+                ).fetchone()
+                fresh = row is not None and (row[1] or now - row[2] < self.open_ttl
+                                             or (fresh_since is not None and row[2] >= fresh_since))
+                if fresh:
+                    self._pending_access[order_id] = now
+                counter = 'hits' if fresh else 'misses'
+                self._pending_counts[counter] = self._pending_counts.get(counter, 0) + 1
+                if now - self._flushed_at >= self.flush_interval:
+                    self._flush(conn)
+        except sqlite3.Error as e:
+            logger.warning(f"Cache commandes indisponible (lecture {order_id}): {e}")
+            return None
+        return json.loads(row[0]) if fresh else None
+    
+    def set(self, order_id: int, data: Dict[str, Any], requested_at: float = None):
+        """
+        Enregistre les détails d'une commande (les réponses vides ne sont pas mises en cache)
+        requested_at : début de l'appel au back-office, la réponse est ignorée si la commande a été invalidée depuis
+        """
+        if not data:
+            return
+        now = time.time()
+        try:
+            with self._lock:
+                conn = self._connect()
+                if requested_at is not None and conn.execute(
+                    'SELECT 1 FROM invalidated_orders WHERE order_id = ? AND invalidated_at >= ?', (order_id, requested_at)
+                ).fetchone():
+                    return
+                with conn:
+                    conn.execute(
+                        'INSERT OR REPLACE INTO order_details (order_id, data, is_closed, fetched_at, accessed_at) '
+                        'VALUES (?, ?, ?, ?, ?)',
+                        (order_id, json.dumps(data), 1 if data.get('is_closed') else 0, now, now)
+                    )
+                self._writes += 1
+                if self._writes % self._eviction_interval == 0:
+                    self._evict(conn)
+        except sqlite3.Error as e:
+            logger.warning(f"Cache commandes indisponible (écriture {order_id}): {e}")
+    
+    def _flush(self, conn: sqlite3.Connection):
+        """Écrit les dates d'accès et compteurs en attente (appelé avec self._lock)"""
+        self._flushed_at = time.time()
+        if not self._pending_access and not self._pending_counts:
+            return
+        accesses, counts = self._pending_access, self._pending_counts
+        self._pending_access, self._pending_counts = {}, {}
+        with conn:
+            # Un autre worker a pu lire la commande plus récemment
+            conn.executemany(
+                'UPDATE order_details SET accessed_at = MAX(accessed_at, ?) WHERE order_id = ?',
+                [(accessed_at, order_id) for order_id, accessed_at in accesses.items()]
+            )
+            for name, value in counts.items():
+                self._increment(conn, name, value)
+    
+    def flush(self):
+        """Écrit tout de suite les lectures en attente de ce processus"""
+        try:
+            with self._lock:
+                self._flush(self._connect())
+        except sqlite3.Error as e:
+            logger.warning(f"Cache commandes indisponible (écriture des lectures): {e}")
+    
+    def _evict(self, conn: sqlite3.Connection):
+        """Supprime les entrées les moins récemment lues au-delà de max_entries"""
+        # Dates d'accès à jour avant de choisir les entrées à supprimer
+        self._flush(conn)
+        count = conn.execute('SELECT COUNT(*) FROM order_details').fetchone()[0]
+        excess = count - self.max_entries
+        if excess > 0:
+            with conn:
+                conn.execute(
+                    'DELETE FROM order_details WHERE order_id IN '
+                    '(SELECT order_id FROM order_details ORDER BY accessed_at LIMIT ?)',
+                    (excess,)
+                )
+                self._increment(conn, 'evictions', excess)
+    
+    def invalidate(self, order_ids: List[int]) -> int:
+        """Supprime les commandes données du cache, retourne le nombre d'entrées supprimées"""
+        if not order_ids:
+            return 0
+        now = time.time()
+        placeholders = ', '.join('?' for _ in order_ids)
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                evicted = conn.execute(f'DELETE FROM order_details WHERE order_id IN ({placeholders})', order_ids).rowcount
+                conn.executemany(
+                    'INSERT OR REPLACE INTO invalidated_orders (order_id, invalidated_at) VALUES (?, ?)',
+                    [(order_id, now) for order_id in order_ids]
+                )
+                # Au-delà d'une heure, plus aucun appel commencé avant l'invalidation n'est en cours
+                conn.execute('DELETE FROM invalidated_orders WHERE invalidated_at < ?', (now - 3600,))
+                self._increment(conn, 'invalidations', evicted)
+        return evicted
+    
+    def clear(self):
+        """Vide le cache (les compteurs sont conservés)"""
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute('DELETE FROM order_details')
+    
+    def stats(self) -> Dict[str, Any]:
+        """Compteurs du cache (cumulés sur tous les workers)"""
+        try:
+            with self._lock:
+                conn = self._connect()
+                self._flush(conn)
+                entries, closed = conn.execute(
+                    'SELECT COUNT(*), COALESCE(SUM(is_closed), 0) FROM order_details'
+                ).fetchone()
+                counters = dict(conn.execute('SELECT name, value FROM cache_stats').fetchall())
+        except sqlite3.Error as e:
+            return {'error': str(e)}
+        
+        hits = counters.get('hits', 0)
+        misses = counters.get('misses', 0)
+        return {
+            'entries': entries,
+            'closed_entries': closed,
+            'max_entries': self.max_entries,
+            'hits': hits,
+            'misses': misses,
+            'hit_ratio': round(hits / (hits + misses), 3) if hits + misses else None,
+            'evictions': counters.get('evictions', 0),
+            'invalidations': counters.get('invalidations', 0)
+        }
+
+_order_cache = None
+_order_cache_lock = threading.Lock()
+
+def get_order_cache() -> OrderDetailsCache:
+    """Retourne le cache des commandes partagé du processus"""
+    global _order_cache
+    
+    with _order_cache_lock:
+        if _order_cache is None:
+            _order_cache = OrderDetailsCache(os.path.join(FRESHEO_DATA_DIR, 'order_cache.sqlite3'))
+            # Worker arrêté (--max-requests, redémarrage) : ne pas perdre les dernières lectures
+            atexit.register(_order_cache.flush)
+        return _order_cache
+
+# Champs des détails de commande utilisés par le CSV et le cache (le reste du payload est ignoré)
+ORDER_DETAILS_FIELDS = ('id', 'total_meals', 'is_closed')
+
+_json_decoder = json.JSONDecoder()
+_JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+def parse_json_projection(text: str, fields: Tuple[str, ...]) -> Optional[Dict[str, Any]]:
+    """
+    Lit seulement les champs demandés du premier objet d'un document JSON (objet, ou tableau d'objets)
+    Les autres valeurs ne sont pas gardées et la lecture s'arrête dès que tous les champs
+    sont trouvés (le reste du document, souvent les repas et leurs photos, n'est pas parcouru)
+    Retourne None pour un tableau vide, lève ValueError si le document n'a pas cette forme
+    """
+    def skip_whitespace(index: int) -> int:
+        return _JSON_WHITESPACE.match(text, index).end()
+    
+    wanted = set(fields)
+    projected = {}
+    index = skip_whitespace(0)
+    if text.startswith('[', index):
+        index = skip_whitespace(index + 1)
+        if text.startswith(']', index):
+            return None
+    if not text.startswith('{', index):
+        raise ValueError("Objet JSON attendu")
+    
+    index = skip_whitespace(index + 1)
+    if text.startswith('}', index):
+        return projected
+    while True:
+        if not text.startswith('"', index):
+            raise ValueError(f"Clé JSON attendue à la position {index}")
+        key, index = json.decoder.scanstring(text, index + 1)
+        index = skip_whitespace(index)
+        if not text.startswith(':', index):
+            raise ValueError(f"':' attendu à la position {index}")
+        index = skip_whitespace(index + 1)
+        
+        if key in wanted:
+            projected[key], index = _json_decoder.raw_decode(text, index)
+            wanted.discard(key)
+            if not wanted:
+                return projected
+        else:
+            # Valeur ignorée (ex: repas) : décodée par le parser C puis libérée aussitôt
+            index = _json_decoder.raw_decode(text, index)[1]
+        
+        index = skip_whitespace(index)
+        if text.startswith(',', index):
+            index = skip_whitespace(index + 1)
+        elif text.startswith('}', index):
+            return projected
+        else:
+            raise ValueError(f"',' ou '}}' attendu à la position {index}")
+
+def get_response_outcome(endpoint: str, response: requests.Response, elapsed: float) -> str:
+    """
+    Signal pour la limite adaptative : overload si le back-office est en difficulté
+    (5xx / 429, ou erreurs rejouées par la session avant la réponse finale), slow ou fast sinon
+    """
+    if response.status_code >= 500 or response.status_code == 429:
+        return 'overload'
+    retries = getattr(response.raw, 'retries', None)
+    if retries is not None and retries.history:
+        return 'overload'
+    median = _latency_tracker.percentile(endpoint, 0.5)
+    if median is not None and elapsed > FRESHEO_LIMITER_SLOW_FACTOR * median:
+        return 'slow'
+    return 'fast'
+
+def _close_response(future: Future):
+    """Libère la connexion de la réponse d'un appel perdant"""
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+class FresheoDeliveryAPI:
+    def __init__(self, base_url: str, token: str, session: requests.Session = None, cache: OrderDetailsCache = None):
+        # S'assurer que l'URL de base contient /api/bo/v1
+        base_url = base_url.rstrip('/')
+        if not base_url.endswith('/api/bo/v1'):
+            base_url = base_url + '/api/bo/v1'
+        
+        self.base_url = base_url
+        self.headers = {
+            'Authorization': f'Bearer {token}',
+            'Content-Type': 'application/json'
+        }
+        self.session = session
+        self.cache = cache
+
+    def _get(self, endpoint: str, url: str, params: Dict[str, Any] = None) -> requests.Response:
+        """
+        GET via la session partagée avec le timeout (connexion, lecture) de l'endpoint
+        Chaque appel prend une place dans le budget global adaptatif (_upstream_limiter)
+        Avec FRESHEO_HEDGE_ENABLED, un appel plus lent que le p95 récent est doublé (voir _get_hedged)
+        """
+        if FRESHEO_HEDGE_ENABLED and endpoint in FRESHEO_HEDGE_ENDPOINTS:
+            threshold = _latency_tracker.percentile(endpoint, FRESHEO_HEDGE_PERCENTILE)
+            if threshold is not None:
+                response = self._get_hedged(endpoint, url, params, max(threshold, FRESHEO_HEDGE_MIN_DELAY))
+            else:
+                response = self._send(endpoint, url, params)
+        else:
+            response = self._send(endpoint, url, params)
+        response.raise_for_status()
+        return response
+    
+    def _send(self, endpoint: str, url: str, params: Dict[str, Any] = None,
+              sending: threading.Event = None) -> requests.Response:
+        """
+        Un appel au back-office (retries de la session compris), mesuré pour les métriques et le hedging
+        sending est signalé quand l'appel a obtenu sa place dans le budget global
+        """
+        session = self.session or get_http_session()
+        acquired_at = _upstream_limiter.acquire()
+        outcome = 'overload'
+        response = None
+        try:
+            if sending is not None:
+                sending.set()
+            started = time.perf_counter()
+            try:
+                response = session.get(url, headers=self.headers, params=params, timeout=ENDPOINT_TIMEOUTS[endpoint])
+            except requests.exceptions.RequestException as e:
+                UPSTREAM_RESPONSES.labels(endpoint, 'error').inc()
+                if not isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+                    # Erreur sans rapport avec la charge (ex: URL invalide) : limite inchangée
+                    outcome = 'error'
+                raise
+            finally:
+                elapsed = time.perf_counter() - started
+                UPSTREAM_LATENCY.labels(endpoint).observe(elapsed)
+                if _active_profiles:
+                    record_upstream_call(endpoint, response.url if response is not None else url, started, elapsed, response)
+            outcome = get_response_outcome(endpoint, response, elapsed)
+        finally:
+            _upstream_limiter.release(acquired_at, outcome)
+        
+        if response.ok:
+            _latency_tracker.observe(endpoint, elapsed)
+        UPSTREAM_RESPONSES.labels(endpoint, str(response.status_code)).inc()
+        return response
+    
+    def _get_hedged(self, endpoint: str, url: str, params: Dict[str, Any], delay: float) -> requests.Response:
+        """
+        Lance l'appel, puis un second appel identique s'il n'a pas répondu après delay secondes
+        (dans la limite de FRESHEO_HEDGE_MAX_INFLIGHT secours simultanés) : la première réponse gagne
+        L'appel perdant n'est pas interrompu, sa réponse est ignorée
+        """
+        executor = get_hedge_executor()
+        sending = threading.Event()
+        primary = executor.submit(self._send, endpoint, url, params, sending)
+        primary.add_done_callback(lambda future: sending.set())
+        # Le délai compte à partir de l'envoi : l'attente d'une place dans le budget global ne déclenche pas de secours
+        sending.wait()
+        try:
+            return primary.result(timeout=delay)
+        except FuturesTimeoutError:
+            pass
+        
+        if not _hedge_slots.acquire(blocking=False):
+            UPSTREAM_HEDGES.labels(endpoint, 'capped').inc()
+            return primary.result()
+        
+        UPSTREAM_HEDGES.labels(endpoint, 'sent').inc()
+        try:
+            hedge = executor.submit(self._send, endpoint, url, params)
+        except RuntimeError:
+            # Executor arrêté (fin du processus)
+            _hedge_slots.release()
+            return primary.result()
+        hedge.add_done_callback(lambda future: _hedge_slots.release())
+        
+        pending = {primary, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in (primary, hedge):
+                # _send rend les réponses 4xx/5xx sans exception : seule une réponse valide gagne,
+                # sinon l'autre appel est attendu
+                if future in done and future.exception() is None and future.result().ok:
+                    if future is hedge:
+                        UPSTREAM_HEDGES.labels(endpoint, 'won').inc()
+                    for loser in (primary, hedge):
+                        if loser is not future:
+                            loser.add_done_callback(_close_response)
+                    return future.result()
+        # Les deux appels ont échoué : remonter l'erreur de l'appel initial
+        # (celle du secours si seul lui a obtenu une réponse HTTP)
+        if primary.exception() is not None and hedge.exception() is None:
+            return hedge.result()
+        hedge.add_done_callback(_close_response)
+        return primary.result()
+
+    def get_delivery_rounds_for_date(self, date: str) -> List[Dict[str, Any]]:
+        """Récupère toutes les tournées pour une date donnée"""
+        url = f"{self.base_url}/rounds/delivery"
+        params = {'date': date}
+        
+        try:
+            # Timeout long pour éviter les problèmes de performance (5+ minutes parfois)
+            response = self._get('rounds', url, params=params)
+            return response.json()
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Erreur lors de la récupération des tournées: {e}")
+            raise
+
+    def get_round_details(self, round_id: int) -> Dict[str, Any]:
+        """Récupère les détails d'une tournée spécifique"""
+        url = f"{self.base_url}/rounds/delivery/{round_id}"
+        
+        try:
+            # Timeout long pour les détails de tournée qui peuvent être volumineux
+            response = self._get('round_details', url)
+            return response.json()
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"Impossible de récupérer les détails de la tournée {round_id}: {e}")
+            return {}
+
+    def get_order_details(self, order_id: int, use_cache: bool = True,
+                          fields: Tuple[str, ...] = ORDER_DETAILS_FIELDS, fresh_since: float = None) -> Dict[str, Any]:
+        """
+        Récupère les détails d'une commande
+        Seuls les champs fields sont lus dans la réponse (fields=None pour le payload complet)
+        Passe par le cache local si le client en a un (use_cache=False pour forcer l'appel API)
+        fresh_since : accepter une commande ouverte en cache si elle a été récupérée depuis (reprise d'une génération)
+        Lève requests.RequestException si le back-office reste en erreur après les retries
+        """
+        if use_cache and self.cache is not None:
+            cached = self.cache.get(order_id, fresh_since=fresh_since)
+            if cached is not None:
+                return cached if fields is None else {key: cached[key] for key in fields if key in cached}
+        
+        url = f"{self.base_url}/get-order/{order_id}/delivery"
+        requested_at = time.time()
+        
+        try:
+            # Les erreurs transitoires (5xx, connexion coupée) sont déjà rejouées par la session
+            response = self._get('order_details', url)
+            data = self._parse_order_details(order_id, response, fields)
+            
+            # L'API peut retourner un array ou un objet
+            if isinstance(data, list):
+                if len(data) > 0:
+                    data = data[0]  # Garder le premier élément
+                else:
+                    data = None
+            if data is None:
+                logger.warning(f"API a retourné une liste vide pour la commande {order_id}")
+                ORDER_DETAILS_FALLBACKS.labels('empty').inc()
+                return {}  # Retourner un dict vide si liste vide
+        except requests.exceptions.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                # Réponse définitive du back-office : commande sans détails (total_meals par défaut)
+                logger.warning(f"Commande {order_id} introuvable dans le back-office (total_meals par défaut)")
+                ORDER_DETAILS_FALLBACKS.labels('not_found').inc()
+                return {}
+            # Pas de total_meals par défaut : l'appelant marque la tournée en erreur
+            logger.error(f"Impossible de récupérer les détails de la commande {order_id}: {e}")
+            raise
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Impossible de récupérer les détails de la commande {order_id}: {e}")
+            raise
+        
+        if self.cache is not None:
+            self.cache.set(order_id, data, requested_at=requested_at)
+        return data
+    
+    def _parse_order_details(self, order_id: int, response: requests.Response, fields: Tuple[str, ...]):
+        """
+        Lecture des seuls champs demandés (parse_json_projection),
+        avec repli sur le parsing complet si la réponse n'a pas la forme attendue
+        """
+        if fields is None:
+            return response.json()
+        
+        content = response.content
+        try:
+            return parse_json_projection(content.decode(json.detect_encoding(content)), fields)
+        except (ValueError, IndexError) as e:
+            logger.warning(f"Lecture partielle impossible pour la commande {order_id}, parsing complet: {e}")
+        
+        data = response.json()
+        if isinstance(data, list):
+            data = data[0] if data else None
+        if isinstance(data, dict):
+            data = {key: data[key] for key in fields if key in data}
+        return data
+
+def is_process_alive(pid: int) -> bool:
+    """Vérifie qu'un processus (worker gunicorn) existe toujours"""
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class LabelSnapshotStore:
+    """
+    Dernières lignes CSV construites pour chaque date de livraison (SQLite)
+    Garde aussi les lignes de chaque tournée avec l'empreinte de la tournée,
+    pour les reconstructions incrémentales
+    Contient aussi des baux inter-processus pour qu'un seul worker gunicorn
+    exécute une tâche partagée (ex: préparation planifiée)
+    """
+    
+    def __init__(self, directory: str):
+        self.path = os.path.join(directory, 'snapshots.sqlite3')
+        self._conn = None
+        self._conn_pid = None
+        self._lock = threading.Lock()
+    
+    def _connect(self) -> sqlite3.Connection:
+        """Connexion SQLite du processus (rouverte après un fork)"""
+        if self._conn is None or self._conn_pid != os.getpid():
+            conn = open_sqlite(self.path)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS snapshots (
+                    date TEXT PRIMARY KEY,
+                    rows TEXT NOT NULL,
+                    row_count INTEGER NOT NULL,
+                    built_at REAL NOT NULL,
+                    csv TEXT,
+                    digest TEXT,
+                    row_index TEXT
+                )
+            """)
+            # Lignes CSV déjà rendues, leur empreinte (ETag) et l'index des groupes, ajoutés depuis la création de la table
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(snapshots)')}
+            for column in ('csv', 'digest', 'row_index'):
+                if column not in columns:
+                    conn.execute(f'ALTER TABLE snapshots ADD COLUMN {column} TEXT')
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS round_rows (
+                    round_id INTEGER PRIMARY KEY,
+                    date TEXT NOT NULL,
+                    fingerprint TEXT NOT NULL,
+                    rows TEXT NOT NULL,
+                    built_at REAL NOT NULL
+                )
+            """)
+            conn.execute('CREATE INDEX IF NOT EXISTS round_rows_date ON round_rows (date)')
+            # Oublier les tournées trop anciennes
+            conn.execute('DELETE FROM round_rows WHERE built_at < ?', (time.time() - FRESHEO_ROUND_ROWS_TTL_DAYS * 86400,))
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS checkpoints (
+                    date TEXT NOT NULL,
+                    mode TEXT NOT NULL,
+                    rounds TEXT NOT NULL,
+                    started_at REAL NOT NULL,
+                    owner TEXT,
+                    heartbeat_at REAL,
+                    PRIMARY KEY (date, mode)
+                )
+            """)
+            # Propriétaire ("pid:id" de la génération en cours, NULL une fois interrompue) ajouté depuis la création
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(checkpoints)')}
+            for column, definition in (('owner', 'TEXT'), ('heartbeat_at', 'REAL')):
+                if column not in columns:
+                    conn.execute(f'ALTER TABLE checkpoints ADD COLUMN {column} {definition}')
+            conn.execute('DELETE FROM checkpoints WHERE started_at < ?', (time.time() - FRESHEO_CHECKPOINT_TTL,))
+            # Dernière invalidation de chaque date (POST /invalidate) : une génération commencée avant
+            # n'enregistre ni son snapshot ni ses tournées
+            conn.execute('CREATE TABLE IF NOT EXISTS invalidations (date TEXT PRIMARY KEY, invalidated_at REAL NOT NULL)')
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS flight_results (
+                    key TEXT PRIMARY KEY,
+                    rows TEXT NOT NULL,
+                    finished_at REAL NOT NULL
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS leases (
+                    name TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            """)
+            self._conn = conn
+            self._conn_pid = os.getpid()
+        return self._conn
+    
+    def save(self, date: str, rows: List[Dict[str, Any]], built_at: float = None,
+             csv_text: str = None, row_index: List[list] = None):
+        """
+        Enregistre les lignes d'une date (remplace le snapshot précédent)
+        avec leur rendu CSV, son empreinte et l'index des groupes (csv_text / row_index s'ils sont déjà calculés)
+        """
+        if csv_text is None or row_index is None:
+            csv_text, row_index = render_indexed_csv_rows(rows)
+        with self._lock:
+            if built_at is not None and self._invalidated_since(date, built_at):
+                logger.info(f"🧹 {date}: invalidée pendant la génération, snapshot non enregistré")
+                return
+            self._connect().execute(
+                'INSERT OR REPLACE INTO snapshots (date, rows, row_count, built_at, csv, digest, row_index) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (date, json.dumps(rows), len(rows), built_at or time.time(), csv_text, get_csv_digest(csv_text), json.dumps(row_index))
+            )
+    
+    def load(self, date: str) -> Tuple[List[Dict[str, Any]], float]:
+        """Retourne (lignes, built_at) du snapshot d'une date, ou None"""
+        with self._lock:
+            row = self._connect().execute('SELECT rows, built_at FROM snapshots WHERE date = ?', (date,)).fetchone()
+        return (json.loads(row[0]), row[1]) if row else None
+    
+    def load_part(self, date: str) -> Dict[str, Any]:
+        """
+        Snapshot d'une date sous forme de partie de CSV déjà rendue (voir csv_part), ou None
+        Les lignes ne sont pas relues : le CSV n'est pas resérialisé
+        """
+        with self._lock:
+            row = self._connect().execute(
+                'SELECT csv, digest, row_count, built_at, row_index FROM snapshots WHERE date = ?', (date,)
+            ).fetchone()
+        if row is None:
+            return None
+        csv_text, digest, row_count, built_at, row_index = row
+        if csv_text is None or row_index is None:
+            # Snapshot enregistré avant l'ajout du rendu CSV ou de l'index
+            snapshot = self.load(date)
+            if snapshot is None:
+                return None
+            csv_text, row_index = render_indexed_csv_rows(snapshot[0])
+            return csv_part(csv_text, row_count, built_at, row_index=row_index)
+        return csv_part(csv_text, row_count, built_at, digest, json.loads(row_index))
+    
+    def digests(self, dates: List[str]) -> Dict[str, Tuple[str, float]]:
+        """Empreinte et built_at des snapshots existants parmi les dates données, sans lire leur contenu"""
+        placeholders = ', '.join('?' for _ in dates)
+        with self._lock:
+            return {
+                date: (digest, built_at)
+                for date, digest, built_at in self._connect().execute(
+                    f'SELECT date, digest, built_at FROM snapshots WHERE date IN ({placeholders}) AND digest IS NOT NULL', dates
+                )
+            }
+    
+    def built_at(self, dates: List[str]) -> Dict[str, float]:
+        """Date de construction des snapshots existants parmi les dates données"""
+        placeholders = ', '.join('?' for _ in dates)
+        with self._lock:
+            return dict(self._connect().execute(
+                f'SELECT date, built_at FROM snapshots WHERE date IN ({placeholders})', dates
+            ).fetchall())
+    
+    def load_round_rows(self, date: str, since: float = 0) -> Dict[int, Tuple[str, List[Dict[str, Any]]]]:
+        """Lignes connues des tournées d'une date (construites depuis since) : {round_id: (empreinte, lignes)}"""
+        with self._lock:
+            return {
+                round_id: (fingerprint, json.loads(rows))
+                for round_id, fingerprint, rows in self._connect().execute(
+                    'SELECT round_id, fingerprint, rows FROM round_rows WHERE date = ? AND built_at >= ?', (date, since)
+                )
+            }
+    
+    def save_round_rows(self, date: str, round_id: int, fingerprint: str, rows: List[Dict[str, Any]],
+                        started_at: float = None):
+        """Enregistre les lignes d'une tournée et son empreinte (sauf si la date a été invalidée depuis started_at)"""
+        with self._lock:
+            if started_at is not None and self._invalidated_since(date, started_at):
+                return
+            self._connect().execute(
+                'INSERT OR REPLACE INTO round_rows (round_id, date, fingerprint, rows, built_at) VALUES (?, ?, ?, ?, ?)',
+                (round_id, date, fingerprint, json.dumps(rows), time.time())
+            )
+    
+    def prune_round_rows(self, date: str, round_ids: List[int]):
+        """Supprime les tournées d'une date qui ne sont plus dans la liste round_ids"""
+        placeholders = ', '.join('?' for _ in round_ids)
+        with self._lock:
+            self._connect().execute(
+                f'DELETE FROM round_rows WHERE date = ? AND round_id NOT IN ({placeholders})', (date, *round_ids)
+            )
+    
+    def _invalidated_since(self, date: str, since: float) -> bool:
+        return self._connect().execute(
+            'SELECT 1 FROM invalidations WHERE date = ? AND invalidated_at >= ?', (date, since)
+        ).fetchone() is not None
+    
+    def invalidate(self, order_ids: List[int], round_ids: List[int], dates: List[str]) -> Dict[str, List]:
+        """
+        Évince tout ce qui dépend des commandes, tournées et dates données :
+        - lignes des tournées qui contiennent une des commandes, des tournées données et de toutes les tournées des dates données
+        - snapshots et points de reprise des dates concernées (dates données, dates des tournées évincées,
+          dates dont le snapshot contient une des commandes)
+        - résultats des générations regroupées (SingleFlight) qui couvrent une de ces dates
+        Les tournées inconnues (jamais générées ou expirées) ne peuvent pas être rattachées à une date
+        Retourne {'rounds': tournées évincées, 'unknown_rounds': tournées inconnues,
+                  'dates': dates concernées, 'snapshots': dates dont le snapshot a été évincé}
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                affected_rounds = {}
+                if order_ids:
+                    placeholders = ', '.join('?' for _ in order_ids)
+                    affected_rounds.update(conn.execute(
+                        f"SELECT DISTINCT round_rows.round_id, round_rows.date FROM round_rows, json_each(round_rows.rows) AS row "
+                        f"WHERE json_extract(row.value, '$.order_id') IN ({placeholders})", order_ids
+                    ).fetchall())
+                    snapshot_dates = {date for (date,) in conn.execute(
+                        f"SELECT DISTINCT snapshots.date FROM snapshots, json_each(snapshots.rows) AS row "
+                        f"WHERE json_extract(row.value, '$.order_id') IN ({placeholders})", order_ids
+                    )}
+                else:
+                    snapshot_dates = set()
+                if round_ids:
+                    placeholders = ', '.join('?' for _ in round_ids)
+                    affected_rounds.update(conn.execute(
+                        f'SELECT round_id, date FROM round_rows WHERE round_id IN ({placeholders})', round_ids
+                    ).fetchall())
+                
+                affected_dates = sorted(set(dates) | set(affected_rounds.values()) | snapshot_dates)
+                if dates:
+                    placeholders = ', '.join('?' for _ in dates)
+                    affected_rounds.update(conn.execute(
+                        f'SELECT round_id, date FROM round_rows WHERE date IN ({placeholders})', dates
+                    ).fetchall())
+                
+                if affected_rounds:
+                    placeholders = ', '.join('?' for _ in affected_rounds)
+                    conn.execute(f'DELETE FROM round_rows WHERE round_id IN ({placeholders})', list(affected_rounds))
+                evicted_snapshots = []
+                if affected_dates:
+                    placeholders = ', '.join('?' for _ in affected_dates)
+                    evicted_snapshots = [date for (date,) in conn.execute(
+                        f'SELECT date FROM snapshots WHERE date IN ({placeholders}) ORDER BY date', affected_dates
+                    )]
+                    conn.execute(f'DELETE FROM snapshots WHERE date IN ({placeholders})', affected_dates)
+                    conn.execute(f'DELETE FROM checkpoints WHERE date IN ({placeholders})', affected_dates)
+                    # Clé "date1,date2|mode..." : un worker qui attend ne doit pas recevoir l'ancien résultat
+                    stale_flights = [key for (key,) in conn.execute('SELECT key FROM flight_results')
+                                     if set(key.split('|', 1)[0].split(',')) & set(affected_dates)]
+                    conn.executemany('DELETE FROM flight_results WHERE key = ?', [(key,) for key in stale_flights])
+                    conn.executemany(
+                        'INSERT OR REPLACE INTO invalidations (date, invalidated_at) VALUES (?, ?)',
+                        [(date, now) for date in affected_dates]
+                    )
+        return {
+            'rounds': sorted(affected_rounds),
+            'unknown_rounds': [round_id for round_id in round_ids if round_id not in affected_rounds],
+            'dates': affected_dates,
+            'snapshots': evicted_snapshots
+        }
+    
+    @staticmethod
+    def _is_checkpoint_live(owner: Optional[str], heartbeat_at: Optional[float]) -> bool:
+        """La génération propriétaire tourne encore : worker en vie et activité récente"""
+        return (owner is not None and heartbeat_at is not None
+                and time.time() - heartbeat_at < FRESHEO_CHECKPOINT_LEASE
+                and is_process_alive(int(owner.split(':')[0])))
+    
+    def load_checkpoint(self, date: str, mode: str) -> Dict[str, Any]:
+        """
+        Point de reprise encore valide d'une génération (date, mode) interrompue : {'rounds', 'started_at'}, ou None
+        (None aussi tant que la génération propriétaire est en cours)
+        """
+        with self._lock:
+            row = self._connect().execute(
+                'SELECT rounds, started_at, owner, heartbeat_at FROM checkpoints WHERE date = ? AND mode = ? AND started_at >= ?',
+                (date, mode, time.time() - FRESHEO_CHECKPOINT_TTL)
+            ).fetchone()
+        if row is None or self._is_checkpoint_live(row[2], row[3]):
+            return None
+        return {'rounds': json.loads(row[0]), 'started_at': row[1]}
+    
+    def claim_checkpoint(self, date: str, mode: str, owner: str) -> Tuple[Optional[Dict[str, Any]], bool]:
+        """
+        Reprend le point de reprise (date, mode) pour la génération owner
+        Retourne ({'rounds', 'started_at'}, False) si une génération interrompue est à reprendre,
+        (None, True) si une autre génération est en cours (ni reprise ni nouveau point de reprise),
+        (None, False) sinon
+        """
+        with self._lock:
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute(
+                    'SELECT rounds, started_at, owner, heartbeat_at FROM checkpoints WHERE date = ? AND mode = ? AND started_at >= ?',
+                    (date, mode, time.time() - FRESHEO_CHECKPOINT_TTL)
+                ).fetchone()
+                if row is None or self._is_checkpoint_live(row[2], row[3]):
+                    conn.execute('ROLLBACK')
+                    return None, row is not None
+                conn.execute(
+                    'UPDATE checkpoints SET owner = ?, heartbeat_at = ? WHERE date = ? AND mode = ?',
+                    (owner, time.time(), date, mode)
+                )
+                conn.execute('COMMIT')
+            except sqlite3.Error:
+                conn.execute('ROLLBACK')
+                raise
+        return {'rounds': json.loads(row[0]), 'started_at': row[1]}, False
+    
+    def save_checkpoint(self, date: str, mode: str, rounds: List[Dict[str, Any]], started_at: float, owner: str):
+        """Enregistre la liste des tournées d'une génération qui commence (et oublie les points de reprise expirés)"""
+        with self._lock:
+            conn = self._connect()
+            conn.execute('DELETE FROM checkpoints WHERE started_at < ?', (time.time() - FRESHEO_CHECKPOINT_TTL,))
+            conn.execute(
+                'INSERT OR REPLACE INTO checkpoints (date, mode, rounds, started_at, owner, heartbeat_at) VALUES (?, ?, ?, ?, ?, ?)',
+                (date, mode, json.dumps(rounds), started_at, owner, time.time())
+            )
+    
+    def touch_checkpoint(self, date: str, mode: str, owner: str):
+        """Signale que la génération owner est toujours active"""
+        with self._lock:
+            self._connect().execute(
+                'UPDATE checkpoints SET heartbeat_at = ? WHERE date = ? AND mode = ? AND owner = ?',
+                (time.time(), date, mode, owner)
+            )
+    
+    def release_checkpoint(self, date: str, mode: str, owner: str):
+        """Génération owner interrompue : son point de reprise peut être repris tout de suite"""
+        with self._lock:
+            self._connect().execute(
+                'UPDATE checkpoints SET owner = NULL WHERE date = ? AND mode = ? AND owner = ?', (date, mode, owner)
+            )
+    
+    def clear_checkpoint(self, date: str, mode: str, owner: str):
+        """Supprime le point de reprise d'une génération terminée (s'il lui appartient toujours)"""
+        with self._lock:
+            self._connect().execute(
+                'DELETE FROM checkpoints WHERE date = ? AND mode = ? AND owner = ?', (date, mode, owner)
+            )
+    
+    def try_acquire_lease(self, name: str, ttl: float) -> bool:
+        """Prend (ou prolonge) le bail name pour ttl secondes si personne d'autre ne le détient"""
+        owner = str(os.getpid())
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute('SELECT owner, expires_at FROM leases WHERE name = ?', (name,)).fetchone()
+                # Bail d'un autre worker encore valide (et worker toujours en vie)
+                if row and row[0] != owner and row[1] > now and is_process_alive(int(row[0])):
+                    conn.execute('ROLLBACK')
+                    return False
+                conn.execute('INSERT OR REPLACE INTO leases (name, owner, expires_at) VALUES (?, ?, ?)', (name, owner, now + ttl))
+                conn.execute('COMMIT')
+                return True
+            except sqlite3.Error:
+                conn.execute('ROLLBACK')
+                raise
+    
+    def release_lease(self, name: str):
+        """Libère le bail name s'il appartient à ce processus"""
+        with self._lock:
+            self._connect().execute('DELETE FROM leases WHERE name = ? AND owner = ?', (name, str(os.getpid())))
+    
+    def save_flight_result(self, key: str, rows: List[Dict[str, Any]], started_at: float = None):
+        """
+        Publie le résultat d'une génération pour les workers qui l'attendent
+        Pas publié si une des dates de la clé a été invalidée depuis started_at : les workers en attente régénèrent
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute('DELETE FROM flight_results WHERE finished_at < ?', (now - FRESHEO_SINGLE_FLIGHT_TTL,))
+                if started_at is not None and any(self._invalidated_since(date, started_at)
+                                                  for date in key.split('|', 1)[0].split(',')):
+                    return
+                conn.execute('INSERT OR REPLACE INTO flight_results (key, rows, finished_at) VALUES (?, ?, ?)', (key, json.dumps(rows), now))
+    
+    def load_flight_result(self, key: str, since: float) -> List[Dict[str, Any]]:
+        """Résultat d'une génération terminée après since, ou None"""
+        with self._lock:
+            row = self._connect().execute(
+                'SELECT rows FROM flight_results WHERE key = ? AND finished_at >= ?', (key, since)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+_snapshot_store = None
+_snapshot_store_lock = threading.Lock()
+
+def get_snapshot_store() -> LabelSnapshotStore:
+    """Retourne le stockage des snapshots partagé du processus"""
+    global _snapshot_store
+    
+    with _snapshot_store_lock:
+        if _snapshot_store is None:
+            _snapshot_store = LabelSnapshotStore(FRESHEO_DATA_DIR)
+        return _snapshot_store
+
+_api_clients = {}
+
+def get_api_client() -> FresheoDeliveryAPI:
+    """
+    Retourne le client API partagé du processus, configuré depuis le fichier .env
+    Retourne None si le token n'est pas configuré
+    """
+    base_url = os.getenv('FRESHEO_BASE_URL', 'https://api.fresheo.be')
+    token = os.getenv('FRESHEO_API_TOKEN', 'your_default_token_here')
+    
+    if not token or token == 'your_default_token_here':
+        return None
+    
+    with _http_session_lock:
+        if (base_url, token) not in _api_clients:
+            _api_clients[(base_url, token)] = FresheoDeliveryAPI(base_url, token, cache=get_order_cache())
+        return _api_clients[(base_url, token)]
+
+def get_target_date(simulated_today: datetime = None) -> str:
+    """
+    Reproduit la logique SQL de filtrage par date selon le jour de la semaine
+    Note: Retourne la première date de la plage pour la nouvelle API
+    """
+    today = simulated_today if simulated_today else datetime.now()
+    day_of_week = today.weekday()  # 0=Lundi, 4=Vendredi, 5=Samedi, 6=Dimanche
+    
+    if day_of_week == 4:  # Vendredi → Samedi
+        return (today + timedelta(days=1)).strftime("%Y-%m-%d")
+    elif day_of_week == 5:  # Samedi → Dimanche (première date de la plage dim-mar)
+        return (today + timedelta(days=1)).strftime("%Y-%m-%d")
+    else:  # Autres jours → Aujourd'hui
+        return today.strftime("%Y-%m-%d")
+
+def get_target_dates_range(simulated_today: datetime = None) -> List[str]:
+    """
+    Retourne toutes les dates cibles selon la logique SQL EXACTE
+    SQL: WHEN 6 THEN shipping_date BETWEEN CURRENT_DATE + INTERVAL '1 day' AND CURRENT_DATE + INTERVAL '3 days'
+    """
+    today = simulated_today if simulated_today else datetime.now()
+    day_of_week = today.weekday()  # 0=Lundi, 4=Vendredi, 5=Samedi, 6=Dimanche
+    
+    if day_of_week == 4:  # Vendredi → Samedi (CURRENT_DATE + 1 day)
+        target_date = (today + timedelta(days=1)).strftime("%Y-%m-%d")
+        return [target_date]
+    elif day_of_week == 5:  # Samedi → Dimanche à Mardi (BETWEEN +1 day AND +3 days)
+        dates = []
+        dates.append((today + timedelta(days=1)).strftime("%Y-%m-%d"))  # Dimanche (+1)
+        dates.append((today + timedelta(days=2)).strftime("%Y-%m-%d"))  # Lundi (+2)
+        dates.append((today + timedelta(days=3)).strftime("%Y-%m-%d"))  # Mardi (+3)
+        return dates
+    else:  # Autres jours → Aujourd'hui (CURRENT_DATE)
+        return [today.strftime("%Y-%m-%d")]
+
+def get_day_name_french(date_str: str) -> str:
+    """Convertit une date en nom de jour en français"""
+    date_obj = datetime.strptime(date_str, "%Y-%m-%d")
+    days = ['lundi', 'mardi', 'mercredi', 'jeudi', 'vendredi', 'samedi', 'dimanche']
+    return days[date_obj.weekday()]
+
+def get_delivery_planning_name(date_str: str, time_slot: str) -> str:
+    """
+    Génère le delivery_planning_name au format "lundi matin" ou "mardi soir"
+    """
+    day_name = get_day_name_french(date_str)
+    
+    # Extraire l'heure du time_slot (format "09:00" ou "13:00")
+    try:
+        hour = int(time_slot.split(':')[0])
+        period = "matin" if hour < 12 else "soir"
+        return f"{day_name} {period}"
+    except (ValueError, IndexError):
+        return f"{day_name} journée"
+
+def format_customer_name(first_name: str, last_name: str) -> str:
+    """Formate le nom client en Title Case comme dans SQL INITCAP"""
+    return f"{first_name.title()} {last_name.title()}"
+
+def calculate_labels_quantity(total_meals: int) -> int:
+    """Calcule le nombre d'étiquettes nécessaires (ceil(total_meals / 7))"""
+    return math.ceil(total_meals / 7)
+
+def generate_color_code(delivery_tour_index: int) -> str:
+    """Génère le code couleur basé sur l'index de tournée"""
+    return f"color_{((delivery_tour_index % 10) + 1)}"
+
+class BuildProgress:
+    """
+    Avancement d'une génération de CSV : tournées détaillées (ou en erreur) et commandes récupérées
+    orders_defaulted : commandes dont total_meals a pris la valeur par défaut (détails vides ou sans le champ)
+    on_change(progress) est appelé à chaque mise à jour (depuis les threads de récupération)
+    Les compteurs sont aussi reportés dans parent s'il est fourni (ex: avancement d'une date → génération)
+    """
+    
+    def __init__(self, on_change=None, parent: 'BuildProgress' = None):
+        self.rounds_total = 0
+        self.rounds_done = 0
+        self.rounds_failed = 0
+        self.orders_total = 0
+        self.orders_fetched = 0
+        self.orders_defaulted = 0
+        self.on_change = on_change
+        self.parent = parent
+        self._lock = threading.Lock()
+    
+    def add(self, **counts: int):
+        """Incrémente les compteurs donnés (ex: add(rounds_done=1, orders_total=12))"""
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+        if self.on_change:
+            self.on_change(self)
+        if self.parent:
+            self.parent.add(**counts)
+    
+    def as_dict(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'rounds_total': self.rounds_total,
+                'rounds_done': self.rounds_done,
+                'rounds_failed': self.rounds_failed,
+                'orders_total': self.orders_total,
+                'orders_fetched': self.orders_fetched,
+                'orders_defaulted': self.orders_defaulted
+            }
+    
+    @property
+    def complete(self) -> bool:
+        """Aucune tournée en erreur ni commande avec une valeur par défaut : les lignes peuvent remplacer un snapshot"""
+        return self.rounds_failed == 0 and self.orders_defaulted == 0
+
+def build_csv_record(date: str, round_data: Dict[str, Any], order: Dict[str, Any],
+                     order_details: Dict[str, Any]) -> Dict[str, Any]:
+    """Construit la ligne CSV d'une commande"""
+    if order_details and 'total_meals' not in order_details:
+        ORDER_DETAILS_FALLBACKS.labels('missing_field').inc()
+    total_meals = order_details.get('total_meals', 4)  # Valeur par défaut si non trouvé
+    
+    return {
+        'order_id': order['id'],
+        'shipping_group': round_data['round'],  # Numéro de tournée
+        'shipping_order': order['index'],  # Position dans la tournée
+        'qrcode_data': f"BE_{order['id']}",
+        'total_meals': total_meals,
+        'max_meals': total_meals,  # Égal à total_meals comme suggéré
+        'labels_quantity': calculate_labels_quantity(total_meals),
+        'shipping_date': date,
+        'color': generate_color_code(round_data['round']),
+        'user_lang': 'FR',  # Fixe comme suggéré
+        'cust_name': order['customerName'],  # Disponible directement
+        'shipping_label': get_delivery_planning_name(date, round_data['timeOfDay']),
+        'delivery_status': order['deliveryStatus'] == 'replacement' if order['deliveryStatus'] else False
+    }
+
+def get_round_fingerprint(round_data: Dict[str, Any]) -> str:
+    """
+    Empreinte d'une tournée de la liste /rounds/delivery
+    Change dès qu'un champ de la tournée change (roundLength, ordersShipped, horaire...)
+    """
+    return hashlib.sha1(json.dumps(round_data, sort_keys=True).encode()).hexdigest()
+
+def iter_order_groups_for_csv(date: str, api: FresheoDeliveryAPI, max_workers: int = None,
+                              progress: BuildProgress = None, rounds: List[Dict[str, Any]] = None,
+                              round_store: LabelSnapshotStore = None, incremental: bool = False,
+                              round_filter=None) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Extrait les commandes d'une date groupe par groupe (shipping_label, shipping_group),
+    dans l'ordre du tri SQL : chaque groupe est produit dès que toutes ses commandes sont récupérées
+    Les détails de tournées et de commandes sont récupérés en parallèle
+    (au plus max_workers appels simultanés, FRESHEO_MAX_WORKERS par défaut)
+    L'avancement est reporté dans progress s'il est fourni
+    rounds peut contenir la liste des tournées du jour si elle a déjà été récupérée
+    Avec round_store, les lignes de chaque tournée sont gardées avec son empreinte ;
+    en mode incremental, seules les tournées nouvelles ou modifiées sont redemandées au back-office
+    Avec round_store, la génération laisse aussi un point de reprise (date, mode) : une génération
+    interrompue relancée dans les FRESHEO_CHECKPOINT_TTL secondes repart de sa liste de tournées,
+    de ses tournées terminées et de ses commandes déjà récupérées
+    round_filter(round_data) limite la génération aux tournées retenues (voir get_round_filter) :
+    les autres ne sont pas redemandées au back-office
+    """
+    mode = 'incremental' if incremental else 'full'
+    started_at = time.time()
+    checkpoint, concurrent = None, False
+    # Propriétaire du point de reprise : worker et génération
+    owner = f"{os.getpid()}:{uuid.uuid4().hex}"
+    if round_store is not None and FRESHEO_CHECKPOINT_TTL > 0:
+        if round_filter is None:
+            checkpoint, concurrent = round_store.claim_checkpoint(date, mode, owner)
+        else:
+            # Génération filtrée : profite d'un point de reprise sans le prendre
+            checkpoint = round_store.load_checkpoint(date, mode)
+    
+    # 1. Récupérer toutes les tournées du jour
+    if rounds is None and checkpoint is not None:
+        rounds = checkpoint['rounds']
+    elif rounds is None:
+        with BUILD_PHASE_DURATION.labels('list').time():
+            rounds = api.get_delivery_rounds_for_date(date)
+    
+    # Seule une génération complète laisse un point de reprise (une génération filtrée peut en profiter)
+    # Une génération de la même date et du même mode en cours ailleurs (préparation, autre requête) garde le sien
+    checkpointed = round_store is not None and FRESHEO_CHECKPOINT_TTL > 0 and round_filter is None and not concurrent
+    resumed_since = checkpoint['started_at'] if checkpoint else None
+    if checkpoint is not None:
+        logger.info(f"⏯️ {date}: reprise de la génération {mode} du {datetime.fromtimestamp(resumed_since).isoformat(timespec='seconds')}")
+    elif checkpointed:
+        round_store.save_checkpoint(date, mode, rounds, time.time(), owner)
+    
+    round_ids = [round_data['id'] for round_data in rounds]
+    if round_filter is not None:
+        rounds = [round_data for round_data in rounds if round_filter(round_data)]
+        logger.info(f"🔎 {date}: {len(rounds)}/{len(round_ids)} tournées retenues par le filtre")
+    if progress:
+        progress.add(rounds_total=len(rounds))
+    
+    # Groupes du tri SQL (shipping_label, shipping_group), connus dès la liste des tournées
+    groups = {}
+    for index, round_data in enumerate(rounds):
+        group_key = (get_delivery_planning_name(date, round_data['timeOfDay']), round_data['round'])
+        groups.setdefault(group_key, []).append(index)
+    
+    # Tournées inchangées depuis la dernière génération (incremental) ou déjà terminées par la génération
+    # reprise : lignes réutilisées telles quelles
+    fingerprints = [get_round_fingerprint(round_data) for round_data in rounds]
+    reused_rows = {}
+    if round_store is not None:
+        round_store.prune_round_rows(date, round_ids)
+        if incremental or checkpoint is not None:
+            known_rounds = round_store.load_round_rows(date, since=0 if incremental else resumed_since)
+            for index, round_data in enumerate(rounds):
+                known = known_rounds.get(round_data['id'])
+                if known and known[0] == fingerprints[index]:
+                    reused_rows[index] = known[1]
+                    if progress:
+                        progress.add(rounds_done=1, orders_total=len(known[1]), orders_fetched=len(known[1]))
+            logger.info(f"♻️ {date}: {len(reused_rows)}/{len(rounds)} tournées réutilisées")
+    
+    executor = ThreadPoolExecutor(max_workers=max_workers or FRESHEO_MAX_WORKERS)
+    # Fin des phases details / orders : dernier détail de tournée / de commande reçu
+    fetch_started = time.perf_counter()
+    phase_ends = {'details': fetch_started, 'orders': fetch_started}
+    
+    def mark_phase_end(phase: str):
+        phase_ends[phase] = max(phase_ends[phase], time.perf_counter())
+    
+    def fetch_round(round_data: Dict[str, Any]):
+        # Dès qu'une tournée est disponible, lancer la récupération de ses commandes
+        round_details = api.get_round_details(round_data['id'])
+        mark_phase_end('details')
+        order_futures = []
+        for order in round_details.get('orders', []):
+            order_future = executor.submit(api.get_order_details, order['id'], fresh_since=resumed_since)
+            order_future.add_done_callback(lambda future: mark_phase_end('orders'))
+            if progress:
+                order_future.add_done_callback(lambda future: progress.add(orders_fetched=1))
+            order_futures.append((order, order_future))
+        if progress:
+            # Détails de tournée vides = erreur de l'API : les commandes de la tournée manquent
+            progress.add(rounds_done=1, rounds_failed=0 if round_details else 1, orders_total=len(order_futures))
+        return bool(round_details), order_futures
+    
+    try:
+        # 2. Lancer la récupération des détails des tournées, dans l'ordre des groupes
+        round_futures = {}
+        for group_key in sorted(groups):
+            for index in groups[group_key]:
+                if index not in reused_rows:
+                    round_futures[index] = executor.submit(fetch_round, rounds[index])
+        
+        # 3. Produire les groupes dans l'ordre du tri SQL
+        # (tournées et commandes dans l'ordre de l'API, puis tri stable par shipping_order)
+        sort_duration = 0.0
+        for group_key in sorted(groups):
+            group_rows = []
+            for index in groups[group_key]:
+                if index in reused_rows:
+                    group_rows.extend(reused_rows[index])
+                    continue
+                
+                complete, order_futures = round_futures[index].result()
+                round_rows = []
+                for order, order_future in order_futures:
+                    try:
+                        order_details = order_future.result()
+                    except requests.exceptions.RequestException:
+                        # Détails indisponibles après les retries : pas d'étiquette avec une valeur
+                        # par défaut, la tournée est en erreur (la date est incomplète)
+                        if complete and progress:
+                            progress.add(rounds_failed=1)
+                        complete = False
+                        continue
+                    if 'total_meals' not in order_details:
+                        # Ligne avec la valeur par défaut : gardée dans le CSV, mais ni la tournée
+                        # ni le snapshot de la date ne sont enregistrés
+                        complete = False
+                        if progress:
+                            progress.add(orders_defaulted=1)
+                    round_rows.append(build_csv_record(date, rounds[index], order, order_details))
+                group_rows.extend(round_rows)
+                
+                # Ne pas garder une tournée construite avec des valeurs par défaut (erreur API)
+                if round_store is not None and complete:
+                    round_store.save_round_rows(date, rounds[index]['id'], fingerprints[index], round_rows, started_at=started_at)
+            
+            sort_started = time.perf_counter()
+            group_rows.sort(key=lambda x: x['shipping_order'])
+            sort_duration += time.perf_counter() - sort_started
+            CSV_ROWS.inc(len(group_rows))
+            if checkpointed:
+                round_store.touch_checkpoint(date, mode, owner)
+            yield group_rows
+        
+        if round_futures:
+            BUILD_PHASE_DURATION.labels('details').observe(phase_ends['details'] - fetch_started)
+            BUILD_PHASE_DURATION.labels('orders').observe(phase_ends['orders'] - fetch_started)
+        BUILD_PHASE_DURATION.labels('sort').observe(sort_duration)
+        
+        # Génération allée jusqu'au bout : plus rien à reprendre
+        if checkpointed:
+            round_store.clear_checkpoint(date, mode, owner)
+            checkpointed = False
+    finally:
+        # Génération abandonnée (ex: client déconnecté) : ne pas lancer les appels restants,
+        # ni attendre ceux en cours (leur réponse est ignorée)
+        executor.shutdown(wait=False, cancel_futures=True)
+        if checkpointed:
+            # Reprise possible tout de suite, sans attendre FRESHEO_CHECKPOINT_LEASE
+            round_store.release_checkpoint(date, mode, owner)
+
+def extract_orders_for_csv(date: str, api: FresheoDeliveryAPI, max_workers: int = None,
+                           progress: BuildProgress = None, round_store: LabelSnapshotStore = None,
+                           incremental: bool = False, round_filter=None) -> List[Dict[str, Any]]:
+    """
+    Extrait et formate toutes les commandes pour le CSV en utilisant la nouvelle API
+    Les lignes sont triées comme dans la requête SQL
+    (shipping_date, shipping_label, shipping_group, shipping_order)
+    """
+    orders_for_csv = []
+    for group_rows in iter_order_groups_for_csv(date, api, max_workers=max_workers, progress=progress,
+                                                round_store=round_store, incremental=incremental, round_filter=round_filter):
+        orders_for_csv.extend(group_rows)
+    return orders_for_csv
+
+# Colonnes du CSV, dans l'ordre de la requête SQL
+CSV_FIELDNAMES = [
+    'order_id', 'shipping_group', 'shipping_order', 'qrcode_data',
+    'total_meals', 'max_meals', 'labels_quantity', 'shipping_date',
+    'color', 'user_lang', 'cust_name', 'shipping_label', 'delivery_status'
+]
+
+def resolve_target_dates(args) -> Tuple[List[str], str]:
+    """
+    Résout les dates cibles depuis les paramètres de requête (date=, today= ou from=/to=)
+    Retourne (target_dates, suffixe du nom de fichier selon le mode)
+    Lève ValueError avec le message d'erreur destiné au client
+    """
+    test_date = args.get('date')      # Force une date de livraison spécifique
+    simulate_today = args.get('today') # Simule "quel jour on est"
+    date_from = args.get('from')      # Plage de dates de livraison (réimpressions)
+    date_to = args.get('to')
+    
+    if len([mode for mode in (test_date, simulate_today, date_from or date_to) if mode]) > 1:
+        raise ValueError('Utiliser soit date=, soit today=, soit from=/to=, pas plusieurs')
+    
+    if date_from or date_to:
+        # Mode 4: Plage de dates de livraison
+        if not (date_from and date_to):
+            raise ValueError('Les paramètres from= et to= doivent être utilisés ensemble')
+        try:
+            start = datetime.strptime(date_from, '%Y-%m-%d')
+            end = datetime.strptime(date_to, '%Y-%m-%d')
+        except ValueError:
+            raise ValueError('Format de date invalide pour from/to. Utiliser yyyy-mm-dd')
+        days = (end - start).days + 1
+        if days < 1:
+            raise ValueError('La date from= doit précéder la date to=')
+        if days > FRESHEO_MAX_RANGE_DAYS:
+            raise ValueError(f'Plage trop longue ({days} jours, maximum {FRESHEO_MAX_RANGE_DAYS})')
+        target_dates = [(start + timedelta(days=offset)).strftime('%Y-%m-%d') for offset in range(days)]
+        logger.info(f"🗓️ Mode plage: livraisons du {date_from} au {date_to}")
+        return target_dates, "_range"
+    
+    if test_date:
+        # Mode 1: Date de livraison forcée
+        try:
+            datetime.strptime(test_date, '%Y-%m-%d')
+        except ValueError:
+            raise ValueError('Format de date invalide. Utiliser yyyy-mm-dd')
+        logger.info(f"🎯 Mode date forcée: livraisons pour {test_date}")
+        return [test_date], "_date_forced"
+    
+    day_names = ['lundi', 'mardi', 'mercredi', 'jeudi', 'vendredi', 'samedi', 'dimanche']
+    
+    if simulate_today:
+        # Mode 2: Simulation du jour actuel + logique SQL
+        try:
+            simulated_today_dt = datetime.strptime(simulate_today, '%Y-%m-%d')
+        except ValueError:
+            raise ValueError('Format de date invalide pour today. Utiliser yyyy-mm-dd')
+        target_dates = get_target_dates_range(simulated_today_dt)
+        day_name = day_names[simulated_today_dt.weekday()]
+        logger.info(f"🧪 Mode simulation: comme si on était {day_name} {simulate_today}")
+        logger.info(f"📅 → Livraisons pour: {target_dates}")
+        return target_dates, f"_simulated_{simulate_today}"
+    
+    # Mode 3: Logique SQL normale (vraie date actuelle)
+    target_dates = get_target_dates_range()
+    real_today = datetime.now().strftime('%Y-%m-%d')
+    day_name = day_names[datetime.now().weekday()]
+    logger.info(f"📅 Mode automatique: vraiment {day_name} {real_today}")
+    logger.info(f"📅 → Livraisons pour: {target_dates}")
+    return target_dates, "_auto"
+
+def render_csv_header() -> str:
+    """Header du CSV"""
+    output = io.StringIO()
+    csv.DictWriter(output, fieldnames=CSV_FIELDNAMES).writeheader()
+    return output.getvalue()
+
+def render_csv_rows(rows: List[Dict[str, Any]]) -> str:
+    """Lignes CSV sans header (les lignes de plusieurs dates se concatènent)"""
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=CSV_FIELDNAMES)
+    with BUILD_PHASE_DURATION.labels('serialize').time():
+        writer.writerows(rows)
+    return output.getvalue()
+
+def render_indexed_csv_rows(rows: List[Dict[str, Any]]) -> Tuple[str, List[list]]:
+    """
+    Lignes CSV sans header et index des groupes (shipping_label, shipping_group), contigus après le tri :
+    [[shipping_label, shipping_group, début, fin, nombre de lignes], ...] (positions dans le texte)
+    """
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=CSV_FIELDNAMES)
+    row_index = []
+    with BUILD_PHASE_DURATION.labels('serialize').time():
+        for (label, group), group_rows in itertools.groupby(rows, key=lambda row: (row['shipping_label'], row['shipping_group'])):
+            group_rows = list(group_rows)
+            start = output.tell()
+            writer.writerows(group_rows)
+            row_index.append([label, group, start, output.tell(), len(group_rows)])
+    return output.getvalue(), row_index
+
+def get_csv_digest(csv_text: str) -> str:
+    """Empreinte du contenu CSV d'une date"""
+    return hashlib.sha1(csv_text.encode('utf-8')).hexdigest()
+
+def csv_part(csv_text: str, row_count: int, built_at: float, digest: str = None, row_index: List[list] = None) -> Dict[str, Any]:
+    """
+    Partie du CSV correspondant à une date : lignes rendues, empreinte, nombre de lignes,
+    date de construction et index des groupes (voir render_indexed_csv_rows)
+    """
+    return {
+        'csv': csv_text,
+        'digest': digest or get_csv_digest(csv_text),
+        'row_count': row_count,
+        'built_at': built_at,
+        'index': row_index or []
+    }
+
+def get_csv_filename(target_dates: List[str], mode_suffix: str) -> str:
+    """Nom du fichier CSV téléchargé"""
+    if mode_suffix == "_range":
+        filename_dates = f"{target_dates[0]}_to_{target_dates[-1]}"
+    else:
+        filename_dates = "_".join(target_dates)
+    return f"delivery_labels_{filename_dates}{mode_suffix}.csv"
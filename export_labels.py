@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Export en ligne de commande des CSV d'étiquettes, sans passer par le serveur
+
+Mêmes dates et même contenu que /delivery.csv, écrits directement sur disque :
+- un fichier par date (défaut), écrit dès que la date est terminée
+- ou un seul fichier pour toutes les dates (--combined)
+Les fichiers sont écrits de façon atomique (fichier temporaire puis renommage).
+Les dates sont traitées en parallèle et partagent le budget d'appels au back-office.
+
+Usage :
+    python export_labels.py                                      # dates du jour (logique SQL)
+    python export_labels.py --date 2025-08-05 --date 2025-08-06 -o exports/
+    python export_labels.py --from 2025-08-04 --to 2025-08-10 --combined semaine.csv
+    python export_labels.py --today 2025-08-02 --incremental
+
+Configuration lue comme le serveur (.env, FRESHEO_API_TOKEN, FRESHEO_BASE_URL...).
+N'importe que delivery_pipeline (client du back-office et génération des lignes), pas le serveur Flask.
+Code de sortie 1 si une date a échoué ou est incomplète.
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from typing import Any, Dict, List
+
+def parse_arguments(argv: List[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Export des CSV d'étiquettes de livraison sur disque")
+    dates = parser.add_mutually_exclusive_group()
+    dates.add_argument('--date', action='append', metavar='YYYY-MM-DD',
+                       help="Date de livraison (répétable)")
+    dates.add_argument('--today', metavar='YYYY-MM-DD',
+                       help="Simule le jour courant : dates de livraison selon la logique SQL")
+    dates.add_argument('--from', dest='date_from', metavar='YYYY-MM-DD', help="Début de plage (avec --to)")
+    parser.add_argument('--to', dest='date_to', metavar='YYYY-MM-DD', help="Fin de plage (avec --from)")
+    parser.add_argument('-o', '--output-dir', default='.', help="Répertoire des fichiers (défaut: répertoire courant)")
+    parser.add_argument('--combined', nargs='?', const='', metavar='FICHIER',
+                        help="Un seul fichier pour toutes les dates (nom du serveur si FICHIER est omis)")
+    parser.add_argument('--parallel', type=int, default=None,
+                        help="Dates traitées en parallèle (défaut: FRESHEO_MAX_PARALLEL_DATES)")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Ne redemander que les tournées nouvelles ou modifiées depuis la dernière génération")
+    parser.add_argument('-v', '--verbose', action='store_true', help="Afficher les logs du serveur")
+    args = parser.parse_args(argv)
+
+    if args.date_to and not args.date_from:
+        parser.error("--to s'utilise avec --from")
+    for value in (args.date or []):
+        try:
+            datetime.strptime(value, '%Y-%m-%d')
+        except ValueError:
+            parser.error(f"Format de date invalide: {value} (attendu yyyy-mm-dd)")
+    return args
+
+def write_atomic(path: str, content: str):
+    """Écrit le fichier via un fichier temporaire : jamais de CSV à moitié écrit"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(f"{path}.tmp", 'w', newline='', encoding='utf-8') as f:
+        f.write(content)
+    os.replace(f"{path}.tmp", path)
+
+def export_date(pipeline, date: str, api, incremental: bool) -> Dict[str, Any]:
+    """Génère les lignes d'une date et mesure la durée (aussi en cas d'échec)"""
+    started = time.perf_counter()
+    progress = pipeline.BuildProgress()
+    try:
+        rows = pipeline.extract_orders_for_csv(date, api, progress=progress,
+                                               round_store=pipeline.get_snapshot_store(), incremental=incremental)
+    except Exception as e:
+        return {'error': str(e), 'duration': time.perf_counter() - started}
+    return {
+        'rows': rows,
+        'duration': time.perf_counter() - started,
+        'rounds': progress.rounds_total,
+        'rounds_failed': progress.rounds_failed,
+        'orders_defaulted': progress.orders_defaulted,
+        'complete': progress.complete
+    }
+
+def print_summary(date: str, result: Dict[str, Any], path: str = None):
+    if 'error' in result:
+        print(f"❌ {date}: {result['error']} ({result['duration']:.1f}s)")
+        return
+    status = '✅' if result['complete'] else '⚠️ '
+    failed = f", {result['rounds_failed']} en erreur" if result['rounds_failed'] else ''
+    if result['orders_defaulted']:
+        failed += f", {result['orders_defaulted']} commande(s) avec total_meals par défaut"
+    target = f" → {path}" if path else ''
+    print(f"{status} {date}: {len(result['rows'])} commandes, {result['rounds']} tournées{failed} "
+          f"en {result['duration']:.1f}s{target}")
+
+def main(argv: List[str] = None) -> int:
+    """Point d'entrée principal"""
+    args = parse_arguments(argv)
+
+    # Import après la lecture des arguments : --help et les erreurs de saisie sont immédiats
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    import delivery_pipeline as pipeline
+
+    api = pipeline.get_api_client()
+    if api is None:
+        print("❌ Token API manquant. Configurer FRESHEO_API_TOKEN dans .env", file=sys.stderr)
+        return 1
+
+    if args.date:
+        target_dates, mode_suffix = list(dict.fromkeys(args.date)), '_date_forced'
+    else:
+        try:
+            target_dates, mode_suffix = pipeline.resolve_target_dates({
+                'today': args.today, 'from': args.date_from, 'to': args.date_to
+            })
+        except ValueError as e:
+            print(f"❌ {e}", file=sys.stderr)
+            return 1
+
+    print(f"🏷️ Export des étiquettes pour {', '.join(target_dates)}")
+    started = time.perf_counter()
+    results = {}
+
+    with ThreadPoolExecutor(max_workers=min(len(target_dates), args.parallel or pipeline.FRESHEO_MAX_PARALLEL_DATES)) as executor:
+        futures = {executor.submit(export_date, pipeline, date, api, args.incremental): date for date in target_dates}
+
+        # Un fichier par date : écrit dès que la date est terminée
+        for future in as_completed(futures):
+            date = futures[future]
+            results[date] = future.result()
+            path = None
+            if args.combined is None and 'error' not in results[date]:
+                path = os.path.join(args.output_dir, pipeline.get_csv_filename([date], mode_suffix))
+                write_atomic(path, pipeline.render_csv_header() + pipeline.render_csv_rows(results[date]['rows']))
+            print_summary(date, results[date], path)
+
+    failed_dates = [date for date in target_dates if 'error' in results[date]]
+    incomplete_dates = [date for date in target_dates if 'error' not in results[date] and not results[date]['complete']]
+
+    if args.combined is not None:
+        # Fichier unique : écrit seulement si toutes les dates ont été générées
+        if failed_dates:
+            print(f"❌ Fichier combiné non écrit (dates en échec: {', '.join(failed_dates)})")
+        else:
+            path = args.combined or os.path.join(args.output_dir, pipeline.get_csv_filename(target_dates, mode_suffix))
+            write_atomic(path, pipeline.render_csv_header() + ''.join(
+                pipeline.render_csv_rows(results[date]['rows']) for date in target_dates
+            ))
+            print(f"💾 {sum(len(results[date]['rows']) for date in target_dates)} commandes → {path}")
+
+    print(f"⏱️ Total: {time.perf_counter() - started:.1f}s pour {len(target_dates)} date(s)")
+    if incomplete_dates:
+        print(f"⚠️ Étiquettes manquantes ou incomplètes pour {', '.join(incomplete_dates)} (tournées en erreur, total_meals par défaut)")
+    return 1 if failed_dates or incomplete_dates else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+Faux back-office Fresheo pour les mesures de performance (benchmark.py)
+
+Simule les trois endpoints utilisés par le serveur d'étiquettes :
+- GET /api/bo/v1/rounds/delivery?date=yyyy-mm-dd
+- GET /api/bo/v1/rounds/delivery/{id}
+- GET /api/bo/v1/get-order/{id}/delivery
+
+Les données sont déterministes (même date = mêmes tournées et commandes),
+les latences et taux d'erreur sont configurables par endpoint.
+
+Usage :
+    python fake_backoffice.py --port 8765 --rounds 40 --orders 25 \\
+        --latency rounds=lognormal:2:0.3 --latency order_details=lognormal:0.08:0.5 \\
+        --error-rate order_details=0.01
+
+Puis lancer le serveur avec FRESHEO_BASE_URL=http://127.0.0.1:8765
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Tuple
+from urllib.parse import parse_qs, urlparse
+
+ENDPOINTS = ('rounds', 'round_details', 'order_details')
+TIMES_OF_DAY = ['09:00', '10:30', '13:00', '17:00', '19:00']
+DELIVERY_STATUSES = [None, 'normal', 'replacement']
+
+class LatencyModel:
+    """
+    Distribution de latence d'un endpoint, décrite par une chaîne :
+    - "0.05"                   : fixe (secondes)
+    - "uniform:0.02:0.2"       : uniforme entre min et max
+    - "lognormal:0.08:0.5"     : log-normale de médiane 0.08 s et sigma 0.5 (queue longue)
+    """
+
+    def __init__(self, spec: str):
+        self.spec = spec
+        parts = spec.split(':')
+        self.kind = parts[0] if len(parts) > 1 else 'fixed'
+        values = [float(value) for value in (parts[1:] if len(parts) > 1 else parts)]
+        expected = {'fixed': 1, 'uniform': 2, 'lognormal': 2}
+        if self.kind not in expected or len(values) != expected[self.kind]:
+            raise ValueError(f"Latence invalide: {spec}")
+        self.values = values
+
+    def sample(self, rnd: random.Random) -> float:
+        if self.kind == 'uniform':
+            return rnd.uniform(*self.values)
+        if self.kind == 'lognormal':
+            median, sigma = self.values
+            return rnd.lognormvariate(0, sigma) * median
+        return self.values[0]
+
+class FakeBackOffice:
+    """Données et comportement du faux back-office (latences, erreurs, compteurs d'appels)"""
+
+    def __init__(self, rounds_per_date: int = 20, orders_per_round: int = 20,
+                 latencies: Dict[str, str] = None, error_rates: Dict[str, float] = None,
+                 payload_kb: float = 4, seed: int = 0, capacity: int = 0):
+        self.rounds_per_date = rounds_per_date
+        self.orders_per_round = orders_per_round
+        self.latencies = {endpoint: LatencyModel((latencies or {}).get(endpoint, '0')) for endpoint in ENDPOINTS}
+        self.error_rates = {endpoint: (error_rates or {}).get(endpoint, 0.0) for endpoint in ENDPOINTS}
+        self.payload_kb = payload_kb
+        self.seed = seed
+        # Au-delà de capacity appels simultanés, le back-office répond 500 (0 = illimité)
+        self.capacity = capacity
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._counts = {}
+        self._in_flight = 0
+        self.max_in_flight = 0
+
+    # Compteurs d'appels par endpoint et code HTTP
+    def record(self, endpoint: str, status: int):
+        with self._lock:
+            key = (endpoint, status)
+            self._counts[key] = self._counts.get(key, 0) + 1
+
+    def counts(self) -> Dict[str, Dict[str, int]]:
+        """Appels reçus : {endpoint: {code HTTP: nombre}}"""
+        with self._lock:
+            counts = {}
+            for (endpoint, status), count in self._counts.items():
+                counts.setdefault(endpoint, {})[str(status)] = count
+            return counts
+
+    def reset_counts(self):
+        with self._lock:
+            self._counts = {}
+
+    def draw(self, endpoint: str) -> Tuple[float, bool]:
+        """Tire la latence et l'échec éventuel d'un appel"""
+        with self._lock:
+            latency = self.latencies[endpoint].sample(self._random)
+            failed = self._random.random() < self.error_rates[endpoint]
+        return latency, failed
+
+    def enter(self) -> bool:
+        """Début d'un appel, False si le back-office est saturé"""
+        with self._lock:
+            self._in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self._in_flight)
+            return not self.capacity or self._in_flight <= self.capacity
+
+    def leave(self):
+        with self._lock:
+            self._in_flight -= 1
+
+    # Données déterministes
+    def rounds_for_date(self, date: str) -> List[Dict[str, Any]]:
+        rnd = random.Random(f"{self.seed}-{date}")
+        base_id = int(date.replace('-', '')) * 1000
+        rounds = []
+        for index in range(self.rounds_per_date):
+            rounds.append({
+                'id': base_id + index,
+                'timeOfDay': TIMES_OF_DAY[index % len(TIMES_OF_DAY)],
+                'shippingDate': date,
+                'round': index // len(TIMES_OF_DAY) + 1,
+                'roundLength': self.orders_per_round,
+                'ordersShipped': rnd.randint(0, self.orders_per_round)
+            })
+        rnd.shuffle(rounds)
+        return rounds
+
+    def round_details(self, round_id: int) -> Dict[str, Any]:
+        rnd = random.Random(f"{self.seed}-{round_id}")
+        orders = []
+        for index in range(self.orders_per_round):
+            order_id = round_id * 1000 + index
+            orders.append({
+                'id': order_id,
+                'index': index + 1,
+                'customerName': f"Client {order_id}",
+                'deliveryStatus': rnd.choice(DELIVERY_STATUSES),
+                'isDelivered': False,
+                'isActive': True,
+                'firstDelivery': rnd.random() < 0.1
+            })
+        return {'id': round_id, 'orders': orders}
+
+    def order_details(self, order_id: int) -> List[Dict[str, Any]]:
+        rnd = random.Random(f"{self.seed}-{order_id}")
+        # Champs volumineux non utilisés par le CSV (repas, photos), comme le vrai back-office
+        meals_count = max(1, int(self.payload_kb * 1024 // 256))
+        return [{
+            'id': order_id,
+            'is_closed': rnd.random() < 0.5,
+            'total_meals': rnd.randint(1, 24),
+            'customer': {'first_name': 'Client', 'last_name': str(order_id), 'email': f"client{order_id}@example.com"},
+            'meals': [
+                {'id': meal, 'name': f"Repas {meal}", 'picture': f"https://cdn.example.com/meals/{meal}.jpg", 'description': 'x' * 160}
+                for meal in range(meals_count)
+            ]
+        }]
+
+class FakeBackOfficeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Réponse envoyée en un seul segment (pas de délai Nagle / ACK retardé)
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status: int, data: Any):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        backoffice = self.server.backoffice
+        url = urlparse(self.path)
+        parts = url.path.replace('/api/bo/v1', '', 1).strip('/').split('/')
+
+        if parts == ['_counts']:
+            return self.send_json(200, backoffice.counts())
+
+        if parts == ['rounds', 'delivery']:
+            endpoint = 'rounds'
+        elif len(parts) == 3 and parts[:2] == ['rounds', 'delivery'] and parts[2].isdigit():
+            endpoint = 'round_details'
+        elif len(parts) == 3 and parts[0] == 'get-order' and parts[1].isdigit() and parts[2] == 'delivery':
+            endpoint = 'order_details'
+        else:
+            return self.send_json(404, {'error': 'not found'})
+
+        latency, failed = backoffice.draw(endpoint)
+        available = backoffice.enter()
+        try:
+            time.sleep(latency)
+        finally:
+            backoffice.leave()
+        if failed or not available:
+            backoffice.record(endpoint, 500)
+            return self.send_json(500, {'error': 'simulated failure' if failed else 'overloaded'})
+
+        if endpoint == 'rounds':
+            date = parse_qs(url.query).get('date', [None])[0]
+            if not date:
+                backoffice.record(endpoint, 400)
+                return self.send_json(400, {'error': 'date parameter is required'})
+            data = backoffice.rounds_for_date(date)
+        elif endpoint == 'round_details':
+            data = backoffice.round_details(int(parts[2]))
+        else:
+            data = backoffice.order_details(int(parts[1]))
+        backoffice.record(endpoint, 200)
+        self.send_json(200, data)
+
+def start_fake_backoffice(backoffice: FakeBackOffice, host: str = '127.0.0.1', port: int = 0) -> ThreadingHTTPServer:
+    """Démarre le faux back-office dans un thread ; l'URL est dans server.url"""
+    server = ThreadingHTTPServer((host, port), FakeBackOfficeHandler)
+    server.daemon_threads = True
+    server.backoffice = backoffice
+    server.url = f"http://{host}:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def parse_endpoint_values(values: List[str], convert) -> Dict[str, Any]:
+    """Convertit des options "endpoint=valeur" en dictionnaire"""
+    result = {}
+    for value in values or []:
+        endpoint, _, raw = value.partition('=')
+        if endpoint not in ENDPOINTS or not raw:
+            raise argparse.ArgumentTypeError(f"Attendu endpoint=valeur avec endpoint parmi {', '.join(ENDPOINTS)}: {value}")
+        result[endpoint] = convert(raw)
+    return result
+
+def add_backoffice_arguments(parser: argparse.ArgumentParser):
+    """Options communes à fake_backoffice.py et benchmark.py"""
+    parser.add_argument('--rounds', type=int, default=20, help="Tournées par date (défaut: 20)")
+    parser.add_argument('--orders', type=int, default=20, help="Commandes par tournée (défaut: 20)")
+    parser.add_argument('--latency', action='append', metavar='ENDPOINT=SPEC',
+                        help="Latence d'un endpoint (rounds, round_details, order_details), ex: order_details=lognormal:0.08:0.5")
+    parser.add_argument('--error-rate', action='append', metavar='ENDPOINT=RATE',
+                        help="Proportion de réponses 500 pour un endpoint, ex: order_details=0.01")
+    parser.add_argument('--payload-kb', type=float, default=4, help="Taille approximative d'un détail de commande en Ko (défaut: 4)")
+    parser.add_argument('--seed', type=int, default=0, help="Graine des latences, erreurs et données (défaut: 0)")
+    parser.add_argument('--capacity', type=int, default=0,
+                        help="Appels simultanés au-delà desquels le back-office répond 500 (défaut: 0 = illimité)")
+
+def backoffice_from_arguments(args: argparse.Namespace) -> FakeBackOffice:
+    return FakeBackOffice(
+        rounds_per_date=args.rounds,
+        orders_per_round=args.orders,
+        latencies=parse_endpoint_values(args.latency, lambda raw: LatencyModel(raw).spec),
+        error_rates=parse_endpoint_values(args.error_rate, float),
+        payload_kb=args.payload_kb,
+        seed=args.seed,
+        capacity=args.capacity
+    )
+
+def main():
+    """Point d'entrée principal"""
+    parser = argparse.ArgumentParser(description="Faux back-office Fresheo pour les mesures de performance")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    add_backoffice_arguments(parser)
+    args = parser.parse_args()
+
+    backoffice = backoffice_from_arguments(args)
+    server = ThreadingHTTPServer((args.host, args.port), FakeBackOfficeHandler)
+    server.daemon_threads = True
+    server.backoffice = backoffice
+
+    print(f"🧪 Faux back-office sur http://{args.host}:{args.port} "
+          f"({args.rounds} tournées x {args.orders} commandes par date)")
+    print(f"📊 Compteurs d'appels: http://{args.host}:{args.port}/_counts")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+"""
+Configuration gunicorn (chargée automatiquement depuis le répertoire de lancement)
+Les options de lancement restent dans la commande du Dockerfile et GUNICORN_CMD_ARGS
+"""
+
+import glob
+import os
+
+def on_starting(server):
+    """Au démarrage du serveur : métriques multiprocess d'un lancement précédent supprimées"""
+    multiproc_dir = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+    if multiproc_dir:
+        for path in glob.glob(os.path.join(multiproc_dir, '*.db')):
+            os.remove(path)
+
+def post_worker_init(worker):
+    """Services d'arrière-plan du serveur, démarrés dans chaque worker (jamais à l'import de app.py)"""
+    import app
+    # Préparation planifiée des CSV : un seul worker prépare à la fois grâce au bail
+    app.start_prewarm_scheduler()
+
+def child_exit(server, worker):
+    """Worker arrêté (--max-requests, crash) : ses jauges livesum ne comptent plus dans /metrics"""
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
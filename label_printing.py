@@ -0,0 +1,303 @@
+"""
+Rendu des étiquettes prêtes à imprimer à partir des lignes du CSV de livraison
+
+- ZPL : imprimantes thermiques Zebra, le QR code est dessiné par l'imprimante (^BQ)
+- PDF : une page par étiquette, QR codes vectoriels calculés avec segno
+
+Chaque ligne donne labels_quantity étiquettes (numérotées 1/n, 2/n...).
+Les gabarits sont calculés une fois par format d'étiquette (lru_cache), puis remplis ligne par ligne.
+Ce module ne dépend pas du serveur : les processus de rendu des QR codes n'importent que lui.
+"""
+
+import functools
+from collections import deque
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+
+MM_PER_INCH = 25.4
+POINTS_PER_INCH = 72
+
+def expand_labels(row: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    """Étiquettes d'une ligne : labels_quantity copies numérotées (aucune pour 0, comme dans le CSV)"""
+    count = int(row['labels_quantity'])
+    for index in range(1, count + 1):
+        yield {
+            'cust_name': str(row['cust_name']),
+            'shipping_label': str(row['shipping_label']),
+            'group_line': f"Tournée {row['shipping_group']} - Position {row['shipping_order']}",
+            'meals_line': f"{row['total_meals']} repas - Étiquette {index}/{count}",
+            'color': str(row['color']),
+            'replacement': 'REMPLACEMENT' if str(row['delivery_status']) == 'True' else '',
+            'order_id': str(row['order_id']),
+            'qrcode_data': str(row['qrcode_data'])
+        }
+
+def iter_batches(rows: Iterable[Dict[str, Any]], size: int) -> Iterator[List[Dict[str, Any]]]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def truncate(text: str, max_chars: int) -> str:
+    return text if len(text) <= max_chars else text[:max(1, max_chars - 1)] + '…'
+
+class LabelLayout:
+    """Positions des éléments d'une étiquette (en mm, origine en haut à gauche)"""
+
+    def __init__(self, width_mm: float, height_mm: float):
+        self.width = width_mm
+        self.height = height_mm
+        self.margin = 3.0
+        # QR code carré à droite, texte à gauche
+        self.qr_size = min(height_mm - 2 * self.margin - 4, width_mm * 0.4)
+        self.qr_x = width_mm - self.margin - self.qr_size
+        self.qr_y = self.margin
+        self.text_width = self.qr_x - 2 * self.margin
+        # (champ, hauteur de police en mm, gras) du haut vers le bas
+        self.lines = [('cust_name', 5.0, True), ('shipping_label', 3.5, False),
+                      ('group_line', 3.5, False), ('meals_line', 3.5, False)]
+        self.badge_height = 7.0
+        self.badge_y = height_mm - self.margin - self.badge_height
+        self.badge_width = min(30.0, self.text_width)
+
+    def line_positions(self) -> List[Tuple[str, float, bool, float]]:
+        """(champ, hauteur, gras, haut de la ligne)"""
+        positions, top = [], self.margin
+        for field, size, bold in self.lines:
+            positions.append((field, size, bold, top))
+            top += size * 1.5
+        return positions
+
+    def max_chars(self, font_size: float) -> int:
+        # Largeur moyenne d'un caractère : ~0.55 x la hauteur de police
+        return max(1, int(self.text_width / (font_size * 0.55)))
+
+# ZPL
+
+def zpl_escape(value: str) -> str:
+    """Champ ^FH : les caractères de commande ZPL sont envoyés en hexadécimal (_XX)"""
+    return value.replace('_', '_5F').replace('^', '_5E').replace('~', '_7E')
+
+@functools.lru_cache(maxsize=16)
+def get_zpl_template(width_mm: float, height_mm: float, dpi: int) -> str:
+    """Gabarit ZPL d'une étiquette (champs {nom} à remplir), calculé une fois par format"""
+    layout = LabelLayout(width_mm, height_mm)
+
+    def dots(mm: float) -> int:
+        return int(round(mm * dpi / MM_PER_INCH))
+
+    commands = ['^XA', '^CI28', f'^PW{dots(width_mm)}', f'^LL{dots(height_mm)}']
+    for field, size, bold, top in layout.line_positions():
+        font_dots = dots(size * (1.15 if bold else 1))
+        commands.append(f'^FO{dots(layout.margin)},{dots(top)}^A0N,{font_dots},{font_dots}^FH^FD{{{field}}}^FS')
+    # Code couleur en blanc sur fond noir, mention de remplacement à côté
+    badge_dots = dots(layout.badge_height)
+    commands.append(f'^FO{dots(layout.margin)},{dots(layout.badge_y)}'
+                    f'^GB{dots(layout.badge_width)},{badge_dots},{badge_dots}^FS')
+    commands.append(f'^FO{dots(layout.margin + 1.5)},{dots(layout.badge_y + 1.5)}'
+                    f'^A0N,{dots(4)},{dots(4)}^FR^FH^FD{{color}}^FS')
+    commands.append(f'^FO{dots(layout.margin + layout.badge_width + 2)},{dots(layout.badge_y + 1.5)}'
+                    f'^A0N,{dots(4)},{dots(4)}^FH^FD{{replacement}}^FS')
+    # QR code dessiné par l'imprimante : version 1-2 (21-25 modules) + zone de silence
+    magnification = max(1, min(10, dots(layout.qr_size) // 29))
+    commands.append(f'^FO{dots(layout.qr_x)},{dots(layout.qr_y)}^BQN,2,{magnification}^FH^FDMA,{{qrcode_data}}^FS')
+    commands.append(f'^FO{dots(layout.qr_x)},{dots(layout.qr_y + layout.qr_size + 0.5)}'
+                    f'^A0N,{dots(2.5)},{dots(2.5)}^FD{{order_id}}^FS')
+    commands.append('^XZ')
+    return '\n'.join(commands) + '\n'
+
+def render_zpl_label(template: str, layout: LabelLayout, label: Dict[str, Any]) -> str:
+    fields = {key: zpl_escape(value) for key, value in label.items()}
+    for field, size, _, _ in layout.line_positions():
+        fields[field] = zpl_escape(truncate(label[field], layout.max_chars(size)))
+    return template.format(**fields)
+
+def iter_zpl(rows: Iterable[Dict[str, Any]], width_mm: float, height_mm: float, dpi: int,
+             batch_size: int = 100) -> Iterator[str]:
+    """Étiquettes ZPL, envoyées par lots de batch_size lignes"""
+    template = get_zpl_template(width_mm, height_mm, dpi)
+    layout = LabelLayout(width_mm, height_mm)
+    for batch in iter_batches(rows, batch_size):
+        yield ''.join(render_zpl_label(template, layout, label) for row in batch for label in expand_labels(row))
+
+# PDF
+
+def render_qr_batch(data: List[str]) -> List[Tuple[str, int]]:
+    """
+    QR codes d'un lot (exécuté dans les processus de rendu) : pour chaque donnée,
+    les rectangles des modules noirs en unités de module (opérateurs PDF "re") et la taille du symbole
+    """
+    import segno
+
+    results = []
+    for value in data:
+        matrix = segno.make_qr(value, error='m').matrix
+        size = len(matrix)
+        operators = []
+        for row_number, row in enumerate(matrix):
+            y = size - 1 - row_number
+            column = 0
+            while column < size:
+                if row[column]:
+                    start = column
+                    while column < size and row[column]:
+                        column += 1
+                    operators.append(f'{start} {y} {column - start} 1 re')
+                else:
+                    column += 1
+        results.append((' '.join(operators), size))
+    return results
+
+def pdf_text(value: str) -> str:
+    """Chaîne PDF littérale en WinAnsiEncoding (police standard Helvetica)"""
+    encoded = value.encode('cp1252', errors='replace').decode('latin-1')
+    return '(' + encoded.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)') + ')'
+
+@functools.lru_cache(maxsize=16)
+def get_pdf_template(width_mm: float, height_mm: float) -> Tuple[str, Dict[str, int]]:
+    """Gabarit du contenu d'une page (champs {nom} à remplir) et nombre max de caractères par ligne"""
+    layout = LabelLayout(width_mm, height_mm)
+
+    def points(mm: float) -> str:
+        return f'{mm * POINTS_PER_INCH / MM_PER_INCH:.2f}'
+
+    def baseline(top: float, size: float) -> str:
+        return points(height_mm - top - size)
+
+    operations = ['0 g']
+    max_chars = {}
+    for field, size, bold, top in layout.line_positions():
+        font = 'F2' if bold else 'F1'
+        operations.append(f'BT /{font} {points(size * 1.4)} Tf {points(layout.margin)} {baseline(top, size)} Td {{{field}}} Tj ET')
+        max_chars[field] = layout.max_chars(size)
+    operations.append(f'{points(layout.margin)} {points(height_mm - layout.badge_y - layout.badge_height)} '
+                      f'{points(layout.badge_width)} {points(layout.badge_height)} re f')
+    operations.append(f'1 g BT /F2 {points(5)} Tf {points(layout.margin + 1.5)} {baseline(layout.badge_y + 1.2, 4)} Td {{color}} Tj ET 0 g')
+    operations.append(f'BT /F2 {points(5)} Tf {points(layout.margin + layout.badge_width + 2)} '
+                      f'{baseline(layout.badge_y + 1.2, 4)} Td {{replacement}} Tj ET')
+    operations.append(f'BT /F1 {points(3)} Tf {points(layout.qr_x)} {baseline(layout.qr_y + layout.qr_size + 0.5, 2.5)} '
+                      f'Td {{order_id}} Tj ET')
+    # QR code : rectangles en unités de module, mis à l'échelle par la matrice {qr_matrix}
+    operations.append('q {qr_matrix} cm {qr_operators} f Q')
+    return '\n'.join(operations), max_chars
+
+class PdfStream:
+    """
+    Écriture d'un PDF au fil de l'eau : chaque page est envoyée dès qu'elle est prête,
+    la table des objets (xref) et l'arbre des pages sont écrits à la fin
+    """
+
+    CATALOG, PAGES, FONT, FONT_BOLD = 1, 2, 3, 4
+
+    def __init__(self, width_mm: float, height_mm: float):
+        self.media_box = (f'0 0 {width_mm * POINTS_PER_INCH / MM_PER_INCH:.2f} '
+                          f'{height_mm * POINTS_PER_INCH / MM_PER_INCH:.2f}')
+        self.offsets = {}
+        self.position = 0
+        self.pages = []
+        self.next_object = 5
+
+    def _object(self, number: int, body: bytes) -> bytes:
+        self.offsets[number] = self.position
+        data = f'{number} 0 obj\n'.encode('ascii') + body + b'\nendobj\n'
+        self.position += len(data)
+        return data
+
+    def begin(self) -> bytes:
+        header = b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n'
+        self.position = len(header)
+        return header + b''.join([
+            self._object(self.CATALOG, f'<< /Type /Catalog /Pages {self.PAGES} 0 R >>'.encode('ascii')),
+            self._object(self.FONT, b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>'),
+            self._object(self.FONT_BOLD, b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold /Encoding /WinAnsiEncoding >>')
+        ])
+
+    def page(self, content: str) -> bytes:
+        stream = content.encode('latin-1')
+        content_number, page_number = self.next_object, self.next_object + 1
+        self.next_object += 2
+        self.pages.append(page_number)
+        return self._object(
+            content_number, f'<< /Length {len(stream)} >>\nstream\n'.encode('ascii') + stream + b'\nendstream'
+        ) + self._object(page_number, (
+            f'<< /Type /Page /Parent {self.PAGES} 0 R /MediaBox [{self.media_box}] '
+            f'/Resources << /Font << /F1 {self.FONT} 0 R /F2 {self.FONT_BOLD} 0 R >> >> /Contents {content_number} 0 R >>'
+        ).encode('ascii'))
+
+    def end(self) -> bytes:
+        kids = ' '.join(f'{number} 0 R' for number in self.pages)
+        data = self._object(self.PAGES, f'<< /Type /Pages /Kids [{kids}] /Count {len(self.pages)} >>'.encode('ascii'))
+        xref_position = self.position
+        lines = [f'xref\n0 {self.next_object}\n', '0000000000 65535 f \n']
+        lines += [f'{self.offsets[number]:010d} 00000 n \n' for number in range(1, self.next_object)]
+        lines.append(f'trailer\n<< /Size {self.next_object} /Root {self.CATALOG} 0 R >>\nstartxref\n{xref_position}\n%%EOF\n')
+        return data + ''.join(lines).encode('ascii')
+
+def iter_pdf(rows: Iterable[Dict[str, Any]], width_mm: float, height_mm: float,
+             executor=None, batch_size: int = 100, prefetch: int = 4) -> Iterator[bytes]:
+    """
+    PDF d'une page par étiquette, envoyé lot par lot
+    Les QR codes des lots suivants (prefetch lots d'avance) sont calculés par executor (pool de processus)
+    pendant que le lot courant est écrit ; sans executor, ils sont calculés sur place
+    Si le pool casse (processus de rendu tué), les lots restants sont calculés sur place
+    """
+    template, max_chars = get_pdf_template(width_mm, height_mm)
+    layout = LabelLayout(width_mm, height_mm)
+    writer = PdfStream(width_mm, height_mm)
+    yield writer.begin()
+
+    batches = iter_batches(rows, batch_size)
+    pending = deque()
+
+    def submit_next() -> bool:
+        nonlocal executor
+        batch = next(batches, None)
+        if batch is None:
+            return False
+        # Un QR code par commande, partagé par ses étiquettes
+        data = list(dict.fromkeys(str(row['qrcode_data']) for row in batch))
+        result = None
+        if executor is not None:
+            try:
+                result = executor.submit(render_qr_batch, data)
+            except BrokenProcessPool:
+                executor = None
+        pending.append((batch, data, result if result is not None else render_qr_batch(data)))
+        return True
+
+    def qr_results(data: List[str], result) -> List[Tuple[str, int]]:
+        nonlocal executor
+        if not isinstance(result, Future):
+            return result
+        try:
+            return result.result()
+        except BrokenProcessPool:
+            executor = None
+            return render_qr_batch(data)
+
+    while len(pending) < max(1, prefetch) and submit_next():
+        pass
+
+    while pending:
+        batch, data, result = pending.popleft()
+        submit_next()
+        qr_codes = dict(zip(data, qr_results(data, result)))
+        pages = []
+        for row in batch:
+            qr_operators, qr_modules = qr_codes[str(row['qrcode_data'])]
+            scale = layout.qr_size / qr_modules * POINTS_PER_INCH / MM_PER_INCH
+            qr_matrix = (f'{scale:.4f} 0 0 {scale:.4f} {layout.qr_x * POINTS_PER_INCH / MM_PER_INCH:.2f} '
+                         f'{(height_mm - layout.qr_y - layout.qr_size) * POINTS_PER_INCH / MM_PER_INCH:.2f}')
+            for label in expand_labels(row):
+                fields = {key: pdf_text(value) for key, value in label.items()}
+                for field, limit in max_chars.items():
+                    fields[field] = pdf_text(truncate(label[field], limit))
+                pages.append(writer.page(template.format(qr_matrix=qr_matrix, qr_operators=qr_operators, **fields)))
+        yield b''.join(pages)
+
+    yield writer.end()
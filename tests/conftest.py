@@ -0,0 +1,55 @@
+"""
+Serveur d'étiquettes branché sur le faux back-office (fake_backoffice.py), dans le processus des tests
+
+La configuration est lue à l'import de app.py : le faux back-office est démarré et l'environnement
+préparé avant l'import, une fois pour toute la session (chaque test utilise ses propres dates)
+"""
+
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fake_backoffice import ENDPOINTS, FakeBackOffice, start_fake_backoffice
+
+INVALIDATE_TOKEN = 'test-invalidate-token'
+
+@pytest.fixture(scope='session')
+def backoffice():
+    """Données déterministes (graine fixe) : les CSV de référence de tests/data en dépendent"""
+    return FakeBackOffice(rounds_per_date=6, orders_per_round=5, seed=7)
+
+@pytest.fixture(scope='session')
+def labels(backoffice, tmp_path_factory):
+    """Module app.py configuré sur le faux back-office"""
+    server = start_fake_backoffice(backoffice)
+    os.environ.update({
+        'FRESHEO_BASE_URL': server.url,
+        'FRESHEO_API_TOKEN': 'test-token',
+        'FRESHEO_DATA_DIR': str(tmp_path_factory.mktemp('data')),
+        'FRESHEO_INVALIDATE_TOKEN': INVALIDATE_TOKEN,
+        # Erreurs simulées : pas de nouvelle tentative ni de requête de secours
+        'FRESHEO_MAX_RETRIES': '0',
+        'FRESHEO_HEDGE_ENDPOINTS': '',
+        # Toujours attendre la génération (pas de snapshot servi à cause d'un délai)
+        'FRESHEO_STALE_AFTER': '0',
+        'FRESHEO_PREWARM_AT': '',
+        'FRESHEO_LABEL_PROCESSES': '0',
+        'FRESHEO_ACCEL_REDIRECT': ''
+    })
+    import app
+    yield app
+    server.shutdown()
+
+@pytest.fixture
+def client(labels, backoffice):
+    """Client de test ; le faux back-office répond sans erreur au début de chaque test"""
+    for endpoint in ENDPOINTS:
+        backoffice.error_rates[endpoint] = 0.0
+    backoffice.reset_counts()
+    yield labels.app.test_client()
+    for endpoint in ENDPOINTS:
+        backoffice.error_rates[endpoint] = 0.0
@@ -0,0 +1,193 @@
+"""
+/delivery.csv contre le faux back-office : contenu de référence, filtres, invalidation, commandes en erreur
+"""
+
+import csv
+import io
+import os
+
+import pytest
+
+from conftest import INVALIDATE_TOKEN
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+def read_baseline(name: str) -> bytes:
+    with open(os.path.join(DATA_DIR, name), 'rb') as f:
+        return f.read()
+
+def csv_rows(data: bytes):
+    return list(csv.DictReader(io.StringIO(data.decode('utf-8'))))
+
+# Contenu de référence (CSV produits par la version d'origine du serveur, avec les mêmes données)
+
+@pytest.mark.parametrize('stream', [False, True], ids=['buffered', 'stream'])
+@pytest.mark.parametrize('query, baseline', [
+    ('date=2025-08-05', 'delivery_2025-08-05.csv'),
+    ('today=2025-08-02', 'delivery_today_2025-08-02.csv'),
+], ids=['date', 'today'])
+def test_csv_matches_baseline(client, query, baseline, stream):
+    response = client.get(f"/delivery.csv?{query}{'&stream=1' if stream else ''}")
+    assert response.status_code == 200
+    assert response.get_data() == read_baseline(baseline)
+
+def test_csv_filename(client):
+    response = client.get('/delivery.csv?today=2025-08-02')
+    assert response.headers['Content-Disposition'] == (
+        'attachment; filename=delivery_labels_2025-08-03_2025-08-04_2025-08-05_simulated_2025-08-02.csv'
+    )
+
+# Filtres de lignes
+
+FILTER_DATE = '2025-08-12'
+
+@pytest.fixture
+def full_rows(client):
+    response = client.get(f'/delivery.csv?date={FILTER_DATE}')
+    assert response.status_code == 200
+    return csv_rows(response.get_data())
+
+@pytest.mark.parametrize('stream', [False, True], ids=['buffered', 'stream'])
+def test_shipping_group_filter(client, full_rows, stream):
+    response = client.get(f"/delivery.csv?date={FILTER_DATE}&shipping_group=2{'&stream=1' if stream else ''}")
+    assert response.status_code == 200
+    expected = [row for row in full_rows if row['shipping_group'] == '2']
+    assert expected
+    assert csv_rows(response.get_data()) == expected
+
+def test_shipping_group_ranges_are_merged(client, full_rows):
+    response = client.get(f'/delivery.csv?date={FILTER_DATE}&shipping_group=1-1,2&shipping_group=1')
+    assert csv_rows(response.get_data()) == full_rows
+
+def test_shipping_label_filter(client, full_rows):
+    label = full_rows[0]['shipping_label']
+    response = client.get(f'/delivery.csv?date={FILTER_DATE}&shipping_label={label.upper()}')
+    assert response.status_code == 200
+    assert csv_rows(response.get_data()) == [row for row in full_rows if row['shipping_label'] == label]
+
+def test_shipping_date_filter_builds_only_that_date(client, backoffice, full_rows):
+    backoffice.reset_counts()
+    response = client.get(f'/delivery.csv?from={FILTER_DATE}&to=2025-08-18&shipping_date={FILTER_DATE}')
+    assert response.status_code == 200
+    assert csv_rows(response.get_data()) == full_rows
+    assert backoffice.counts()['rounds'] == {'200': 1}
+
+@pytest.mark.parametrize('query', [
+    f'date={FILTER_DATE}&shipping_group=3-1',
+    f'date={FILTER_DATE}&shipping_group=abc',
+    f'date={FILTER_DATE}&shipping_group=1-x',
+    f'date={FILTER_DATE}&shipping_date=2025-13-01',
+    f'date={FILTER_DATE}&shipping_date=2025-08-13',
+    f'date={FILTER_DATE}&today=2025-08-10',
+    f'from={FILTER_DATE}',
+], ids=['reversed-range', 'not-a-number', 'bad-range-end', 'bad-date', 'date-not-targeted', 'date-and-today',
+        'from-without-to'])
+def test_invalid_parameters_are_rejected(client, backoffice, query):
+    response = client.get(f'/delivery.csv?{query}')
+    assert response.status_code == 400
+    assert response.get_json()['error']
+    # Rejeté avant tout appel au back-office
+    assert backoffice.counts() == {}
+
+# Invalidation ciblée
+
+INVALIDATION_DATE = '2025-08-13'
+AUTHORIZATION = {'Authorization': f'Bearer {INVALIDATE_TOKEN}'}
+
+def test_invalidate_requires_token(client):
+    response = client.post('/invalidate', json={'dates': [INVALIDATION_DATE]},
+                           headers={'Authorization': 'Bearer wrong'})
+    assert response.status_code == 401
+
+@pytest.mark.parametrize('body', [
+    {},
+    {'order_ids': 'not-a-list'},
+    {'order_ids': [True]},
+    {'dates': ['13/08/2025']},
+], ids=['empty', 'not-a-list', 'bool-id', 'bad-date'])
+def test_invalidate_rejects_invalid_body(client, body):
+    response = client.post('/invalidate', json=body, headers=AUTHORIZATION)
+    assert response.status_code == 400
+    assert response.get_json()['error']
+
+def test_invalidate_date_rebuilds_from_backoffice(client, backoffice):
+    first = client.get(f'/delivery.csv?date={INVALIDATION_DATE}')
+    assert first.headers['X-Data-Source'] == 'live'
+
+    response = client.post('/invalidate', json={'dates': [INVALIDATION_DATE]}, headers=AUTHORIZATION)
+    assert response.status_code == 200
+    assert response.get_json()['snapshots_evicted'] == [INVALIDATION_DATE]
+
+    backoffice.reset_counts()
+    second = client.get(f'/delivery.csv?date={INVALIDATION_DATE}&incremental=1')
+    assert second.get_data() == first.get_data()
+    # Plus aucune tournée réutilisable pour la date : toutes redemandées
+    assert backoffice.counts()['round_details'] == {'200': backoffice.rounds_per_date}
+
+def test_invalidate_order_refetches_only_that_order(client, backoffice):
+    first = client.get(f'/delivery.csv?date={INVALIDATION_DATE}&incremental=1')
+    order_id = int(csv_rows(first.get_data())[0]['order_id'])
+
+    response = client.post('/invalidate', json={'order_ids': [order_id]}, headers=AUTHORIZATION)
+    assert response.status_code == 200
+    evicted = response.get_json()
+    assert evicted['orders_evicted'] == 1
+    assert len(evicted['rounds_evicted']) == 1
+
+    backoffice.reset_counts()
+    second = client.get(f'/delivery.csv?date={INVALIDATION_DATE}&incremental=1')
+    assert second.get_data() == first.get_data()
+    counts = backoffice.counts()
+    assert counts['round_details'] == {'200': 1}
+    assert counts['order_details'] == {'200': 1}
+
+def test_invalidate_drops_coalesced_results_of_the_date(labels):
+    store = labels.get_snapshot_store()
+    rows = [{'order_id': 1}]
+    store.save_flight_result(f'{INVALIDATION_DATE}|full', rows)
+    store.save_flight_result(f'2025-08-12,{INVALIDATION_DATE}|incremental', rows)
+    store.save_flight_result('2025-08-12|full', rows)
+
+    store.invalidate([], [], [INVALIDATION_DATE])
+    assert store.load_flight_result(f'{INVALIDATION_DATE}|full', since=0) is None
+    assert store.load_flight_result(f'2025-08-12,{INVALIDATION_DATE}|incremental', since=0) is None
+    assert store.load_flight_result('2025-08-12|full', since=0) == rows
+
+# Détails de commandes en erreur
+
+def fail_order_details(labels, backoffice):
+    """Toutes les commandes en erreur, y compris celles déjà en cache"""
+    labels.get_order_cache().clear()
+    backoffice.error_rates['order_details'] = 1.0
+
+def test_failed_orders_buffered_without_snapshot(client, labels, backoffice):
+    fail_order_details(labels, backoffice)
+    response = client.get('/delivery.csv?date=2025-08-14')
+    assert response.status_code == 200
+    assert response.headers['X-Data-Source'] == 'partial'
+    assert response.headers['X-Incomplete-Dates'] == '2025-08-14'
+    assert csv_rows(response.get_data()) == []
+
+def test_failed_orders_buffered_serves_snapshot(client, labels, backoffice):
+    complete = client.get('/delivery.csv?date=2025-08-15')
+    assert complete.headers['X-Data-Source'] == 'live'
+
+    fail_order_details(labels, backoffice)
+    response = client.get('/delivery.csv?date=2025-08-15')
+    assert response.status_code == 200
+    assert response.headers['X-Data-Source'] == 'snapshot'
+    assert 'X-Incomplete-Dates' not in response.headers
+    assert response.get_data() == complete.get_data()
+
+def test_failed_orders_stream_without_snapshot_is_interrupted(client, labels, backoffice):
+    fail_order_details(labels, backoffice)
+    # Headers déjà envoyés : la réponse s'arrête en erreur au lieu de se terminer sur un CSV incomplet
+    with pytest.raises(labels.IncompleteDateError):
+        client.get('/delivery.csv?date=2025-08-16&stream=1').get_data()
+
+def test_failed_orders_stream_serves_snapshot(client, labels, backoffice):
+    complete = client.get('/delivery.csv?date=2025-08-17')
+    fail_order_details(labels, backoffice)
+    response = client.get('/delivery.csv?date=2025-08-17&stream=1')
+    assert response.status_code == 200
+    assert response.get_data() == complete.get_data()